@@ -13,7 +13,6 @@
 from bkr.client.command import Command
 from bkr.common.pyconfig import PyConfigParser
 import glob
-import pkg_resources
 
 user_config_file = os.environ.get("BEAKER_CLIENT_CONF", None)
 if not user_config_file:
@@ -44,6 +43,8 @@ def host_filter_presets():
     if _host_filter_presets is not None:
         return _host_filter_presets
 
+    # pkg_resources is slow to import, only pay for it when we need it
+    import pkg_resources
     _host_filter_presets = {}
     config_files = \
                    sorted(glob.glob(pkg_resources.resource_filename('bkr.client', 'host-filters/*.conf'))) + \
@@ -127,6 +127,9 @@ def __getitem__(self, name):
     def __iter__(self):
         return self.plugins.iterkeys()
 
+    def __contains__(self, name):
+        return self.normalize_name(name) in self.plugins
+
     @classmethod
     def normalize_name(cls, name):
         return name
@@ -367,7 +370,7 @@ def parse_args(self, args=None, values=None):
             command = self.default_command
             # keep args as is
 
-        if not command in self.container.plugins:
+        if command not in self.container:
             self.error("unknown command: %s" % command)
 
         CommandClass = self.container[command]
@@ -8,13 +8,11 @@
 
 import os
 import sys
-import pkg_resources
 import logging
 from optparse import Option, IndentedHelpFormatter, SUPPRESS_HELP
 import xmlrpclib
 import cgi
-import krbV
-from bkr.client.command import CommandOptionParser, ClientCommandContainer, BeakerClientConfigurationError
+from bkr.client.command import Plugin, CommandOptionParser, ClientCommandContainer, BeakerClientConfigurationError
 from bkr.common import __version__
 from bkr.log import log_to_stream
 
@@ -25,9 +23,65 @@
 
 
 class BeakerCommandContainer(ClientCommandContainer):
+    """
+    Commands are registered lazily. Looking up a command by name imports only
+    the module which provides it, the complete set of commands is loaded
+    only when something needs all of them (such as the help output).
+    """
+
+    _all_registered = False
+
+    @classmethod
+    def builtin_command_modules(cls):
+        """
+        Returns a dict of (command name -> module name) for the modules in the
+        bkr.client.commands package, without importing them. Each cmd_foo_bar
+        module is expected to provide the foo-bar command.
+        """
+        import bkr.client.commands
+        path = os.path.dirname(bkr.client.commands.__file__)
+        modules = {}
+        for fn in os.listdir(path):
+            # same rules as ClientCommandContainer.register_module
+            if not fn.startswith('cmd_') or not fn.endswith('.py'):
+                continue
+            modules[cls.normalize_name(fn[4:-3])] = fn[:-3]
+        return modules
+
+    @classmethod
+    def register_command(cls, name):
+        """
+        Registers the named command, importing only the module which provides
+        it. Commands from setuptools entry points override the built-in
+        commands, as in register_all. Falls back to registering all commands
+        if the command is not provided by the module we expect.
+        """
+        name = cls.normalize_name(name)
+        if name in cls._get_plugins():
+            return
+        import pkg_resources
+        for entrypoint in pkg_resources.iter_entry_points('bkr.client.commands'):
+            if cls.normalize_name(entrypoint.name) == name:
+                cls.register_plugin(entrypoint.load(), name=entrypoint.name)
+                return
+        module_name = cls.builtin_command_modules().get(name)
+        if module_name is not None:
+            module_name = 'bkr.client.commands.%s' % module_name
+            __import__(module_name)
+            module = sys.modules[module_name]
+            for pn in dir(module):
+                plugin = getattr(module, pn)
+                if type(plugin) is type and issubclass(plugin, Plugin) \
+                        and plugin is not Plugin:
+                    cls.register_plugin(plugin)
+            if name in cls._get_plugins():
+                return
+        cls.register_all()
 
     @classmethod
     def register_all(cls):
+        if cls._all_registered:
+            return
         # Load all modules in the bkr.client.commands package as commands, for 
         # backwards compatibility with older packages that just drop their files 
         # into the bkr.client.commands package.
@@ -36,8 +90,30 @@ def register_all(cls):
         # Load subcommands from setuptools entry points in the bkr.client.commands 
         # group. This is the new, preferred way for other packages to provide their 
         # own bkr subcommands.
+        import pkg_resources
         for entrypoint in pkg_resources.iter_entry_points('bkr.client.commands'):
             cls.register_plugin(entrypoint.load(), name=entrypoint.name)
+        cls._all_registered = True
+
+    def __contains__(self, name):
+        self.register_command(name)
+        return self.normalize_name(name) in self._get_plugins()
+
+    def _get_plugin(self, name):
+        self.register_command(name)
+        normalized_name = self.normalize_name(name)
+        plugins = self._get_plugins()
+        if normalized_name not in plugins:
+            raise KeyError("Plugin not found: %s" % normalized_name)
+        plugin = plugins[normalized_name]
+        plugin.container = self
+        plugin.normalized_name = normalized_name
+        return plugin
+
+    @property
+    def plugins(self):
+        self.register_all()
+        return self._get_plugins()
 
 class BeakerOptionParser(CommandOptionParser):
     standard_option_list = [
@@ -53,7 +129,6 @@ class BeakerOptionParser(CommandOptionParser):
             help=SUPPRESS_HELP),
     ]
 
-BeakerCommandContainer.register_all()
 from bkr.client import conf, BeakerJobTemplateError
 
 def warn_on_version_mismatch(response):
@@ -70,6 +145,14 @@ def warn_on_version_mismatch(response):
                     'but server version is %s\n'
                     % (__version__, server_version))
 
+def krb5_errors():
+    # krbV is only imported once Kerberos authentication is attempted, so
+    # there cannot be any Kerberos errors if it was never imported.
+    krbV = sys.modules.get('krbV')
+    if krbV is None:
+        return ()
+    return (krbV.Krb5Error,)
+
 def main():
     log_to_stream(sys.stderr, level=logging.WARNING)
 
@@ -99,7 +182,8 @@ def main():
 
     try:
         return cmd.run(*cmd_args, **cmd_opts.__dict__)
-    except krbV.Krb5Error, e:
+    except krb5_errors(), e:
+        krbV = sys.modules['krbV']
         if e.args[0] == krbV.KRB5KRB_AP_ERR_TKT_EXPIRED:
             sys.stderr.write('Kerberos ticket expired (run kinit to obtain a new ticket)\n')
             return 1
@@ -7,6 +7,7 @@
 
 import sys
 import time
+import xmlrpclib
 
 
 __all__ = (
@@ -39,15 +40,22 @@ def watch_tasks(hub, task_id_list, indentation_level=0, sleep_time=30, task_url=
         while True:
             all_done = True
             changed = False
+            if watcher.bulk_supported:
+                # The server waits for one of the tasks to change, so there 
+                # is no need to sleep between calls.
+                changed = watcher.update_many(hub, timeout=sleep_time)
+            if not watcher.bulk_supported:
+                for task in watcher.task_list:
+                    changed |= watcher.update(task)
             for task in watcher.task_list:
-                changed |= watcher.update(task)
                 is_failed |= watcher.is_failed(task)
                 all_done &= watcher.is_finished(task)
             if changed:
                 display_tasklist_status(watcher.task_list)
             if all_done:
                 break
-            time.sleep(sleep_time)
+            if not watcher.bulk_supported:
+                time.sleep(sleep_time)
     except KeyboardInterrupt:
         running_task_list = [ t.task_id for t in watcher.task_list if not watcher.is_finished(t) ]
         if running_task_list:
@@ -60,9 +68,14 @@ class TaskWatcher(object):
 
     display_tasklist_status = staticmethod(display_tasklist_status)
 
+    #: Set to False if the server does not have taskactions.task_info_many,
+    #: in which case each task is polled separately.
+    bulk_supported = True
+
     def __init__(self):
         self.subtask_dict = {}
         self.task_list = []
+        self.version = None
 
     def is_finished(self, task):
         """Is the task finished?"""
@@ -84,13 +97,38 @@ def is_failed(self, task):
             result |= subtask.is_failed()
         return result
 
-    def update(self, task):
+    def update_many(self, hub, timeout=0):
+        """
+        Update all unfinished tasks with one call to the server, which waits
+        up to timeout seconds for any of them to change. Returns True on state
+        change.
+        """
+        task_list = [task for task in self.task_list if not self.is_finished(task)]
+        try:
+            result = hub.taskactions.task_info_many(
+                    [task.task_id for task in task_list], self.version, timeout)
+        except xmlrpclib.Fault as fault:
+            if 'not implemented by this server' not in fault.faultString:
+                raise
+            self.bulk_supported = False
+            return False
+        self.version = result['version']
+        changed = False
+        for task in task_list:
+            task_info = result['tasks'].get(task.task_id)
+            if task_info is not None:
+                changed |= self.update(task, task_info)
+        return changed
+
+    def update(self, task, task_info=None):
         """Update info and log if needed. Returns True on state change."""
         if self.is_finished(task):
             return False
 
         last = task.task_info
-        task.task_info = task.hub.taskactions.task_info(task.task_id, False)
+        if task_info is None:
+            task_info = task.hub.taskactions.task_info(task.task_id, False)
+        task.task_info = task_info
 
         if task.task_info is None:
             print "No such task id: %s" % task.task_id
@@ -0,0 +1,61 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import sys
+import unittest2 as unittest
+from bkr.client.main import BeakerCommandContainer
+
+class CommandContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Start each test from an empty registry, with none of the command 
+        # modules imported, regardless of what other tests have done.
+        self.saved_plugins = BeakerCommandContainer.__dict__.get('_class_plugins')
+        self.saved_all_registered = BeakerCommandContainer._all_registered
+        self.saved_modules = dict((name, module) for name, module
+                in sys.modules.items()
+                if name.startswith('bkr.client.commands.cmd_'))
+        for name in self.saved_modules:
+            del sys.modules[name]
+        BeakerCommandContainer._class_plugins = {}
+        BeakerCommandContainer._all_registered = False
+
+    def tearDown(self):
+        for name in list(sys.modules):
+            if name.startswith('bkr.client.commands.cmd_'):
+                del sys.modules[name]
+        sys.modules.update(self.saved_modules)
+        if self.saved_plugins is None:
+            del BeakerCommandContainer._class_plugins
+        else:
+            BeakerCommandContainer._class_plugins = self.saved_plugins
+        BeakerCommandContainer._all_registered = self.saved_all_registered
+
+    def test_builtin_command_modules(self):
+        modules = BeakerCommandContainer.builtin_command_modules()
+        self.assertEquals(modules['job-watch'], 'cmd_job_watch')
+        self.assertEquals(modules['labcontroller-list'], 'cmd_labcontroller_list')
+        self.assertNotIn('help', modules)
+
+    def test_command_lookup_imports_only_that_command(self):
+        container = BeakerCommandContainer(conf={})
+        command = container['job-results']
+        self.assertEquals(command.__module__,
+                'bkr.client.commands.cmd_job_results')
+        self.assertFalse(BeakerCommandContainer._all_registered)
+        self.assertNotIn('bkr.client.commands.cmd_system_list', sys.modules)
+
+    def test_contains(self):
+        container = BeakerCommandContainer(conf={})
+        self.assertIn('whoami', container)
+        self.assertIn('help', container)
+        self.assertNotIn('notexist', container)
+
+    def test_all_commands_are_listed(self):
+        container = BeakerCommandContainer(conf={})
+        names = list(container)
+        for name in BeakerCommandContainer.builtin_command_modules():
+            self.assertIn(name, names)
+        self.assertIn('help', names)
@@ -0,0 +1,50 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Benchmarks for performance-sensitive parts of Beaker.
+
+These are written as test cases so that they can reuse the integration test 
+fixtures, but they are slow and only measure things, so they are skipped 
+unless BEAKER_BENCHMARKS is set in the environment. Run them with:
+
+    env BEAKER_BENCHMARKS=1 ./run-tests.sh -v bkr.inttest.benchmarks
+
+Results are written to stderr as a simple table.
+"""
+
+import os
+import sys
+import time
+from unittest2 import SkipTest
+
+def setup_package():
+    if not os.environ.get('BEAKER_BENCHMARKS'):
+        raise SkipTest('BEAKER_BENCHMARKS is not set')
+
+class Timer(object):
+    """
+    Context manager which records the elapsed wall clock time in seconds.
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.elapsed = time.time() - self.start
+
+def report(title, columns, rows):
+    """
+    Writes a table of benchmark results to stderr.
+    """
+    widths = [max(len(str(column)), *[len(str(row[i])) for row in rows])
+            for i, column in enumerate(columns)]
+    sys.stderr.write('\n%s\n' % title)
+    sys.stderr.write('  '.join(str(column).rjust(width)
+            for column, width in zip(columns, widths)) + '\n')
+    for row in rows:
+        sys.stderr.write('  '.join(str(value).rjust(width)
+                for value, width in zip(row, widths)) + '\n')
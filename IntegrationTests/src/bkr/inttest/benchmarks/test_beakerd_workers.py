@@ -0,0 +1,69 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from turbogears import config
+from turbogears.database import session
+from bkr.server.model import Job, TaskStatus
+from bkr.server.tools import beakerd
+from bkr.server.tests import data_setup
+from bkr.inttest import DatabaseTestCase
+from bkr.inttest.mail_capture import MailCaptureThread
+from bkr.inttest.benchmarks import Timer, report
+
+class BeakerdWorkersBenchmark(DatabaseTestCase):
+
+    num_jobs = 200
+    worker_counts = [1, 2, 4, 8]
+
+    def setUp(self):
+        self.mail_capture = MailCaptureThread()
+        self.mail_capture.start()
+        self.addCleanup(self.mail_capture.stop)
+        with session.begin():
+            self.lab_controller = data_setup.create_labcontroller()
+            self.distro_tree = data_setup.create_distro_tree(
+                    lab_controllers=[self.lab_controller])
+            for _ in range(20):
+                data_setup.create_system(lab_controller=self.lab_controller,
+                        shared=True)
+        self.addCleanup(self._reset_workers)
+
+    def _reset_workers(self):
+        for executor in beakerd._worker_executors or []:
+            executor.shutdown()
+        beakerd._worker_executors = None
+        config.update({'beaker.scheduler_workers': 1})
+
+    def _create_new_jobs(self):
+        with session.begin():
+            jobs = [data_setup.create_job(distro_tree=self.distro_tree)
+                    for _ in range(self.num_jobs)]
+        return [job.id for job in jobs]
+
+    def test_process_new_recipes_throughput(self):
+        rows = []
+        for num_workers in self.worker_counts:
+            self._reset_workers()
+            config.update({'beaker.scheduler_workers': num_workers})
+            job_ids = self._create_new_jobs()
+            with Timer() as process_timer:
+                beakerd.process_new_recipes()
+            beakerd.update_dirty_jobs()
+            with Timer() as queue_timer:
+                beakerd.queue_processed_recipesets()
+            beakerd.update_dirty_jobs()
+            with session.begin():
+                for job_id in job_ids:
+                    self.assertEquals(Job.by_id(job_id).status, TaskStatus.queued)
+                    Job.by_id(job_id).cancel()
+            beakerd.update_dirty_jobs()
+            rows.append((num_workers,
+                    '%.2f' % process_timer.elapsed,
+                    '%.1f' % (self.num_jobs / process_timer.elapsed),
+                    '%.2f' % queue_timer.elapsed,
+                    '%.1f' % (self.num_jobs / queue_timer.elapsed)))
+        report('beakerd throughput for %s single-recipe jobs' % self.num_jobs,
+                ['workers', 'process (s)', 'recipes/s', 'queue (s)', 'recipe sets/s'],
+                rows)
@@ -0,0 +1,31 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import unittest2 as unittest
+from bkr.inttest.client import run_client
+from bkr.inttest.benchmarks import Timer, report
+
+class ClientStartupBenchmark(unittest.TestCase):
+
+    runs = 20
+    commands = [
+        ['bkr', '--help'],
+        ['bkr', 'job-watch', '--help'],
+        ['bkr', 'job-results', '--help'],
+        ['bkr', 'job-submit', '--help'],
+        ['bkr', 'whoami'],
+    ]
+
+    def test_startup_time(self):
+        rows = []
+        for args in self.commands:
+            run_client(args) # warm up the page cache
+            with Timer() as timer:
+                for _ in range(self.runs):
+                    run_client(args)
+            rows.append((' '.join(args),
+                    '%.1f' % (timer.elapsed * 1000 / self.runs)))
+        report('bkr client startup, mean of %d runs' % self.runs,
+                ['command', 'time (ms)'], rows)
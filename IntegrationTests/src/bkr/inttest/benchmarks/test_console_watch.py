@@ -0,0 +1,118 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os, os.path
+import random
+import shutil
+import tempfile
+import unittest2 as unittest
+from bkr.labcontroller.inotify import Inotify, IN_MODIFY, IN_CREATE
+from bkr.labcontroller.log_storage import LogStorage
+from bkr.labcontroller.proxy import ConsoleWatchFile
+from bkr.inttest.benchmarks import Timer, report
+
+class FakeHub(object):
+    # stands in for the server's recipes.register_file
+    class recipes(object):
+        @staticmethod
+        def register_file(*args):
+            pass
+
+class FakeMonitor(object):
+
+    def __init__(self, log_storage):
+        self.log_storage = log_storage
+
+    def report_panic(self, watchdog, panic_message):
+        pass
+
+    def report_install_failure(self, watchdog, failure_message):
+        pass
+
+def poll_update(watch):
+    # What ConsoleWatchFile.update() used to do: re-open the log every time,
+    # and read at most one block.
+    try:
+        f = open(watch.log, 'r')
+    except IOError:
+        return False
+    try:
+        f.seek(watch.where)
+        block = f.read(watch.blocksize)
+        now = f.tell()
+    finally:
+        f.close()
+    if not block:
+        return False
+    watch.process_log(block)
+    watch.where = now
+    return True
+
+class ConsoleWatchBenchmark(unittest.TestCase):
+
+    num_consoles = 2000
+    passes = 20
+    #: fraction of consoles written to between passes
+    active_fraction = 0.05
+
+    def setUp(self):
+        self.console_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.console_dir)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.monitor = FakeMonitor(LogStorage(self.cache_dir,
+                'http://localhost/logs/', FakeHub()))
+        self.fqdns = ['system%d.example.invalid' % i
+                for i in range(self.num_consoles)]
+        for fqdn in self.fqdns:
+            with open(os.path.join(self.console_dir, fqdn), 'w') as f:
+                f.write('Booting...\n')
+
+    def _watches(self):
+        return [ConsoleWatchFile(os.path.join(self.console_dir, fqdn),
+                    {'recipe_id': i, 'system': fqdn}, self.monitor, 'Kernel panic')
+                for i, fqdn in enumerate(self.fqdns)]
+
+    def _write_consoles(self, rng):
+        written = rng.sample(self.fqdns, int(self.num_consoles * self.active_fraction))
+        for fqdn in written:
+            with open(os.path.join(self.console_dir, fqdn), 'a') as f:
+                f.write('x' * 200 + '\n')
+        return written
+
+    def test_console_watch(self):
+        watches = self._watches()
+        rng = random.Random(0)
+        with Timer() as poll_timer:
+            for _ in range(self.passes):
+                self._write_consoles(rng)
+                while any([poll_update(watch) for watch in watches]):
+                    pass
+
+        watches = self._watches()
+        by_name = dict((os.path.basename(watch.log), watch) for watch in watches)
+        notifier = Inotify()
+        self.addCleanup(notifier.close)
+        notifier.add_watch(self.console_dir, IN_MODIFY | IN_CREATE)
+        for watch in watches:
+            watch.update()
+        rng = random.Random(0)
+        with Timer() as inotify_timer:
+            for _ in range(self.passes):
+                self._write_consoles(rng)
+                changed = set(name for wd, mask, name in notifier.read_events())
+                pending = [by_name[name] for name in changed]
+                while pending:
+                    pending = [watch for watch in pending if watch.update()]
+        for watch in watches:
+            watch.close()
+
+        report('console log watching, %d consoles, %d%% written per pass'
+                    % (self.num_consoles, self.active_fraction * 100),
+                ['method', 'total (s)', 'per pass (ms)'],
+                [('open/read/close every log', '%.2f' % poll_timer.elapsed,
+                    '%.1f' % (poll_timer.elapsed * 1000 / self.passes)),
+                 ('inotify, logs kept open', '%.2f' % inotify_timer.elapsed,
+                    '%.1f' % (inotify_timer.elapsed * 1000 / self.passes))])
@@ -0,0 +1,63 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import lxml.etree
+from turbogears.database import session
+from bkr.server.model import System
+from bkr.server.needpropertyxml import XmlHost, filter_cache
+from bkr.inttest import DatabaseTestCase
+from bkr.inttest.benchmarks import Timer, report
+
+host_requires = '''
+    <hostRequires>
+        <and>
+            <system_type op="=" value="Machine"/>
+            <memory op="&gt;=" value="%d"/>
+            <cpu><cores op="&gt;=" value="4"/></cpu>
+            <system><owner op="!=" value="nobody"/></system>
+            <or>
+                <hostname op="like" value="%%.lab.example.com"/>
+                <hostname op="like" value="%%.lab2.example.com"/>
+            </or>
+            <disk><size op="&gt;=" value="100" units="GB"/></disk>
+        </and>
+    </hostRequires>'''
+
+class FilterCacheBenchmark(DatabaseTestCase):
+
+    num_recipes = 1000
+    distinct_counts = [1, 10, 100]
+
+    def setUp(self):
+        session.begin()
+        self.addCleanup(session.rollback)
+        filter_cache.clear()
+
+    def _build_uncached(self, xmls):
+        for xml in xmls:
+            XmlHost(lxml.etree.fromstring(xml)).filter(System.query)
+
+    def _build_cached(self, xmls):
+        for xml in xmls:
+            XmlHost.from_string(xml).apply_filter(System.query)
+
+    def test_clause_build_time(self):
+        rows = []
+        for distinct in self.distinct_counts:
+            xmls = [host_requires % (1024 * (i % distinct))
+                    for i in range(self.num_recipes)]
+            with Timer() as uncached:
+                self._build_uncached(xmls)
+            filter_cache.clear()
+            with Timer() as cached:
+                self._build_cached(xmls)
+            rows.append((distinct,
+                    '%.3f' % (uncached.elapsed * 1000 / self.num_recipes),
+                    '%.3f' % (cached.elapsed * 1000 / self.num_recipes),
+                    '%.1f' % (uncached.elapsed / cached.elapsed)))
+        report('hostRequires clause build time, %d recipes' % self.num_recipes,
+                ['distinct filters', 'uncached (ms/recipe)',
+                    'cached (ms/recipe)', 'speedup'],
+                rows)
@@ -0,0 +1,110 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import lxml.etree
+from sqlalchemy import event
+from turbogears.database import session, get_engine
+from bkr.server.jobs import Jobs, JobSubmissionLookups
+from bkr.server.tests import data_setup
+from bkr.inttest import DatabaseTestCase
+from bkr.inttest.benchmarks import Timer, report
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(get_engine(), 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        event.remove(get_engine(), 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+class JobSubmissionBenchmark(DatabaseTestCase):
+
+    recipe_counts = [10, 50, 100, 200]
+    tasks_per_recipe = 15
+    num_tasks = 100
+    num_jobs = 20
+
+    def setUp(self):
+        with session.begin():
+            self.user = data_setup.create_user()
+            lab_controller = data_setup.create_labcontroller()
+            self.distro_tree = data_setup.create_distro_tree(
+                    lab_controllers=[lab_controller])
+            self.task_names = [data_setup.create_task().name
+                    for _ in range(self.num_tasks)]
+        self.controller = Jobs()
+
+    def _job_xml(self, num_recipes):
+        recipes = []
+        for i in range(num_recipes):
+            tasks = ''.join('<task name="%s"/>' % self.task_names[
+                        (i + j) % self.num_tasks]
+                    for j in range(self.tasks_per_recipe))
+            recipes.append('''
+                <recipe>
+                    <distroRequires>
+                        <distro_name op="=" value="%s"/>
+                        <distro_arch op="=" value="%s"/>
+                    </distroRequires>
+                    <hostRequires><hostname op="like" value="%%.example.com"/></hostRequires>
+                    <packages><package name="benchmark-package-%d"/></packages>
+                    %s
+                </recipe>''' % (self.distro_tree.distro.name,
+                        self.distro_tree.arch.arch, i % 10, tasks))
+        return '<job><whiteboard>benchmark</whiteboard><recipeSet>%s</recipeSet></job>' \
+                % ''.join(recipes)
+
+    def _submit(self, xmljobs, lookups=None):
+        # The jobs are rolled back afterwards, so that each run starts out
+        # with the same database
+        session.begin()
+        try:
+            user = session.merge(self.user)
+            with QueryCounter() as counter:
+                with Timer() as timer:
+                    if lookups is not None:
+                        lookups.prefetch(xmljobs)
+                    for xmljob in xmljobs:
+                        self.controller.process_xmljob(xmljob, user,
+                                lookups=lookups)
+                    session.flush()
+        finally:
+            session.rollback()
+        return timer, counter
+
+    def test_submission_time_by_recipe_count(self):
+        rows = []
+        for num_recipes in self.recipe_counts:
+            xmljob = lxml.etree.fromstring(self._job_xml(num_recipes))
+            timer, counter = self._submit([xmljob])
+            rows.append((num_recipes, num_recipes * self.tasks_per_recipe,
+                    '%.2f' % timer.elapsed, counter.count,
+                    '%.1f' % (num_recipes / timer.elapsed)))
+        report('jobs.upload, one job, %d tasks per recipe'
+                    % self.tasks_per_recipe,
+                ['recipes', 'tasks', 'submit (s)', 'queries', 'recipes/s'],
+                rows)
+
+    def test_upload_many(self):
+        num_recipes = 10
+        xmljobs = [lxml.etree.fromstring(self._job_xml(num_recipes))
+                for _ in range(self.num_jobs)]
+        separate_timer, separate_counter = self._submit(xmljobs)
+        together_timer, together_counter = self._submit(xmljobs,
+                lookups=JobSubmissionLookups())
+        report('%d jobs of %d recipes, %d tasks per recipe'
+                    % (self.num_jobs, num_recipes, self.tasks_per_recipe),
+                ['submission', 'submit (s)', 'queries'],
+                [('jobs.upload for each job', '%.2f' % separate_timer.elapsed,
+                    separate_counter.count),
+                 ('jobs.upload_many', '%.2f' % together_timer.elapsed,
+                    together_counter.count)])
@@ -0,0 +1,103 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os, os.path
+import random
+import shutil
+import tempfile
+import unittest2 as unittest
+from bkr.labcontroller.log_storage import LogFile, compress_log, \
+        COMPRESSED_SUFFIX
+from bkr.inttest.benchmarks import Timer, report
+
+messages = [
+    'kernel: usb 1-1: new high-speed USB device number %d using ehci-pci',
+    'kernel: EXT4-fs (dm-%d): mounted filesystem with ordered data mode',
+    'systemd[1]: Started Session %d of user root.',
+    'rhts-test-runner: Running test /distribution/install (%d)',
+    ':: [   PASS   ] :: Command \'rpm -q kernel\' (Expected 0, got %d)',
+]
+
+def fake_console_log(rng, size):
+    lines = []
+    length = 0
+    timestamp = 0.0
+    while length < size:
+        timestamp += rng.expovariate(10)
+        line = '[%12.6f] %s\n' % (timestamp,
+                rng.choice(messages) % rng.randint(0, 1000))
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+class LogCompressionBenchmark(unittest.TestCase):
+
+    num_logs = 20
+    log_size = 5 * 1024 * 1024
+    range_reads = 2000
+    range_size = 4096
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        rng = random.Random(0)
+        self.log_files = []
+        for i in range(self.num_logs):
+            log_file = LogFile(os.path.join(self.base_dir, 'console-%d.log' % i),
+                    lambda: None)
+            with log_file:
+                log_file.update_chunk(fake_console_log(rng, self.log_size), 0)
+            self.log_files.append(log_file)
+
+    def _disk_usage(self):
+        total = 0
+        for log_file in self.log_files:
+            for path in [log_file.path, log_file.path + COMPRESSED_SUFFIX]:
+                if os.path.exists(path):
+                    total += os.stat(path).st_blocks * 512
+        return total
+
+    def _read_all(self):
+        with Timer() as timer:
+            for log_file in self.log_files:
+                f = log_file.open_ro()
+                while f.read(65536):
+                    pass
+                f.close()
+        return timer
+
+    def _read_ranges(self):
+        rng = random.Random(0)
+        with Timer() as timer:
+            for _ in range(self.range_reads):
+                f = self.log_files[rng.randrange(self.num_logs)].open_ro()
+                f.seek(rng.randrange(self.log_size - self.range_size))
+                data = f.read(self.range_size)
+                f.close()
+                self.assertEquals(len(data), self.range_size)
+        return timer
+
+    def test_log_compression(self):
+        plain_usage = self._disk_usage()
+        plain_read = self._read_all()
+        plain_ranges = self._read_ranges()
+        with Timer() as compress_timer:
+            for log_file in self.log_files:
+                self.assert_(compress_log(log_file.path))
+        compressed_usage = self._disk_usage()
+        compressed_read = self._read_all()
+        compressed_ranges = self._read_ranges()
+        report('job logs compressed at rest, %d logs of %d MB, %d random %d byte reads'
+                    % (self.num_logs, self.log_size // (1024 * 1024),
+                       self.range_reads, self.range_size),
+                ['storage', 'disk usage (MB)', 'full read (s)',
+                 'range read (ms)', 'compress (s)'],
+                [('plain', '%.1f' % (plain_usage / 1048576.0),
+                    '%.2f' % plain_read.elapsed,
+                    '%.3f' % (plain_ranges.elapsed * 1000 / self.range_reads), '-'),
+                 ('compressed', '%.1f' % (compressed_usage / 1048576.0),
+                    '%.2f' % compressed_read.elapsed,
+                    '%.3f' % (compressed_ranges.elapsed * 1000 / self.range_reads),
+                    '%.2f' % compress_timer.elapsed)])
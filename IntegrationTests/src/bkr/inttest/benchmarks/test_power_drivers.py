@@ -0,0 +1,134 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os, os.path
+import sys
+import shutil
+import tempfile
+import unittest2 as unittest
+import gevent, gevent.server, gevent.socket
+from bkr.labcontroller.power import ScriptPowerDriver, SessionPowerDriver, \
+        PowerLimiter
+from bkr.inttest.benchmarks import Timer, report
+
+class FakeBMC(gevent.server.StreamServer):
+    """
+    Pretends to be the power controllers for a lab. Setting up a session is
+    slow, like the authentication handshake of a real BMC, but commands on an
+    established session are fast.
+    """
+
+    session_setup_time = 0.2
+    command_time = 0.01
+
+    def __init__(self):
+        super(FakeBMC, self).__init__(('127.0.0.1', 0))
+        self.sessions_opened = 0
+        self.commands_run = 0
+
+    def handle(self, sock, address):
+        self.sessions_opened += 1
+        gevent.sleep(self.session_setup_time)
+        f = sock.makefile()
+        f.write('ready\n')
+        f.flush()
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            gevent.sleep(self.command_time)
+            self.commands_run += 1
+            f.write('ok\n')
+            f.flush()
+        sock.close()
+
+# Does what most power scripts do: open a new session for every command.
+power_script = '''#!%s
+import os, socket
+s = socket.create_connection(('127.0.0.1', %d))
+f = s.makefile()
+assert f.readline() == 'ready\\n'
+f.write(os.environ['power_mode'] + '\\n')
+f.flush()
+assert f.readline() == 'ok\\n'
+'''
+
+class FakeBMCPowerDriver(SessionPowerDriver):
+
+    name = 'fake-bmc'
+
+    def __init__(self, port):
+        super(FakeBMCPowerDriver, self).__init__()
+        self.port = port
+
+    def session_key(self, power):
+        return power['address']
+
+    def connect(self, power):
+        sock = gevent.socket.create_connection(('127.0.0.1', self.port))
+        f = sock.makefile()
+        assert f.readline() == 'ready\n'
+        return f
+
+    def run(self, session, action, power):
+        session.write(action + '\n')
+        session.flush()
+        if session.readline() != 'ok\n':
+            raise RuntimeError('Power command failed')
+
+    def disconnect(self, session):
+        session.close()
+
+class PowerDriverBenchmark(unittest.TestCase):
+
+    num_systems = 50
+    #: reboots of each system, each of which is an off and an on command
+    reboots = 4
+
+    def setUp(self):
+        self.bmc = FakeBMC()
+        self.bmc.start()
+        self.addCleanup(self.bmc.stop)
+        self.script_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.script_dir)
+        self.script = os.path.join(self.script_dir, 'fake-bmc')
+        with open(self.script, 'w') as f:
+            f.write(power_script % (sys.executable, self.bmc.server_port))
+        os.chmod(self.script, 0755)
+
+    def _run_commands(self, driver):
+        limiter = PowerLimiter(max_total=50, max_per_address=1)
+        def reboot_system(i):
+            power = {'type': u'fake-bmc', 'address': u'bmc%d.example.invalid' % i,
+                    'id': u'', 'user': u'admin', 'passwd': u'password'}
+            for j in range(self.reboots):
+                for action in [u'off', u'on']:
+                    command = {'id': i * 100 + j, 'action': action, 'power': power}
+                    with limiter.limit(power['address']):
+                        driver.attempt(command)
+        sessions_before = self.bmc.sessions_opened
+        with Timer() as timer:
+            gevent.joinall([gevent.spawn(reboot_system, i)
+                    for i in range(self.num_systems)], raise_error=True)
+        driver.close()
+        return timer, self.bmc.sessions_opened - sessions_before
+
+    def test_power_drivers(self):
+        script_timer, script_sessions = self._run_commands(
+                ScriptPowerDriver(self.script))
+        session_timer, session_sessions = self._run_commands(
+                FakeBMCPowerDriver(self.bmc.server_port))
+        num_commands = self.num_systems * self.reboots * 2
+        self.assertEquals(self.bmc.commands_run, num_commands * 2)
+        report('power commands, %d systems, %d commands each'
+                    % (self.num_systems, self.reboots * 2),
+                ['driver', 'total (s)', 'per command (ms)', 'BMC sessions'],
+                [('power script per command', '%.2f' % script_timer.elapsed,
+                    '%.1f' % (script_timer.elapsed * 1000 / num_commands),
+                    script_sessions),
+                 ('in-process, sessions reused', '%.2f' % session_timer.elapsed,
+                    '%.1f' % (session_timer.elapsed * 1000 / num_commands),
+                    session_sessions)])
+        self.assertEquals(session_sessions, self.num_systems)
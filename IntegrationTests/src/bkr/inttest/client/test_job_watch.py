@@ -68,6 +68,34 @@ def test_watch_recipetask(self):
                 '--> Completed: 1 [total: 1]\n'
                 % (recipetask.t_id, recipetask.recipe.resource.fqdn))
 
+    def test_watch_multiple_jobs(self):
+        with session.begin():
+            first = data_setup.create_job(whiteboard=u'first')
+            second = data_setup.create_job(whiteboard=u'second')
+        p = start_client(['bkr', 'job-watch', first.t_id, second.t_id])
+        self.assertEquals(p.stdout.readline(),
+                'Watching tasks (this may be safely interrupted)...\n')
+        self.assertEquals(set([p.stdout.readline(), p.stdout.readline()]),
+                set(['%s first: New\n' % first.t_id,
+                     '%s second: New\n' % second.t_id]))
+        self.assertEquals(p.stdout.readline(), '--> New: 2 [total: 2]\n')
+        with session.begin():
+            data_setup.mark_job_complete(first)
+        start = time.time()
+        self.assertEquals(p.stdout.readline(),
+                '%s first: New -> Completed\n' % first.t_id)
+        # reported well before the 30 second polling interval
+        self.assertLess(time.time() - start, 20)
+        self.assertEquals(p.stdout.readline(),
+                '--> Completed: 1 New: 1 [total: 2]\n')
+        with session.begin():
+            data_setup.mark_job_complete(second)
+        out, err = p.communicate()
+        self.assertEquals(p.returncode, 0, err)
+        self.assertEquals(out,
+                '%s second: New -> Completed\n'
+                '--> Completed: 2 [total: 2]\n' % second.t_id)
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=595512
     def test_invalid_taskspec(self):
         try:
@@ -16,12 +16,14 @@
 import urlparse
 import requests
 import time
+import threading
 from nose.plugins.skip import SkipTest
 from bkr.common.helpers import total_seconds
 from bkr.server.model import session, TaskResult, TaskStatus, LogRecipe, \
         LogRecipeTask, LogRecipeTaskResult, RecipeTask, RecipeTaskResult
 from bkr.labcontroller.proxy import ProxyHelper
 from bkr.labcontroller.config import get_conf
+from bkr.labcontroller.log_storage import compress_log
 from bkr.inttest import data_setup
 from bkr.inttest.assertions import assert_datetime_within
 from bkr.inttest.labcontroller import LabControllerTestCase, processes, \
@@ -269,6 +271,32 @@ def test_max_results_per_recipe_limit_is_enforced(self):
             self.assertEqual(self.recipe.tasks[0].results[-1].log,
                     u'Too many results in recipe')
 
+    def test_concurrent_results(self):
+        # The proxy sends these to the server in bulk, but each caller should 
+        # still get back the id of its own result.
+        results_url = '%srecipes/%s/tasks/%s/results/' % (self.get_proxy_url(),
+                self.recipe.id, self.recipe.tasks[0].id)
+        responses = {}
+        def post_result(i):
+            responses[i] = requests.post(results_url,
+                    data=dict(result='Pass', path='/concurrent/%d' % i),
+                    allow_redirects=False)
+        threads = [threading.Thread(target=post_result, args=(i,))
+                for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with session.begin():
+            session.expire_all()
+            results = dict((result.id, result.path)
+                    for result in self.recipe.tasks[0].results)
+        self.assertEquals(len(results), 20)
+        for i, response in responses.iteritems():
+            self.assertEquals(response.status_code, 201)
+            result_id = int(posixpath.basename(response.headers['Location']))
+            self.assertEquals(results[result_id], u'/concurrent/%d' % i)
+
 class TaskStatusTest(LabControllerTestCase):
 
     def setUp(self):
@@ -995,6 +1023,32 @@ def test_GET_nonexistent_log(self):
         response = requests.get(log_url)
         self.assertEquals(response.status_code, 404)
 
+    def test_GET_compressed_log(self):
+        upload_url = '%srecipes/%s/logs/compressed-log' % (self.get_proxy_url(),
+                self.recipe.id)
+        local_log_dir = '%s/recipes/%s+/%s/' % (get_conf().get('CACHEPATH'),
+                self.recipe.id // 1000, self.recipe.id)
+        contents = ''.join('line %d\n' % i for i in range(100000))
+        response = requests.put(upload_url, data=contents)
+        self.assertEquals(response.status_code, 204)
+        self.assert_(compress_log(os.path.join(local_log_dir, 'compressed-log')))
+        response = requests.get(upload_url)
+        response.raise_for_status()
+        self.assertEquals(response.content, contents)
+        response = requests.get(upload_url, headers={'Range': 'bytes=100000-100099'})
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response.headers['Content-Range'],
+                'bytes 100000-100099/%d' % len(contents))
+        self.assertEquals(response.content, contents[100000:100100])
+        # writing to it again restores the uncompressed log
+        response = requests.put(upload_url, data='more\n',
+                headers={'Content-Range': 'bytes %d-%d/%d' % (len(contents),
+                    len(contents) + 4, len(contents) + 5)})
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(
+                open(os.path.join(local_log_dir, 'compressed-log'), 'r').read(),
+                contents + 'more\n')
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=961300
     def test_PUT_empty_log(self):
         upload_url = '%srecipes/%s/logs/empty-log' % (self.get_proxy_url(),
@@ -0,0 +1,96 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import threading
+import requests
+from nose.plugins.skip import SkipTest
+from bkr.server.model import session
+from bkr.inttest import data_setup
+from bkr.inttest.labcontroller import LabControllerTestCase, processes, \
+        daemons_running_externally
+from bkr.inttest.benchmarks import Timer, report
+
+class RepeatedData(object):
+    """
+    File-like object producing *size* bytes, without holding them in memory.
+    requests sends it with a Content-Length header because it has a len.
+    """
+
+    def __init__(self, size):
+        self.len = size
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        n = min(n, 65536)
+        self.remaining -= n
+        return 'x' * n
+
+def proxy_rss_kb():
+    proxy, = [p for p in processes if p.name == 'beaker-proxy']
+    with open('/proc/%d/status' % proxy.popen.pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+class ProxyLogUploadLoadTest(LabControllerTestCase):
+    """
+    Uploads many large logs to beaker-proxy at once, and reports its memory
+    usage and throughput. Like the benchmarks in bkr.inttest.benchmarks, this
+    only runs if BEAKER_BENCHMARKS is set.
+    """
+
+    concurrent_uploads = 16
+    upload_size = 256 * 1024 * 1024
+
+    def setUp(self):
+        if not os.environ.get('BEAKER_BENCHMARKS'):
+            raise SkipTest('BEAKER_BENCHMARKS is not set')
+        if daemons_running_externally():
+            raise SkipTest('cannot measure memory of remote beaker-proxy')
+        with session.begin():
+            self.recipe = data_setup.create_recipe()
+            self.job = data_setup.create_job_for_recipes([self.recipe])
+            data_setup.mark_recipe_running(self.recipe)
+        self.addCleanup(self.cleanup_job, self.job)
+
+    def test_concurrent_large_PUT_uploads(self):
+        peak_rss = [proxy_rss_kb()]
+        baseline_rss = peak_rss[0]
+        finished = threading.Event()
+        def sample_rss():
+            while not finished.wait(0.1):
+                peak_rss[0] = max(peak_rss[0], proxy_rss_kb())
+        sampler = threading.Thread(target=sample_rss)
+        sampler.start()
+        responses = []
+        def upload(i):
+            url = '%srecipes/%s/logs/load-test-%d.log' % (self.get_proxy_url(),
+                    self.recipe.id, i)
+            responses.append(requests.put(url, data=RepeatedData(self.upload_size)))
+        threads = [threading.Thread(target=upload, args=(i,))
+                for i in range(self.concurrent_uploads)]
+        try:
+            with Timer() as timer:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            finished.set()
+            sampler.join()
+        for response in responses:
+            self.assertEquals(response.status_code, 204)
+        total_mb = self.concurrent_uploads * self.upload_size / (1024.0 * 1024.0)
+        report('beaker-proxy log uploads, %d concurrent PUTs of %d MB'
+                    % (self.concurrent_uploads, self.upload_size // (1024 * 1024)),
+                ['total (s)', 'MB/s', 'baseline RSS (MB)', 'peak RSS (MB)'],
+                [('%.2f' % timer.elapsed, '%.1f' % (total_mb / timer.elapsed),
+                  '%.1f' % (baseline_rss / 1024.0), '%.1f' % (peak_rss[0] / 1024.0))])
+        # Each upload is streamed to disk, so memory usage should not
+        # depend on the size of the uploads.
+        self.assertLess(peak_rss[0] - baseline_rss, 64 * 1024)
@@ -240,6 +240,22 @@ def test_stores_virt_console_logs(self, test_get_console_log):
         self.assert_(self.check_console_log_registered())
         self.assert_(self.check_cached_log_contents('foo'))
 
+    @patch.object(ProxyHelper, 'get_console_log')
+    def test_virt_console_fetched_once_per_sleep_time(self, test_get_console_log):
+        test_get_console_log.return_value = 'foo'
+        active_watchdogs = self.watchdog.hub.recipes.tasks.watchdogs('active')
+        self.watchdog.active_watchdogs(active_watchdogs)
+        self.watchdog.run()
+        self.assertEquals(test_get_console_log.call_count, 1)
+        # Woken up early, for example by a write to some other console log.
+        self.watchdog.run()
+        self.assertEquals(test_get_console_log.call_count, 1)
+        # Once SLEEP_TIME has passed the virt console is fetched again.
+        for monitor in self.watchdog.watchdogs.values():
+            monitor.last_run -= self.watchdog.conf.get('SLEEP_TIME', 20)
+        self.watchdog.run()
+        self.assertEquals(test_get_console_log.call_count, 2)
+
 # These cases are really unit tests but they are here because I don't want to 
 # ship all these failure logs in the beaker-lab-controller package.
 
@@ -247,6 +263,7 @@ def test_anaconda_failure_samples():
     for filename in pkg_resources.resource_listdir('bkr.inttest.labcontroller',
             'install-failure-logs'):
         yield check_anaconda_failure_sample, filename
+        yield check_anaconda_failure_sample_prefilter, filename
 
 def check_anaconda_failure_sample(filename):
     log = pkg_resources.resource_string('bkr.inttest.labcontroller',
@@ -258,6 +275,19 @@ def check_anaconda_failure_sample(filename):
             return
     raise AssertionError('No failure found')
 
+def check_anaconda_failure_sample_prefilter(filename):
+    # The combined pattern must not skip past the line with the failure
+    log = pkg_resources.resource_string('bkr.inttest.labcontroller',
+            'install-failure-logs/' + filename)
+    lines = log.splitlines()
+    detector = InstallFailureDetector()
+    first = detector.first_candidate_line('\n'.join(lines))
+    assert first is not None
+    for line in lines[first:]:
+        if detector.feed(line):
+            return
+    raise AssertionError('No failure found')
+
 # https://bugzilla.redhat.com/show_bug.cgi?id=1040794
 def test_unrelated_Oops_string_is_not_detected_as_panic():
     # Sounds implausible, but this really happened...
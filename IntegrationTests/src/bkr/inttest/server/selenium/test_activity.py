@@ -4,11 +4,13 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import requests
 from turbogears.database import session
 from bkr.inttest.server.selenium import WebDriverTestCase
 from bkr.inttest.server.webdriver_utils import login, \
     check_activity_search_results, delete_and_confirm
-from bkr.inttest import data_setup, get_server_base, with_transaction
+from bkr.inttest import data_setup, get_server_base, with_transaction, \
+    DatabaseTestCase
 from bkr.server.model import User, DistroActivity, SystemActivity, \
     GroupActivity, DistroTreeActivity
 
@@ -159,3 +161,13 @@ def test_recipe_activity(self):
             send_keys('field_name:Whiteboard new_value:newwhiteboard')
         b.find_element_by_class_name('grid-filter').submit()
         check_activity_search_results(b, present=[act])
+
+
+class ActivityHTTPTest(DatabaseTestCase):
+
+    def test_exact_count_is_rejected(self):
+        # The activity grids are too big to count every time, so they only 
+        # offer cached counts.
+        response = requests.get(get_server_base() + 'activity/system?count=exact',
+                headers={'Accept': 'application/json'})
+        self.assertEquals(response.status_code, 400)
@@ -208,6 +208,64 @@ def test_invalid_user(self):
         except xmlrpclib.Fault, e:
             self.assertIn('notexist is not a valid user name', e.faultString)
 
+    def test_upload_many(self):
+        job_xml = '''
+            <job>
+                <whiteboard>%s</whiteboard>
+                <recipeSet>
+                    <recipe>
+                        <distroRequires>
+                            <distro_name op="=" value="BlueShoeLinux5-5" />
+                        </distroRequires>
+                        <hostRequires/>
+                        <packages><package name="upload-many-package"/></packages>
+                        <task name="/distribution/install" />
+                        <task name="/distribution/reservesys" />
+                    </recipe>
+                </recipeSet>
+            </job>
+            '''
+        job_tids = self.server.jobs.upload_many(
+                [job_xml % 'first of many', job_xml % 'second of many'])
+        self.assertEquals(len(job_tids), 2)
+        with session.begin():
+            first = TaskBase.get_by_t_id(job_tids[0])
+            second = TaskBase.get_by_t_id(job_tids[1])
+            self.assertEquals(first.whiteboard, u'first of many')
+            self.assertEquals(second.whiteboard, u'second of many')
+            for job in [first, second]:
+                self.assertEquals(job.owner, self.user)
+                recipe = job.recipesets[0].recipes[0]
+                self.assertEquals([t.task.name for t in recipe.tasks],
+                        [u'/distribution/install', u'/distribution/reservesys'])
+                self.assertEquals([p.package for p in recipe.custom_packages],
+                        [u'upload-many-package'])
+
+    def test_upload_many_queues_nothing_if_any_job_is_invalid(self):
+        job_xml = '''
+            <job>
+                <whiteboard>upload_many all or nothing</whiteboard>
+                <recipeSet>
+                    <recipe>
+                        <distroRequires>
+                            <distro_name op="=" value="BlueShoeLinux5-5" />
+                        </distroRequires>
+                        <hostRequires/>
+                        <task name="%s" />
+                    </recipe>
+                </recipeSet>
+            </job>
+            '''
+        try:
+            self.server.jobs.upload_many([job_xml % '/distribution/install',
+                    job_xml % '/asdf/notexist'])
+            self.fail('should raise')
+        except xmlrpclib.Fault, e:
+            self.assertIn('Invalid task(s): /asdf/notexist', e.faultString)
+        with session.begin():
+            self.assertEquals(Job.query.filter(Job.whiteboard ==
+                    u'upload_many all or nothing').count(), 0)
+
 class JobFilterTest(XmlRpcTestCase):
 
     def setUp(self):
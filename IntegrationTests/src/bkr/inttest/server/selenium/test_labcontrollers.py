@@ -635,6 +635,28 @@ def test_obeys_max_running_commands_limit(self):
         # 10 is the configured limit in server-test.cfg
         self.assertEquals(len(commands), 10, commands)
 
+    def test_get_new_queued_command_details(self):
+        with session.begin():
+            system = data_setup.create_system(lab_controller=self.lc)
+            system.action_power(action=u'on', service=u'testdata')
+            first_command_id = system.command_queue[0].id
+        result = self.server.labcontrollers.get_new_queued_command_details(None)
+        self.assertEquals([c['id'] for c in result['commands']],
+                [first_command_id])
+        self.assertEquals(result['cursor'], first_command_id)
+        # Nothing new, so nothing is returned and the cursor is unchanged.
+        result = self.server.labcontrollers.get_new_queued_command_details(
+                first_command_id)
+        self.assertEquals(result['commands'], [])
+        self.assertEquals(result['cursor'], first_command_id)
+        # Only commands queued after the cursor are returned.
+        with session.begin():
+            system.action_power(action=u'off', service=u'testdata')
+        result = self.server.labcontrollers.get_new_queued_command_details(
+                first_command_id)
+        self.assertEquals([c['action'] for c in result['commands']], [u'off'])
+        self.assertEquals(result['cursor'], result['commands'][0]['id'])
+
     def test_clear_running_commands(self):
         with session.begin():
             system = data_setup.create_system(lab_controller=self.lc)
@@ -5,6 +5,7 @@
 # (at your option) any later version.
 
 import datetime
+import xmlrpclib
 from turbogears.database import session
 from bkr.server.model import TaskStatus, TaskResult, LogRecipe
 from bkr.inttest import data_setup
@@ -122,6 +123,45 @@ def test_change_files(self):
                 self.assert_(log.server.startswith('http://archive.example.com/beaker-logs/'), log.server)
                 self.assert_(log.basepath.startswith('/var/www/html/beaker-logs/'), log.basepath)
 
+    def test_change_files_many(self):
+        with session.begin():
+            jobs = [data_setup.create_completed_job() for _ in range(2)]
+            recipes = [job.recipesets[0].recipes[0] for job in jobs]
+        self.server.recipes.change_files_many([r.id for r in recipes],
+                'http://archive.example.com/beaker-logs',
+                '/var/www/html/beaker-logs')
+        with session.begin():
+            session.expire_all()
+            for recipe in recipes:
+                self.assertEquals(recipe.log_server, u'archive.example.com')
+                for log in recipe.all_logs():
+                    self.assert_(log.server.startswith('http://archive.example.com/beaker-logs/'), log.server)
+                    self.assert_(log.basepath.startswith('/var/www/html/beaker-logs/'), log.basepath)
+
+    def test_gets_logs_for_many_recipes(self):
+        with session.begin():
+            recipes = [data_setup.create_recipe() for _ in range(2)]
+            recipes[0].logs.append(LogRecipe(filename=u'first.log'))
+            recipes[1].logs.append(LogRecipe(filename=u'second.log'))
+            data_setup.create_job_for_recipes(recipes)
+        logs = self.server.recipes.files_many([r.id for r in recipes])
+        self.assertEquals(set(logs.keys()), set(str(r.id) for r in recipes))
+        self.assertEquals([log['filename'] for log in logs[str(recipes[0].id)]],
+                ['first.log'])
+        self.assertEquals([log['filename'] for log in logs[str(recipes[1].id)]],
+                ['second.log'])
+
+    def test_files_many_requires_login(self):
+        with session.begin():
+            recipe = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([recipe])
+        server = self.get_server()
+        try:
+            server.recipes.files_many([recipe.id])
+            self.fail('should raise')
+        except xmlrpclib.Fault, e:
+            self.assertIn('Anonymous access denied', e.faultString)
+
     def test_gets_logs(self):
         with session.begin():
             system = data_setup.create_system(lab_controller=self.lc)
@@ -136,3 +136,67 @@ def test_task_roles_visible_between_hosts_and_guests(self):
             self.assertEquals(
                     self.server.recipes.tasks.peer_roles(recipe.tasks[0].id),
                     expected_peer_roles)
+
+    def test_bulk(self):
+        with session.begin():
+            recipe = data_setup.create_recipe()
+            job = data_setup.create_job_for_recipes([recipe])
+            data_setup.mark_recipe_waiting(recipe)
+            task = recipe.tasks[0]
+        self.server.auth.login_password(self.lc.user.user_name, u'logmein')
+        outcomes = self.server.recipes.tasks.bulk([
+            ['recipes.tasks.start', [task.id]],
+            ['recipes.tasks.result', [task.id, 'pass_', '/first', 1, 'ok']],
+            ['recipes.tasks.result', [task.id, 'bogus', '/second', 2, 'bad']],
+            ['recipes.tasks.update', [task.id, {'version': '1.2-3'}]],
+            ['recipes.tasks.stop', [task.id, 'stop']],
+            ['recipes.tasks.result', [task.id, 'pass_', '/third', 3, 'late']],
+            ['jobs.delete_jobs', [[job.t_id]]],
+        ])
+        self.assertEquals(len(outcomes), 7)
+        self.assertIn('result', outcomes[0])
+        self.assertIn('result', outcomes[1])
+        self.assertIn('Invalid result_type', outcomes[2]['faultString'])
+        self.assertEquals(outcomes[3]['result']['version'], '1.2-3')
+        self.assertIn('result', outcomes[4])
+        self.assertIn('Cannot record result for finished task',
+                outcomes[5]['faultString'])
+        self.assertIn('cannot be called in bulk', outcomes[6]['faultString'])
+        with session.begin():
+            session.expire_all()
+            self.assertEquals(task.status, TaskStatus.completed)
+            self.assertEquals(task.version, u'1.2-3')
+            self.assertEquals([result.path for result in task.results],
+                    [u'/first'])
+            self.assertEquals(task.results[0].id, outcomes[1]['result'])
+
+    def test_watchdog_changes(self):
+        with session.begin():
+            first = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([first])
+            data_setup.mark_recipe_running(first, lab_controller=self.lc)
+        self.server.auth.login_password(self.lc.user.user_name, u'logmein')
+        changes = self.server.recipes.tasks.watchdog_changes(None, 'active')
+        self.assertTrue(changes['full'])
+        self.assertEquals(changes['added'],
+                self.server.recipes.tasks.watchdogs('active'))
+        self.assertEquals(changes['removed'], [])
+        # nothing has changed
+        changes = self.server.recipes.tasks.watchdog_changes(changes['cursor'], 'active')
+        self.assertFalse(changes['full'])
+        self.assertEquals(changes['added'], [])
+        self.assertEquals(changes['removed'], [])
+        with session.begin():
+            second = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([second])
+            data_setup.mark_recipe_running(second, lab_controller=self.lc)
+            data_setup.mark_recipe_complete(first, only=True)
+        changes = self.server.recipes.tasks.watchdog_changes(changes['cursor'], 'active')
+        self.assertFalse(changes['full'])
+        self.assertEquals(changes['added'], [{'recipe_id': second.id,
+                'system': second.resource.fqdn, 'is_virt_recipe': False}])
+        self.assertEquals(changes['removed'], [first.id])
+        # a cursor we don't understand gives back everything
+        changes = self.server.recipes.tasks.watchdog_changes('bogus', 'active')
+        self.assertTrue(changes['full'])
+        self.assertEquals([w['recipe_id'] for w in changes['added']], [second.id])
@@ -1218,6 +1218,94 @@ def test_enforced_pagination_redirect(self):
         self.assertEquals(response.status_code, 302)
         self.assertEquals(response.headers['Location'], expected_redirect)
 
+    def _fetch_all_with_cursor(self, url):
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            response = requests.get(url, params={'cursor': cursor},
+                    headers={'Accept': 'application/json'})
+            response.raise_for_status()
+            json = response.json()
+            self.assertNotIn('page', json)
+            ids.extend(activity['id'] for activity in json['entries'])
+            cursor = json.get('next_cursor')
+        return ids
+
+    def test_cursor_pagination(self):
+        with session.begin():
+            system = data_setup.create_system()
+            activities = [system.record_activity(service=u'testdata',
+                    field=u'nonsense', action=action)
+                    for action in [u'poke', u'prod'] * 12]
+        # default sort order, newest first
+        url = get_server_base() + 'systems/%s/activity/?page_size=5' % system.fqdn
+        self.assertEquals(self._fetch_all_with_cursor(url),
+                sorted([a.id for a in activities], reverse=True))
+        # sorted by a non-unique column, ties are broken by id
+        url = (get_server_base() + 'systems/%s/activity/'
+                '?page_size=5&sort_by=action&order=asc' % system.fqdn)
+        self.assertEquals(self._fetch_all_with_cursor(url),
+                sorted([a.id for a in activities if a.action == u'poke']) +
+                sorted([a.id for a in activities if a.action == u'prod']))
+
+    def test_cursor_for_different_sort_order_is_rejected(self):
+        with session.begin():
+            system = data_setup.create_system()
+            for _ in range(3):
+                system.record_activity(service=u'testdata',
+                        field=u'nonsense', action=u'poke')
+        response = requests.get(get_server_base() +
+                'systems/%s/activity/?page_size=2&cursor=' % system.fqdn,
+                headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        next_cursor = response.json()['next_cursor']
+        response = requests.get(get_server_base() +
+                'systems/%s/activity/' % system.fqdn,
+                params={'page_size': 2, 'cursor': next_cursor,
+                        'sort_by': 'action'},
+                headers={'Accept': 'application/json'})
+        self.assertEquals(response.status_code, 400)
+
+    def test_cached_count(self):
+        with session.begin():
+            system = data_setup.create_system()
+            for _ in range(3):
+                system.record_activity(service=u'testdata',
+                        field=u'nonsense', action=u'poke')
+        url = (get_server_base() +
+                'systems/%s/activity/?page_size=2&count=cached' % system.fqdn)
+        # The total is counted in the background after the first request.
+        def cached_count():
+            response = requests.get(url, headers={'Accept': 'application/json'})
+            response.raise_for_status()
+            return response.json().get('count_is_cached')
+        wait_for_condition(cached_count)
+        response = requests.get(url, headers={'Accept': 'application/json'})
+        self.assertEquals(response.json()['count'], 3)
+
+    def test_substring_search(self):
+        # old_value and new_value are in the search index
+        with session.begin():
+            system = data_setup.create_system()
+            frobnicated_activity = system.record_activity(service=u'testdata',
+                    field=u'nonsense', action=u'poke', new=u'frobnicated')
+            polished_activity = system.record_activity(service=u'testdata',
+                    field=u'nonsense', action=u'poke', new=u'polished')
+        response = requests.get(get_server_base() +
+                'systems/%s/activity/?q=*nicat*' % system.fqdn,
+                headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        results = [activity['id'] for activity in response.json()['entries']]
+        self.assertEquals(results, [frobnicated_activity.id])
+        response = requests.get(get_server_base() +
+                'systems/%s/activity/?q=(new_value:*nicat* OR new_value:*lish*) '
+                'action:poke' % system.fqdn,
+                headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        results = [activity['id'] for activity in response.json()['entries']]
+        self.assertItemsEqual(results,
+                [frobnicated_activity.id, polished_activity.id])
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=1401964
     def test_filter_by_activity_id_range(self):
         with session.begin():
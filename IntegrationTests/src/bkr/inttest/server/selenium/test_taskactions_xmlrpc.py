@@ -4,7 +4,11 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import time
+import xmlrpclib
+from threading import Thread
 from turbogears.database import session
+from bkr.server.model import Job
 from bkr.inttest.server.selenium import XmlRpcTestCase
 from bkr.inttest import data_setup
 
@@ -56,3 +60,54 @@ def test_worker_info_for_recipe_without_resource(self):
                 recipe.t_id)['worker'], None)
         self.assertEquals(self.server.taskactions.task_info(
                 recipe.tasks[0].t_id)['worker'], None)
+
+    def test_task_info_many(self):
+        with session.begin():
+            job = data_setup.create_job(owner=self.user)
+            other_job = data_setup.create_job(owner=self.user)
+            recipe = job.recipesets[0].recipes[0]
+        taskids = [job.t_id, recipe.t_id, other_job.t_id]
+        result = self.server.taskactions.task_info_many(taskids)
+        self.assertItemsEqual(result['tasks'].keys(), taskids)
+        self.assertEquals(result['tasks'][recipe.t_id],
+                self.server.taskactions.task_info(recipe.t_id))
+        # Nothing has changed, so nothing is returned.
+        version = result['version']
+        result = self.server.taskactions.task_info_many(taskids, version)
+        self.assertEquals(result['tasks'], {})
+        self.assertEquals(result['version'], version)
+        # Only the job which changed is returned.
+        with session.begin():
+            data_setup.mark_job_running(other_job)
+        result = self.server.taskactions.task_info_many(taskids, version)
+        self.assertEquals(result['tasks'].keys(), [other_job.t_id])
+        self.assertEquals(result['tasks'][other_job.t_id]['state'], 'Running')
+        self.assertNotEquals(result['version'], version)
+
+    def test_task_info_many_returns_as_soon_as_something_changes(self):
+        with session.begin():
+            job = data_setup.create_job(owner=self.user)
+        version = self.server.taskactions.task_info_many([job.t_id])['version']
+        def mark_running():
+            time.sleep(2)
+            with session.begin():
+                data_setup.mark_job_running(Job.by_id(job.id))
+        thread = Thread(target=mark_running)
+        thread.start()
+        start = time.time()
+        result = self.server.taskactions.task_info_many([job.t_id], version, 30)
+        thread.join()
+        # The wait ends early, and the next call returns the new state.
+        self.assertLess(time.time() - start, 20)
+        result = self.server.taskactions.task_info_many([job.t_id],
+                result['version'])
+        self.assertEquals(result['tasks'][job.t_id]['state'], 'Running')
+
+    def test_task_info_many_invalid_taskid(self):
+        with session.begin():
+            job = data_setup.create_job(owner=self.user)
+        try:
+            self.server.taskactions.task_info_many([job.t_id, 'R:0'])
+            self.fail('should raise')
+        except xmlrpclib.Fault, e:
+            self.assertIn('0 is not a valid Recipe id', e.faultString)
@@ -18,7 +18,7 @@
         Provision, TaskPriority, RecipeSet, RecipeTaskResult, Task, SystemPermission,\
         MachineRecipe, GuestRecipe, LabControllerDistroTree, DistroTree, \
         TaskResult, Command, CommandStatus, GroupMembershipType, \
-        RecipeVirtStatus
+        RecipeVirtStatus, StaleTaskStatusException
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import not_
 from turbogears import config
@@ -462,6 +462,46 @@ def mock_sqr(recipe_id, guest_id=None):
             s = Recipe.by_id(s.id)
             self.assertEquals(s.status, TaskStatus.scheduled)
 
+    def test_dirty_jobs_are_updated_in_batches(self):
+        with session.begin():
+            jobs = [data_setup.create_running_job(num_recipes=2)
+                    for _ in range(3)]
+            for job in jobs:
+                data_setup.mark_recipe_tasks_finished(job.recipesets[0].recipes[0],
+                        result=TaskResult.fail, only=True)
+                data_setup.mark_recipe_tasks_finished(job.recipesets[0].recipes[1],
+                        result=TaskResult.pass_, only=True)
+                self.assertTrue(job.is_dirty)
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            for job in jobs:
+                job = Job.by_id(job.id)
+                self.assertFalse(job.is_dirty)
+                self.assertEquals(job.status, TaskStatus.completed)
+                self.assertEquals(job.result, TaskResult.fail)
+                self.assertEquals(job.ftasks, job.recipesets[0].recipes[0].ttasks)
+                self.assertEquals(job.ptasks, job.recipesets[0].recipes[1].ttasks)
+
+    def test_job_failing_in_batch_is_retried_on_its_own(self):
+        with session.begin():
+            good_job = data_setup.create_running_job()
+            bad_job = data_setup.create_running_job()
+            for job in [good_job, bad_job]:
+                data_setup.mark_recipe_tasks_finished(job.recipesets[0].recipes[0],
+                        only=True)
+        original_update_status = Job.update_status
+        def mock_update_status(job, task_rollups=None):
+            if job.id == bad_job.id and task_rollups is not None:
+                raise RuntimeError('ouch')
+            original_update_status(job, task_rollups=task_rollups)
+        with patch.object(Job, 'update_status', mock_update_status):
+            beakerd.update_dirty_jobs()
+        with session.begin():
+            for job in [good_job, bad_job]:
+                job = Job.by_id(job.id)
+                self.assertFalse(job.is_dirty)
+                self.assertEquals(job.status, TaskStatus.completed)
+
     def test_just_in_time_systems(self):
        # Expected behaviour of this test is (as of 0.11.3) the following:
        # When scheduled_queued_recipes() is called it retrieves spare_recipe
@@ -619,6 +659,196 @@ def test_just_in_time_systems_multihost(self):
         self.assertEqual(r2.status, TaskStatus.scheduled)
         self.assertEqual(r3.status, TaskStatus.scheduled)
 
+    def test_recipes_are_processed_by_worker_threads(self):
+        config.update({'beaker.scheduler_workers': 3})
+        def reset_workers():
+            for executor in beakerd._worker_executors or []:
+                executor.shutdown()
+            beakerd._worker_executors = None
+            config.update({'beaker.scheduler_workers': 1})
+        self.addCleanup(reset_workers)
+        with session.begin():
+            data_setup.create_system(shared=True, lab_controller=self.lab_controller)
+            jobs = [data_setup.create_job() for _ in range(5)]
+        beakerd.process_new_recipes()
+        beakerd.update_dirty_jobs()
+        beakerd.queue_processed_recipesets()
+        beakerd.update_dirty_jobs()
+        self.assertEquals(len(beakerd._worker_executors), 3)
+        with session.begin():
+            for job in jobs:
+                self.assertEquals(Job.by_id(job.id).status, TaskStatus.queued)
+
+    def test_stage_timings_and_recipe_latencies_are_recorded(self):
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            job = data_setup.create_job()
+            job.recipesets[0].recipes[0]._host_requires = (u"""
+                <hostRequires>
+                    <hostname op="=" value="%s" />
+                </hostRequires>
+                """ % system.fqdn)
+        runs_before = beakerd._stage_stats['process_new_recipes'].runs
+        items_before = beakerd._stage_stats['process_new_recipes'].items
+        scheduled_before = beakerd._recipe_latencies['queued_to_scheduled'].count
+        beakerd.process_new_recipes()
+        beakerd.update_dirty_jobs()
+        beakerd.queue_processed_recipesets()
+        beakerd.update_dirty_jobs()
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            job = Job.query.get(job.id)
+            self.assertEquals(job.status, TaskStatus.scheduled)
+            recipe_id = job.recipesets[0].recipes[0].id
+        stats = beakerd._stage_stats['process_new_recipes']
+        self.assertEquals(stats.runs, runs_before + 1)
+        self.assert_(stats.items >= items_before + 1)
+        self.assertEquals(beakerd._recipe_latencies['queued_to_scheduled'].count,
+                scheduled_before + 1)
+        self.assertNotIn(recipe_id, beakerd._recipe_transition_times)
+        beakerd.dump_stats() # should not blow up
+
+    def test_rolled_back_recipe_transition_is_not_recorded(self):
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            job = data_setup.create_job()
+            job.recipesets[0].recipes[0]._host_requires = (u"""
+                <hostRequires>
+                    <hostname op="=" value="%s" />
+                </hostRequires>
+                """ % system.fqdn)
+        beakerd.process_new_recipes()
+        beakerd.update_dirty_jobs()
+        beakerd.queue_processed_recipesets()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            recipe_id = Job.query.get(job.id).recipesets[0].recipes[0].id
+        self.assertIn(recipe_id, beakerd._recipe_transition_times)
+        scheduled_before = beakerd._recipe_latencies['queued_to_scheduled'].count
+        # The savepoint for this recipe is rolled back after the transition
+        with patch.object(Recipe, 'createRepo',
+                side_effect=StaleTaskStatusException(u'stale')):
+            beakerd.schedule_queued_recipes()
+        with session.begin():
+            self.assertEquals(Recipe.by_id(recipe_id).status, TaskStatus.queued)
+        self.assertEquals(beakerd._recipe_latencies['queued_to_scheduled'].count,
+                scheduled_before)
+        self.assertIn(recipe_id, beakerd._recipe_transition_times)
+        beakerd.schedule_queued_recipes()
+        with session.begin():
+            self.assertEquals(Recipe.by_id(recipe_id).status, TaskStatus.scheduled)
+        self.assertEquals(beakerd._recipe_latencies['queued_to_scheduled'].count,
+                scheduled_before + 1)
+        self.assertNotIn(recipe_id, beakerd._recipe_transition_times)
+
+    def test_system_index_does_not_hand_out_system_twice(self):
+        config.update({'beaker.scheduler_system_index': True})
+        self.addCleanup(config.update, {'beaker.scheduler_system_index': False})
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            busy_system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            busy_system.user = data_setup.create_user()
+            r1 = data_setup.create_recipe()
+            r2 = data_setup.create_recipe()
+            j1 = data_setup.create_job_for_recipes([r1])
+            j2 = data_setup.create_job_for_recipes([r2])
+            r1.systems[:] = [system, busy_system]
+            r2.systems[:] = [system, busy_system]
+            data_setup.mark_job_queued(j1)
+            data_setup.mark_job_queued(j2)
+        beakerd.update_dirty_jobs()
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            r1 = Recipe.query.get(r1.id)
+            r2 = Recipe.query.get(r2.id)
+            self.assertEquals(r1.status, TaskStatus.scheduled)
+            self.assertEquals(r1.resource.system.id, system.id)
+            self.assertEquals(r2.status, TaskStatus.queued)
+
+    def test_system_index_is_kept_until_something_changes(self):
+        config.update({'beaker.scheduler_system_index': True})
+        self.addCleanup(config.update, {'beaker.scheduler_system_index': False})
+        beakerd._cached_system_index = None
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            system.user = data_setup.create_user()
+            recipe = data_setup.create_recipe()
+            job = data_setup.create_job_for_recipes([recipe])
+            recipe.systems[:] = [system]
+            data_setup.mark_job_queued(job)
+        beakerd.update_dirty_jobs()
+        beakerd.schedule_queued_recipes()
+        refreshed = beakerd._cached_system_index.refreshed
+        # Nothing has changed, so the next pass uses the same index.
+        beakerd.schedule_queued_recipes()
+        self.assertEquals(beakerd._cached_system_index.refreshed, refreshed)
+        # Returning the system is noticed and the index is rebuilt.
+        with session.begin():
+            System.query.get(system.id).user = None
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        self.assertNotEquals(beakerd._cached_system_index.refreshed, refreshed)
+        with session.begin():
+            recipe = Recipe.query.get(recipe.id)
+            self.assertEquals(recipe.status, TaskStatus.scheduled)
+            self.assertEquals(recipe.resource.system.id, system.id)
+
+    def test_system_index_rechecks_host_filter(self):
+        # The recipe's candidate systems were recorded when it was processed, 
+        # but the system no longer matches its host filter.
+        config.update({'beaker.scheduler_system_index': True})
+        self.addCleanup(config.update, {'beaker.scheduler_system_index': False})
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            recipe = data_setup.create_recipe()
+            recipe._host_requires = (
+                    u'<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+                    % data_setup.unique_name(u'nonexistent%s.example.invalid'))
+            job = data_setup.create_job_for_recipes([recipe])
+            recipe.systems[:] = [system]
+            data_setup.mark_job_queued(job)
+        beakerd.update_dirty_jobs()
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            recipe = Recipe.query.get(recipe.id)
+            self.assertEquals(recipe.status, TaskStatus.queued)
+            self.assertEquals(recipe.systems, [])
+
+    def test_schedules_without_system_index(self):
+        with session.begin():
+            system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            revoked_system = data_setup.create_system(shared=True,
+                    lab_controller=self.lab_controller)
+            recipe = data_setup.create_recipe()
+            job = data_setup.create_job_for_recipes([recipe])
+            recipe.systems[:] = [revoked_system]
+            data_setup.mark_job_queued(job)
+            revoked_system.custom_access_policy.rules[:] = []
+        beakerd.update_dirty_jobs()
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            recipe = Recipe.query.get(recipe.id)
+            self.assertEquals(recipe.status, TaskStatus.queued)
+            self.assertEquals(recipe.systems, [])
+            recipe.systems[:] = [System.query.get(system.id)]
+        beakerd.schedule_queued_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            recipe = Recipe.query.get(recipe.id)
+            self.assertEquals(recipe.status, TaskStatus.scheduled)
+            self.assertEquals(recipe.resource.system.id, system.id)
+
     def test_loaned_machine_can_be_scheduled(self):
         with session.begin():
             user = data_setup.create_user()
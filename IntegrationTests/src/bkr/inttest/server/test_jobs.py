@@ -161,6 +161,42 @@ def test_creates_taskpackages_successfully(self):
         job = self.controller.process_xmljob(xmljob, self.user)
         self.assertListEqual(['libbeer'], [x.package for x in job.recipesets[0].recipes[0].custom_packages])
 
+    def test_identical_recipes_share_lookups(self):
+        xml = """
+        <job>
+            <recipeSet>
+                <recipe>
+                    <distroRequires>
+                        <distro_name op="=" value="BlueShoeLinux5-5"/>
+                    </distroRequires>
+                    <hostRequires/>
+                    <packages><package name="libbeer"/></packages>
+                    <task name="/distribution/install"/>
+                </recipe>
+                <recipe>
+                    <distroRequires>
+                        <distro_name op="=" value="BlueShoeLinux5-5"/>
+                    </distroRequires>
+                    <hostRequires/>
+                    <packages><package name="libbeer"/></packages>
+                    <task name="/distribution/install"/>
+                    <task name="/distribution/reservesys"/>
+                </recipe>
+            </recipeSet>
+        </job>
+        """
+        from bkr.server.jobs import JobSubmissionLookups
+        lookups = JobSubmissionLookups()
+        xmljob = lxml.etree.fromstring(xml)
+        job = self.controller.process_xmljob(xmljob, self.user, lookups=lookups)
+        first, second = job.recipesets[0].recipes
+        self.assertEquals(first.distro_tree, second.distro_tree)
+        self.assertEquals(first.custom_packages, second.custom_packages)
+        self.assertEquals(first.tasks[0].task, second.tasks[0].task)
+        self.assertEquals(second.tasks[1].task.name, u'/distribution/reservesys')
+        self.assertEquals(len(lookups.distro_trees), 1)
+        self.assertEquals(lookups.packages.keys(), ['libbeer'])
+
     def test_upload_xml_catches_invalid_xml(self):
         """We want that invalid Job XML is caught in the validation step."""
         xmljob = lxml.etree.fromstring('''
@@ -32,10 +32,11 @@
         RecipeTask, RecipeTaskResult, DeclarativeMappedObject, OSVersion, \
         RecipeReservationRequest, ReleaseAction, SystemPool, CommandStatus, \
         GroupMembershipType, RecipeSetComment, Power, LogRecipeTask, \
-        LogRecipeTaskResult
+        LogRecipeTaskResult, KernelType
+from bkr.server.model.search import search_index_trigram, search_index_filter
 
 from bkr.server.bexceptions import BeakerException
-from sqlalchemy.sql import not_
+from sqlalchemy.sql import not_, select, and_
 from sqlalchemy.exc import OperationalError
 import netaddr
 from bkr.inttest import data_setup, DatabaseTestCase, get_server_base
@@ -952,6 +953,71 @@ def test_add_rule_for_everybody(self):
                 .filter(SystemAccessPolicy.id == self.policy.id)
                 .filter(SystemAccessPolicy.grants(user, perm)).count())
 
+    def _query_grants(self, user, perm):
+        return bool(SystemAccessPolicy.query
+                .filter(SystemAccessPolicy.id == self.policy.id)
+                .filter(SystemAccessPolicy.grants(user, perm)).count())
+
+    def test_group_rule_follows_membership_changes(self):
+        perm = SystemPermission.reserve
+        group = data_setup.create_group()
+        self.policy.add_rule(perm, group=group)
+        user = data_setup.create_user()
+        self.assertFalse(self._query_grants(user, perm))
+        group.add_member(user)
+        session.flush()
+        self.assertTrue(self._query_grants(user, perm))
+        group.remove_member(user)
+        session.flush()
+        self.assertFalse(self._query_grants(user, perm))
+
+    def test_removed_rule_no_longer_grants(self):
+        perm = SystemPermission.reserve
+        user = data_setup.create_user()
+        rule = self.policy.add_rule(perm, user=user)
+        self.assertTrue(self._query_grants(user, perm))
+        self.policy.rules.remove(rule)
+        session.flush()
+        self.assertFalse(self._query_grants(user, perm))
+        self.assertFalse(SystemAccessPolicy.query
+                .filter(SystemAccessPolicy.id == self.policy.id)
+                .filter(SystemAccessPolicy.grants_everybody(perm)).count())
+
+    def test_add_rule_for_inverted_group(self):
+        perm = SystemPermission.reserve
+        group = data_setup.create_group(
+                membership_type=GroupMembershipType.inverted)
+        excluded = data_setup.create_user()
+        group.exclude_user(excluded)
+        self.policy.add_rule(perm, group=group)
+        # users created after the rule are members too
+        member = data_setup.create_user()
+        session.flush()
+        self.assertTrue(self.policy.grants(member, perm))
+        self.assertTrue(self._query_grants(member, perm))
+        self.assertFalse(self.policy.grants(excluded, perm))
+        self.assertFalse(self._query_grants(excluded, perm))
+        # but it does not grant the permission to everybody
+        self.assertFalse(SystemAccessPolicy.query
+                .filter(SystemAccessPolicy.id == self.policy.id)
+                .filter(SystemAccessPolicy.grants_everybody(perm)).count())
+
+    def test_changing_group_membership_type(self):
+        perm = SystemPermission.reserve
+        group = data_setup.create_group()
+        member = data_setup.create_user()
+        group.add_member(member)
+        self.policy.add_rule(perm, group=group)
+        non_member = data_setup.create_user()
+        self.assertFalse(self._query_grants(non_member, perm))
+        group.membership_type = GroupMembershipType.inverted
+        session.flush()
+        self.assertTrue(self._query_grants(non_member, perm))
+        group.membership_type = GroupMembershipType.normal
+        session.flush()
+        self.assertFalse(self._query_grants(non_member, perm))
+        self.assertTrue(self._query_grants(member, perm))
+
 
 class SystemReleaseAction(DatabaseTestCase):
 
@@ -1401,6 +1467,29 @@ def test_url_in_lab(self):
         self.assertRaises(ValueError, lambda: distro_tree.url_in_lab(
                 self.lc, scheme=['http', 'nfs'], required=True))
 
+    def test_cached_lab_urls_are_discarded_when_changed(self):
+        distro_tree = data_setup.create_distro_tree(lab_controllers=[self.lc],
+                urls=[u'http://unimportant/'])
+        session.flush()
+        self.assertEquals(distro_tree.url_in_lab(self.lc), u'http://unimportant/')
+        distro_tree.lab_controller_assocs[0].url = u'http://changed/'
+        self.assertEquals(distro_tree.url_in_lab(self.lc), u'http://changed/')
+        distro_tree.lab_controller_assocs[:] = []
+        self.assertEquals(distro_tree.url_in_lab(self.lc), None)
+
+    def test_netboot_images(self):
+        distro_tree = data_setup.create_distro_tree(arch=u'x86_64',
+                lab_controllers=[self.lc], urls=[u'http://unimportant/'])
+        session.flush()
+        kernel_type = KernelType.by_name(u'default')
+        self.assertEquals(distro_tree.netboot_images(self.lc, kernel_type),
+                (u'http://unimportant/pxeboot/vmlinuz',
+                 u'http://unimportant/pxeboot/initrd'))
+        other_lc = data_setup.create_labcontroller()
+        session.flush()
+        self.assertRaises(ValueError, lambda:
+                distro_tree.netboot_images(other_lc, kernel_type))
+
     def provision_distro_tree(self, distro_tree):
         recipe = data_setup.create_recipe(distro_tree=distro_tree)
         data_setup.create_job_for_recipes([recipe])
@@ -2699,5 +2788,38 @@ def test_invalid_fqdn(self):
         except ValueError as e:
             self.assertIn('Invalid FQDN for lab controller', str(e))
 
+class SearchIndexTest(DatabaseTestCase):
+
+    def setUp(self):
+        session.begin()
+
+    def tearDown(self):
+        session.rollback()
+
+    def _indexed_trigrams(self, key, row_id):
+        t = search_index_trigram.c
+        return set(trigram for trigram, in session.execute(
+                select([t.trigram]).where(and_(t.column_key == key,
+                                               t.row_id == row_id))))
+
+    def test_index_follows_changes(self):
+        system = data_setup.create_system(fqdn=u'abcd.example.invalid')
+        session.flush()
+        self.assertIn(u'abc', self._indexed_trigrams(u'system.fqdn', system.id))
+        system.fqdn = u'wxyz.example.invalid'
+        session.flush()
+        trigrams = self._indexed_trigrams(u'system.fqdn', system.id)
+        self.assertIn(u'wxy', trigrams)
+        self.assertNotIn(u'abc', trigrams)
+
+    def test_search_index_filter(self):
+        included = data_setup.create_system(fqdn=u'frobnicator.example.invalid')
+        excluded = data_setup.create_system(fqdn=u'polisher.example.invalid')
+        session.flush()
+        clause = search_index_filter(System.fqdn, u'%nicat%')
+        systems = System.query.filter(clause).all()
+        self.assertIn(included, systems)
+        self.assertNotIn(excluded, systems)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,60 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import socket
+import shutil
+import tempfile
+from turbogears import config
+from turbogears.database import session
+from bkr.server import wakeup
+from bkr.server.model import Job
+from bkr.inttest import data_setup, DatabaseTestCase
+
+class WakeupNotificationTest(DatabaseTestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp(prefix='beakerd-wakeup-test')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        config.update({'beaker.scheduler_wakeup_socket':
+                os.path.join(tmpdir, 'beakerd.sock')})
+        self.addCleanup(config.update, {'beaker.scheduler_wakeup_socket': ''})
+        self.sock = wakeup.bind()
+        self.sock.settimeout(0.5)
+        self.addCleanup(self.sock.close)
+        wakeup.install_listeners()
+
+    def assert_notified(self):
+        self.assertEquals(self.sock.recv(64), 'wakeup')
+
+    def assert_not_notified(self):
+        self.assertRaises(socket.timeout, self.sock.recv, 64)
+
+    def test_job_submission_notifies_beakerd(self):
+        with session.begin():
+            data_setup.create_job()
+        self.assert_notified()
+
+    def test_marking_job_dirty_notifies_beakerd(self):
+        with session.begin():
+            job = data_setup.create_running_job()
+        self.assert_notified()
+        with session.begin():
+            Job.by_id(job.id).cancel()
+        self.assert_notified()
+
+    def test_rolled_back_transaction_does_not_notify_beakerd(self):
+        session.begin()
+        try:
+            data_setup.create_job()
+            session.flush()
+        finally:
+            session.rollback()
+        self.assert_not_notified()
+
+    def test_unrelated_changes_do_not_notify_beakerd(self):
+        with session.begin():
+            data_setup.create_user()
+        self.assert_not_notified()
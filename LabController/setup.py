@@ -92,5 +92,8 @@ def systemd_tmpfiles_dir():
             'beaker-expire-distros = bkr.labcontroller.expire_distros:main',
             'beaker-clear-netboot = bkr.labcontroller.clear_netboot:main',
         ),
+        'bkr.labcontroller.power_drivers': (
+            'virsh = bkr.labcontroller.power:VirshPowerDriver',
+        ),
     }
 )
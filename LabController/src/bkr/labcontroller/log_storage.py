@@ -8,8 +8,268 @@
 
 import os, os.path
 import errno
+import fcntl
+import struct
+import tempfile
+import threading
+import Queue
+import logging
+import zlib
 from bkr.common.helpers import makedirs_ignore
 
+logger = logging.getLogger(__name__)
+
+#: Suffix added to the name of a log when it is compressed at rest.
+COMPRESSED_SUFFIX = '.bgz'
+
+# Compressed logs are stored in the BGZF format: a series of gzip members, 
+# each holding at most 64KB of the log, with the size of each member recorded 
+# in an extra header field. That lets readers seek within the log by skipping 
+# from one member to the next, and it is still an ordinary gzip file as far as 
+# zcat, rsync and web browsers are concerned.
+_bgzf_header = struct.Struct('<4BI2BH2BHH')
+_bgzf_trailer = struct.Struct('<II')
+_bgzf_max_input = 0xff00
+_bgzf_max_block = 0x10000
+
+def _bgzf_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = _bgzf_header.size + len(compressed) + _bgzf_trailer.size
+    if block_size > _bgzf_max_block:
+        # incompressible, store it instead
+        return _bgzf_block(data, level=0)
+    return (_bgzf_header.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'),
+                ord('C'), 2, block_size - 1)
+            + compressed
+            + _bgzf_trailer.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+
+#: Empty block marking the end of a BGZF file.
+_bgzf_eof = _bgzf_block('')
+
+def _write_compressed(src, dest):
+    while True:
+        data = src.read(_bgzf_max_input)
+        if not data:
+            break
+        dest.write(_bgzf_block(data))
+    dest.write(_bgzf_eof)
+
+class CompressedLogFile(object):
+    """
+    Read-only file object giving the uncompressed contents of a compressed 
+    log. It supports seeking, and only decompresses the parts which are read.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        #: list of (compressed offset, uncompressed offset) for each block
+        self.blocks = []
+        compressed_offset = uncompressed_offset = 0
+        while True:
+            f.seek(compressed_offset)
+            header = f.read(_bgzf_header.size)
+            if not header:
+                break
+            if len(header) < _bgzf_header.size:
+                raise ValueError('Truncated compressed log %s' % f.name)
+            fields = _bgzf_header.unpack(header)
+            if fields[:4] != (0x1f, 0x8b, 8, 4) or fields[8:10] != (ord('B'), ord('C')):
+                raise ValueError('Invalid compressed log %s' % f.name)
+            block_size = fields[11] + 1
+            f.seek(compressed_offset + block_size - 4)
+            uncompressed_size, = struct.unpack('<I', f.read(4))
+            if uncompressed_size:
+                self.blocks.append((compressed_offset, uncompressed_offset))
+            compressed_offset += block_size
+            uncompressed_offset += uncompressed_size
+        self.size = uncompressed_offset
+        self.pos = 0
+        self._cached_block = None # (index, data)
+
+    @property
+    def name(self):
+        return self.f.name
+
+    def _block_index(self, pos):
+        # binary search for the last block starting at or before pos
+        lo, hi = 0, len(self.blocks)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.blocks[mid][1] <= pos:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def _block_data(self, index):
+        if self._cached_block is None or self._cached_block[0] != index:
+            compressed_offset = self.blocks[index][0]
+            self.f.seek(compressed_offset)
+            header = self.f.read(_bgzf_header.size)
+            block_size = _bgzf_header.unpack(header)[11] + 1
+            compressed = self.f.read(block_size - _bgzf_header.size)
+            data = zlib.decompress(compressed[:-_bgzf_trailer.size],
+                    -zlib.MAX_WBITS)
+            self._cached_block = (index, data)
+        return self._cached_block[1]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        chunks = []
+        while size > 0 and self.pos < self.size:
+            index = self._block_index(self.pos)
+            data = self._block_data(index)
+            start = self.pos - self.blocks[index][1]
+            chunk = data[start:start + size]
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid argument')
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def compress_log(path, min_ratio=0.9):
+    """
+    Replaces the log at *path* with a compressed copy, unless it is being 
+    written, is already compressed, or would not shrink below *min_ratio* of 
+    its size. Returns True if the log was compressed.
+
+    Writers hold a shared lock on the log (see :meth:`LogFile.__enter__`), so 
+    it is only compressed while nobody is writing to it.
+    """
+    compressed_path = path + COMPRESSED_SUFFIX
+    try:
+        f = open(path, 'r')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        # Skip it if it has been compressed already, or if it is being 
+        # restored from a compressed copy.
+        if os.fstat(f.fileno()).st_nlink == 0 or os.path.exists(compressed_path):
+            return False
+        original_size = os.fstat(f.fileno()).st_size
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                prefix='.', suffix=COMPRESSED_SUFFIX)
+        try:
+            with os.fdopen(fd, 'w') as dest:
+                _write_compressed(f, dest)
+                compressed_size = dest.tell()
+            if compressed_size >= original_size * min_ratio:
+                os.unlink(temp_path)
+                return False
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, compressed_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        os.unlink(path)
+        logger.debug('Compressed log %s from %s to %s bytes', path,
+                original_size, compressed_size)
+        return True
+    finally:
+        f.close()
+
+def _restore_compressed_log(path):
+    """
+    If the log at *path* has been compressed, replaces the compressed copy 
+    with the uncompressed log so that it can be written to again.
+    """
+    compressed_path = path + COMPRESSED_SUFFIX
+    try:
+        f = open(compressed_path, 'r')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        # Someone else might have restored it while we waited for the lock.
+        if os.fstat(f.fileno()).st_nlink == 0 or os.path.exists(path):
+            return
+        logger.debug('Restoring compressed log %s', path)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        try:
+            with os.fdopen(fd, 'w') as dest:
+                compressed = CompressedLogFile(f)
+                while True:
+                    data = compressed.read(65536)
+                    if not data:
+                        break
+                    dest.write(data)
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        os.unlink(compressed_path)
+    finally:
+        f.close()
+
+class LogCompressor(threading.Thread):
+    """
+    Compresses logs at rest in the background. Paths passed to 
+    :meth:`compress` are compressed one at a time, in the order they were 
+    given.
+    """
+
+    def __init__(self):
+        super(LogCompressor, self).__init__(name='LogCompressor')
+        self.daemon = True
+        self.queue = Queue.Queue()
+        #: total bytes before and after compression, for reporting
+        self.bytes_in = self.bytes_out = 0
+
+    def compress(self, paths):
+        for path in paths:
+            self.queue.put(path)
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                if not compress_log(path):
+                    continue
+                self.bytes_in += size
+                self.bytes_out += os.path.getsize(path + COMPRESSED_SUFFIX)
+            except Exception:
+                logger.exception('Failed to compress log %s', path)
+                continue
+            if self.queue.empty():
+                logger.info('Compressed logs at rest: %d bytes stored in %d bytes',
+                        self.bytes_in, self.bytes_out)
+
 class LogFile(object):
 
     def __init__(self, path, register_func, create=True):
@@ -23,24 +283,54 @@ def __repr__(self):
     def open_ro(self):
         """
         If you just want to read the log, call this instead of entering the context manager.
+
+        If the log has been compressed at rest, this returns 
+        a :class:`CompressedLogFile` giving its uncompressed contents.
         """
-        return open(self.path, 'r')
+        # The log may be compressed or restored between our attempts to open 
+        # it, so we try each name a few times.
+        for _ in range(3):
+            try:
+                return open(self.path, 'r')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                return CompressedLogFile(open(self.path + COMPRESSED_SUFFIX, 'r'))
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
 
     def __enter__(self):
         makedirs_ignore(os.path.dirname(self.path), 0755)
-        created = False
-        if self.create:
-            try:
-                # stdio does not have any mode string which corresponds to this 
-                # combination of flags, so we have to use raw os.open :-(
-                fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
-                created = True
-            except (OSError, IOError), e:
-                if e.errno != errno.EEXIST:
-                    raise
+        while True:
+            # Writes always go to the uncompressed log.
+            _restore_compressed_log(self.path)
+            created = False
+            if self.create:
+                try:
+                    # stdio does not have any mode string which corresponds to this 
+                    # combination of flags, so we have to use raw os.open :-(
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+                    created = True
+                except (OSError, IOError), e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    fd = os.open(self.path, os.O_RDWR)
+            else:
                 fd = os.open(self.path, os.O_RDWR)
-        else:
-            fd = os.open(self.path, os.O_RDWR)
+            # The shared lock stops compress_log() from replacing the log 
+            # while we are writing to it. If it was replaced while we were 
+            # opening it, we start again with the compressed copy.
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            except Exception:
+                os.close(fd)
+                raise
+            if os.fstat(fd).st_nlink:
+                break
+            os.close(fd)
         try:
             self.f = os.fdopen(fd, 'r+')
         except Exception:
@@ -72,6 +362,26 @@ def update_chunk(self, data, offset):
         self.f.write(data)
         self.f.flush()
 
+    def update_from_stream(self, stream, offset, length, chunk_size=65536):
+        """
+        Writes *length* bytes read from *stream* at *offset*, one chunk at 
+        a time, so that large uploads are never held in memory. Returns the 
+        number of bytes written, which is less than *length* if the stream 
+        ended early.
+        """
+        if offset < 0:
+            raise ValueError('Offset cannot be negative')
+        self.f.seek(offset, os.SEEK_SET)
+        written = 0
+        while written < length:
+            chunk = stream.read(min(chunk_size, length - written))
+            if not chunk:
+                break
+            self.f.write(chunk)
+            written += len(chunk)
+        self.f.flush()
+        return written
+
 class LogStorage(object):
 
     """
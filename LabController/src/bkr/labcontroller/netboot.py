@@ -10,6 +10,8 @@
 import logging
 import tempfile
 import shutil
+import time
+import hashlib
 from contextlib import contextmanager
 import collections
 from cStringIO import StringIO
@@ -94,6 +96,118 @@ def copy_default_loader_images():
     copy_path_ignore(os.path.join(get_tftp_root(), 'menu.c32'),
             '/usr/share/syslinux/menu.c32')
 
+class ImageCache(object):
+    """
+    Cache of netboot images on the local filesystem, keyed by distro tree ID 
+    and URL.
+
+    Each image is only fetched once, even if it is requested concurrently by 
+    several greenlets, threads, or processes. Callers should hardlink the 
+    cached file to wherever they need it. When the cache is larger than 
+    max_size bytes, the least recently used images which are not linked 
+    anywhere else are removed.
+    """
+
+    #: How often to check whether an image being fetched by someone else has 
+    #: arrived, in seconds
+    poll_interval = 0.5
+
+    def __init__(self, cache_dir, max_size=None, timeout=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.timeout = timeout
+
+    def path(self, distro_tree_id, url):
+        return os.path.join(self.cache_dir, '%s-%s' % (distro_tree_id,
+                hashlib.sha1(url).hexdigest()))
+
+    def fetch(self, distro_tree_id, url):
+        """
+        Returns the path to the cached image, fetching it first if necessary.
+        """
+        path = self.path(distro_tree_id, url)
+        lock_path = path + '.lock'
+        makedirs_ignore(self.cache_dir, 0755)
+        while True:
+            if os.path.exists(path):
+                # Mark as recently used
+                os.utime(path, None)
+                return path
+            try:
+                fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._wait_for_fetch(path, lock_path)
+                continue
+            try:
+                os.write(fd, '%d\n' % os.getpid())
+                os.close(fd)
+                logger.debug('Fetching %s for distro tree %s', url, distro_tree_id)
+                with atomically_replaced_file(path) as dest:
+                    siphon(urllib2.urlopen(url, timeout=self.timeout), dest)
+            finally:
+                unlink_ignore(lock_path)
+            return path
+
+    def _wait_for_fetch(self, path, lock_path):
+        # Someone else is fetching this image. Wait for them to finish, or 
+        # give up on them if they have died.
+        while not os.path.exists(path):
+            try:
+                pid = int(open(lock_path).read() or 0)
+            except IOError, e:
+                if e.errno == errno.ENOENT:
+                    return # they finished (or failed)
+                raise
+            except ValueError:
+                pid = 0 # they have not written their pid yet
+            if pid:
+                try:
+                    os.kill(pid, 0)
+                except OSError, e:
+                    if e.errno == errno.ESRCH:
+                        logger.warning('Removing stale image lock %s', lock_path)
+                        unlink_ignore(lock_path)
+                        return
+            time.sleep(self.poll_interval)
+
+    def evict(self):
+        """
+        Removes least recently used images until the cache is no bigger than 
+        max_size. Images which are still linked from elsewhere are never 
+        removed, since that would not free any space.
+        """
+        if not self.max_size:
+            return
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.') or name.endswith('.lock'):
+                continue # being fetched
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            total_size += st.st_size
+            if st.st_nlink == 1:
+                entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        for mtime, name, size in entries:
+            if total_size <= self.max_size:
+                break
+            logger.debug('Evicting image %s from cache', name)
+            unlink_ignore(os.path.join(self.cache_dir, name))
+            total_size -= size
+
+def get_image_cache():
+    conf = get_conf()
+    return ImageCache(os.path.join(get_tftp_root(), 'cache'),
+            max_size=conf.get('IMAGE_CACHE_MAX_SIZE'),
+            timeout=conf.get('IMAGE_FETCH_TIMEOUT'))
+
 def fetch_images(distro_tree_id, kernel_url, initrd_url, fqdn):
     """
     Creates references to kernel and initrd files at:
@@ -117,21 +231,18 @@ def fetch_images(distro_tree_id, kernel_url, initrd_url, fqdn):
     except OSError, e:
         if e.errno != errno.ENOENT:
             raise
-    # No luck there, so try something else...
+    # No luck there, so fetch them into the shared cache (unless another 
+    # system has already done so) and link them from there.
 
-    timeout = get_conf().get('IMAGE_FETCH_TIMEOUT')
-    logger.debug('Fetching kernel %s for %s', kernel_url, fqdn)
-    with atomically_replaced_file(os.path.join(images_dir, 'kernel')) as dest:
-        try:
-            siphon(urllib2.urlopen(kernel_url, timeout=timeout), dest)
-        except Exception as e:
-            raise ImageFetchingError(kernel_url, distro_tree_id, e)
-    logger.debug('Fetching initrd %s for %s', initrd_url, fqdn)
-    with atomically_replaced_file(os.path.join(images_dir, 'initrd')) as dest:
+    image_cache = get_image_cache()
+    for image_type, url in [('kernel', kernel_url), ('initrd', initrd_url)]:
+        logger.debug('Fetching %s %s for %s', image_type, url, fqdn)
         try:
-            siphon(urllib2.urlopen(initrd_url, timeout=timeout), dest)
+            cached_path = image_cache.fetch(distro_tree_id, url)
         except Exception as e:
-            raise ImageFetchingError(initrd_url, distro_tree_id, e)
+            raise ImageFetchingError(url, distro_tree_id, e)
+        atomic_link(cached_path, os.path.join(images_dir, image_type))
+    image_cache.evict()
 
 def have_images(fqdn):
     return os.path.exists(os.path.join(get_tftp_root(), 'images', fqdn))
@@ -0,0 +1,300 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Power drivers used by beaker-provision to run power commands.
+
+By default a power command runs the power script for its power type in a new
+process (see :class:`ScriptPowerDriver`). Drivers registered for a power type
+in the ``bkr.labcontroller.power_drivers`` entry point group instead run power
+commands inside beaker-provision, and can keep a session open to each power
+controller between commands (see :class:`SessionPowerDriver`). If a driver
+cannot be loaded, for example because the library it needs is not installed,
+the power script is used instead. A customised power script in
+/etc/beaker/power-scripts always takes precedence over a driver.
+"""
+
+import os, os.path
+import time
+import logging
+import subprocess
+from contextlib import contextmanager
+import pkg_resources
+import gevent, gevent.hub, gevent.lock
+
+logger = logging.getLogger(__name__)
+
+class PowerCommandFailed(Exception):
+    """
+    Raised by :meth:`PowerDriver.attempt` when a power command fails.
+    *description* names what failed (for example "Power script
+    /path/to/script") and *reason* says why.
+    """
+
+    def __init__(self, description, reason):
+        super(PowerCommandFailed, self).__init__('%s failed with %s'
+                % (description, reason))
+        self.description = description
+        self.reason = reason
+
+def find_power_script(power_type):
+    customised = '/etc/beaker/power-scripts/%s' % power_type
+    if os.path.exists(customised) and os.access(customised, os.X_OK):
+        return customised
+    resource = 'power-scripts/%s' % power_type
+    if pkg_resources.resource_exists('bkr.labcontroller', resource):
+        return pkg_resources.resource_filename('bkr.labcontroller', resource)
+    raise ValueError('Invalid power type %r' % power_type)
+
+def build_power_env(command):
+    env = dict(os.environ)
+    env['power_address'] = (command['power'].get('address') or u'').encode('utf8')
+    env['power_id'] = (command['power'].get('id') or u'').encode('utf8')
+    env['power_user'] = (command['power'].get('user') or u'').encode('utf8')
+    env['power_pass'] = (command['power'].get('passwd') or u'').encode('utf8')
+    env['power_mode'] = command['action'].encode('utf8')
+    return env
+
+class PowerDriver(object):
+    """
+    Base class for power drivers.
+    """
+
+    def attempt(self, command):
+        """
+        Makes one attempt at running the given power command. Raises
+        :class:`PowerCommandFailed` if it fails. The caller is responsible for
+        retrying.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class ScriptPowerDriver(PowerDriver):
+    """
+    Runs the given power script in a new process for each power command.
+    """
+
+    def __init__(self, script):
+        self.script = script
+
+    def attempt(self, command):
+        from bkr.labcontroller.async import MonitoredSubprocess
+        env = build_power_env(command)
+        logger.debug('Launching power script %s with env %r', self.script, env)
+        # N.B. the timeout value used here affects daemon shutdown time,
+        # make sure the init script is kept up to date!
+        p = MonitoredSubprocess([self.script], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                timeout=300)
+        logger.debug('Waiting on power script pid %s', p.pid)
+        p.dead.wait()
+        output = p.stdout_reader.get()
+        if p.returncode != 0:
+            raise PowerCommandFailed('Power script %s' % self.script,
+                    'exit status %s:\n%s' % (p.returncode, output[:150].strip()))
+        # TODO submit complete stdout and stderr?
+
+def run_in_thread(func, *args):
+    """
+    Calls func(*args) in gevent's thread pool, so that blocking library calls
+    do not hold up other greenlets.
+    """
+    return gevent.hub.get_hub().threadpool.apply(func, args)
+
+class SessionPowerDriver(PowerDriver):
+    """
+    Base class for drivers which keep a session open to each power controller
+    between power commands. Subclasses must implement :meth:`session_key`,
+    :meth:`connect`, :meth:`run` and :meth:`disconnect`.
+
+    Only one command at a time uses each session. A session is discarded if
+    a command fails on it, and is closed once it has been idle for
+    *idle_timeout* seconds.
+    """
+
+    name = None
+    idle_timeout = 300
+
+    def __init__(self):
+        self.sessions = {} #: dict of (key -> (session, time last used))
+        self.locks = {} #: dict of (key -> lock held while session is in use)
+
+    def session_key(self, power):
+        """
+        Returns a hashable key identifying the power controller to connect to
+        for the given power settings.
+        """
+        raise NotImplementedError()
+
+    def connect(self, power):
+        raise NotImplementedError()
+
+    def run(self, session, action, power):
+        raise NotImplementedError()
+
+    def disconnect(self, session):
+        raise NotImplementedError()
+
+    def attempt(self, command):
+        power = command['power']
+        key = self.session_key(power)
+        lock = self.locks.setdefault(key, gevent.lock.Semaphore())
+        with lock:
+            self._close_idle_sessions()
+            session = None
+            try:
+                if key in self.sessions:
+                    session, _ = self.sessions.pop(key)
+                else:
+                    logger.debug('Connecting to %s for power command %s',
+                            key, command['id'])
+                    session = self.connect(power)
+                self.run(session, command['action'], power)
+            except Exception, e:
+                logger.debug('Power command %s failed on %s', command['id'],
+                        key, exc_info=True)
+                if session is not None:
+                    self._disconnect_quietly(session)
+                raise PowerCommandFailed('Power driver %s' % self.name,
+                        'error: %s' % e)
+            self.sessions[key] = (session, time.time())
+
+    def _close_idle_sessions(self):
+        cutoff = time.time() - self.idle_timeout
+        for key, (session, last_used) in self.sessions.items():
+            if last_used < cutoff:
+                del self.sessions[key]
+                self._disconnect_quietly(session)
+
+    def _disconnect_quietly(self, session):
+        try:
+            self.disconnect(session)
+        except Exception:
+            logger.exception('Error closing power session')
+
+    def close(self):
+        for session, _ in self.sessions.values():
+            self._disconnect_quietly(session)
+        self.sessions.clear()
+
+class VirshPowerDriver(SessionPowerDriver):
+    """
+    In-process equivalent of the virsh power script, using the libvirt Python
+    bindings. The connection to each hypervisor is kept open between commands.
+    """
+
+    name = 'virsh'
+
+    def __init__(self):
+        import libvirt
+        self.libvirt = libvirt
+        super(VirshPowerDriver, self).__init__()
+
+    def session_key(self, power):
+        # Builds the same connection URI as the power script
+        address = power.get('address') or ''
+        if ':' in address:
+            driver, address = address.split(':', 1)
+            address = address.lstrip('/')
+        else:
+            driver = 'qemu'
+        username = ''
+        if power.get('user'):
+            username = '%s@' % power['user']
+            if not address:
+                address = 'localhost'
+        return '%s://%s%s/system' % (driver, username, address)
+
+    def connect(self, power):
+        return run_in_thread(self.libvirt.open, self.session_key(power))
+
+    def run(self, session, action, power):
+        if action == 'interrupt':
+            raise ValueError('interrupt not supported by virsh')
+        domain = run_in_thread(session.lookupByName, power.get('id') or '')
+        state, _ = run_in_thread(domain.state)
+        if action == 'on' and state == self.libvirt.VIR_DOMAIN_SHUTOFF:
+            run_in_thread(domain.create)
+        elif action == 'off' and state == self.libvirt.VIR_DOMAIN_RUNNING:
+            run_in_thread(domain.destroy)
+
+    def disconnect(self, session):
+        run_in_thread(session.close)
+
+_drivers = {}
+
+def get_power_driver(power_type):
+    """
+    Returns the driver for the given power type, loading it the first time.
+    """
+    if power_type in _drivers:
+        return _drivers[power_type]
+    script = find_power_script(power_type)
+    driver = None
+    if not script.startswith('/etc/beaker/power-scripts/'):
+        for entry_point in pkg_resources.iter_entry_points(
+                'bkr.labcontroller.power_drivers', power_type):
+            try:
+                driver = entry_point.load()()
+            except Exception, e:
+                logger.warning('Cannot load power driver %s, falling back to '
+                        'power script %s: %s', entry_point, script, e)
+                continue
+            logger.debug('Using power driver %s for power type %s',
+                    entry_point, power_type)
+            break
+    if driver is None:
+        driver = ScriptPowerDriver(script)
+    _drivers[power_type] = driver
+    return driver
+
+def close_power_drivers():
+    for driver in _drivers.values():
+        driver.close()
+    _drivers.clear()
+
+class PowerLimiter(object):
+    """
+    Limits how many power commands run at once in the whole lab, and against
+    each power address. Zero means no limit.
+    """
+
+    def __init__(self, max_total=0, max_per_address=0):
+        self.total = None
+        if max_total:
+            self.total = gevent.lock.BoundedSemaphore(max_total)
+        self.max_per_address = max_per_address
+        #: dict of (address -> [semaphore, number of users])
+        self.by_address = {}
+
+    @contextmanager
+    def limit(self, address):
+        address_entry = None
+        if address and self.max_per_address:
+            address_entry = self.by_address.setdefault(address,
+                    [gevent.lock.BoundedSemaphore(self.max_per_address), 0])
+            address_entry[1] += 1
+        try:
+            if address_entry is not None:
+                address_entry[0].acquire()
+            try:
+                if self.total is not None:
+                    self.total.acquire()
+                try:
+                    yield
+                finally:
+                    if self.total is not None:
+                        self.total.release()
+            finally:
+                if address_entry is not None:
+                    address_entry[0].release()
+        finally:
+            if address_entry is not None:
+                address_entry[1] -= 1
+                if not address_entry[1]:
+                    del self.by_address[address]
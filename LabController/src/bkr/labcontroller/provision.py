@@ -13,8 +13,6 @@
 import signal
 import daemon
 import datetime
-import pkg_resources
-import subprocess
 import xmlrpclib
 from daemon import pidfile
 from optparse import OptionParser
@@ -25,6 +23,8 @@
 from bkr.labcontroller.config import load_conf, get_conf
 from bkr.labcontroller.proxy import ProxyHelper
 from bkr.labcontroller import netboot
+from bkr.labcontroller.power import get_power_driver, close_power_drivers, \
+        PowerCommandFailed, PowerLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +35,17 @@ def __init__(self, *args, **kwargs):
         self.commands = {} #: dict of (id -> command info) for running commands
         self.greenlets = {} #: dict of (command id -> greenlet which is running it)
         self.last_command_datetime = {} # Last time a command was run against a system.
+        self.command_cursor = None #: cursor for get_new_queued_commands
+        self.last_full_poll = None #: time of the last full poll
+        self.new_commands_supported = True
+
+    def _protect_passwords(self, commands):
+        for command in commands:
+            # The 'is not None' check is important as we do not want to
+            # stringify the None type
+            if 'power' in command and 'passwd' in command['power'] and \
+                    command['power']['passwd'] is not None:
+                command['power']['passwd'] = SensitiveUnicode(command['power']['passwd'])
 
     def get_queued_commands(self):
         try:
@@ -46,14 +57,28 @@ def get_queued_commands(self):
                 commands = self.hub.labcontrollers.get_queued_command_details()
             else:
                 raise
-        for command in commands:
-            # The 'is not None' check is important as we do not want to
-            # stringify the None type
-            if 'power' in command and 'passwd' in command['power'] and \
-                    command['power']['passwd'] is not None:
-                command['power']['passwd'] = SensitiveUnicode(command['power']['passwd'])
+        self._protect_passwords(commands)
         return commands
 
+    def get_new_queued_commands(self):
+        """
+        Returns queued commands newer than the last ones we received.
+        """
+        try:
+            result = self.hub.labcontrollers.get_new_queued_command_details(
+                    self.command_cursor)
+        except xmlrpclib.Fault as fault:
+            if 'Anonymous access denied' in fault.faultString:
+                logger.debug('Session expired, re-authenticating')
+                self.hub._login()
+                result = self.hub.labcontrollers.get_new_queued_command_details(
+                        self.command_cursor)
+            else:
+                raise
+        self.command_cursor = result['cursor']
+        self._protect_passwords(result['commands'])
+        return result['commands']
+
     def get_running_command_ids(self):
         try:
             ids = self.hub.labcontrollers.get_running_command_ids()
@@ -88,11 +113,39 @@ def clear_orphaned_commands(self):
             self.mark_command_aborted(id, "Command orphaned, aborting")
 
     def poll(self):
-        logger.debug('Clearing orphaned commands')
-        self.clear_orphaned_commands()
-
-        logger.debug('Polling for queued commands')
-        for command in self.get_queued_commands():
+        """
+        Every SLEEP_TIME seconds this clears orphaned commands and fetches all 
+        queued commands. In between, it only fetches commands newer than the 
+        last ones we received, so that they are handled soon after they are 
+        queued.
+        """
+        sleep_time = self.conf.get('SLEEP_TIME', 20)
+        now = time.time()
+        if self.new_commands_supported and self.last_full_poll is not None \
+                and now - self.last_full_poll < sleep_time:
+            logger.debug('Polling for new queued commands')
+            try:
+                commands = self.get_new_queued_commands()
+            except xmlrpclib.Fault as fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.warning('Server does not support fetching new queued '
+                        'commands, falling back to full polls only')
+                self.new_commands_supported = False
+                return
+        else:
+            self.last_full_poll = now
+            logger.debug('Clearing orphaned commands')
+            self.clear_orphaned_commands()
+
+            logger.debug('Polling for queued commands')
+            commands = self.get_queued_commands()
+            # The full poll already covers these, so there is no need to 
+            # fetch them again.
+            if commands:
+                self.command_cursor = max(self.command_cursor,
+                        max(command['id'] for command in commands))
+        for command in commands:
             if command['id'] in self.commands:
                 # We've already seen it, ignore
                 continue
@@ -101,12 +154,9 @@ def poll(self):
             predecessors = [self.greenlets[c['id']]
                     for c in self.commands.itervalues()
                     if c['fqdn'] == command['fqdn']]
-            if 'power' in command and command['power'].get('address'):
-                # Also wait for other commands running against the same power address
-                predecessors.extend(self.greenlets[c['id']]
-                        for c in self.commands.itervalues()
-                        if 'power' in c and c['power'].get('address')
-                            == command['power']['address'])
+            # Commands against the same power address are limited by
+            # power_limiter in handle_power instead, so that they do not
+            # wait for each other's unrelated (netboot) commands.
             self.spawn_handler(command, predecessors)
 
     def spawn_handler(self, command, predecessors):
@@ -186,24 +236,6 @@ def handle(self, command, predecessors):
                 self.last_command_datetime[command['fqdn']] = datetime.datetime.utcnow()
         logger.debug('Finished handling command %s', command['id'])
 
-def find_power_script(power_type):
-    customised = '/etc/beaker/power-scripts/%s' % power_type
-    if os.path.exists(customised) and os.access(customised, os.X_OK):
-        return customised
-    resource = 'power-scripts/%s' % power_type
-    if pkg_resources.resource_exists('bkr.labcontroller', resource):
-        return pkg_resources.resource_filename('bkr.labcontroller', resource)
-    raise ValueError('Invalid power type %r' % power_type)
-
-def build_power_env(command):
-    env = dict(os.environ)
-    env['power_address'] = (command['power'].get('address') or u'').encode('utf8')
-    env['power_id'] = (command['power'].get('id') or u'').encode('utf8')
-    env['power_user'] = (command['power'].get('user') or u'').encode('utf8')
-    env['power_pass'] = (command['power'].get('passwd') or u'').encode('utf8')
-    env['power_mode'] = command['action'].encode('utf8')
-    return env
-
 def handle_clear_logs(conf, command):
     console_log = os.path.join(conf['CONSOLE_LOGS'], command['fqdn'])
     logger.debug('Truncating console log %s', console_log)
@@ -227,9 +259,7 @@ def handle_clear_netboot(command):
     netboot.clear_all(command['fqdn'])
 
 def handle_power(conf, command):
-    from bkr.labcontroller.async import MonitoredSubprocess
-    script = find_power_script(command['power']['type'])
-    env = build_power_env(command)
+    driver = get_power_driver(command['power']['type'])
     # We try the command up to 5 times, because some power commands
     # are flakey (apparently)...
     for attempt in range(1, conf['POWER_ATTEMPTS'] + 1):
@@ -243,34 +273,32 @@ def handle_power(conf, command):
                     delay, command['id'])
             if shutting_down.wait(timeout=delay):
                 break
-        logger.debug('Launching power script %s (attempt %s) with env %r',
-                script, attempt, env)
-        # N.B. the timeout value used here affects daemon shutdown time,
-        # make sure the init script is kept up to date!
-        p = MonitoredSubprocess([script], env=env,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                timeout=300)
-        logger.debug('Waiting on power script pid %s', p.pid)
-        p.dead.wait()
-        output = p.stdout_reader.get()
-        if p.returncode == 0 or shutting_down.is_set():
-            break
-    if p.returncode != 0:
-        sanitised_output = output[:150].strip()
-        if command['power'].get('passwd'):
-            sanitised_output = sanitised_output.replace(
-                    command['power']['passwd'], '********')
-        raise ValueError('Power script %s failed after %s attempts with exit status %s:\n%s'
-                % (script, attempt, p.returncode, sanitised_output))
-    # TODO submit complete stdout and stderr?
+        logger.debug('Running power command %s (attempt %s)',
+                command['id'], attempt)
+        with power_limiter.limit(command['power'].get('address')):
+            try:
+                driver.attempt(command)
+            except PowerCommandFailed, e:
+                failure = e
+                if shutting_down.is_set():
+                    break
+            else:
+                return
+    message = '%s failed after %s attempts with %s' % (failure.description,
+            attempt, failure.reason)
+    if command['power'].get('passwd'):
+        message = message.replace(command['power']['passwd'], '********')
+    raise ValueError(message)
 
 def shutdown_handler(signum, frame):
     logger.info('Received signal %s, shutting down', signum)
     shutting_down.set()
 
 def main_loop(poller=None, conf=None):
-    global shutting_down
+    global shutting_down, power_limiter
     shutting_down = gevent.event.Event()
+    power_limiter = PowerLimiter(conf.get('POWER_CONCURRENCY', 50),
+            conf.get('POWER_CONCURRENCY_PER_ADDRESS', 1))
     gevent.monkey.patch_all(thread=False)
 
     # define custom signal handlers
@@ -289,9 +317,14 @@ def main_loop(poller=None, conf=None):
             poller.poll()
         except:
             logger.exception('Failed to poll for queued commands')
-        if shutting_down.wait(timeout=conf.get('SLEEP_TIME', 20)):
+        if poller.new_commands_supported:
+            interval = conf.get('COMMAND_POLL_INTERVAL', 2)
+        else:
+            interval = conf.get('SLEEP_TIME', 20)
+        if shutting_down.wait(timeout=interval):
             gevent.hub.get_hub().join() # let running greenlets terminate
             break
+    close_power_drivers()
     logger.debug('Exited main provision loop')
 
 def main():
@@ -23,6 +23,8 @@
 import subprocess
 import pkg_resources
 import shlex
+import string
+import threading
 from cStringIO import StringIO
 from socket import gethostname
 from threading import Thread, Event
@@ -36,7 +38,10 @@
 from bkr.common.hub import HubProxy
 from bkr.common.xmlrpc import CookieTransport, SafeCookieTransport
 from bkr.labcontroller.config import get_conf
-from bkr.labcontroller.log_storage import LogStorage
+from bkr.labcontroller.log_storage import LogStorage, LogCompressor, \
+        COMPRESSED_SUFFIX
+from bkr.labcontroller.inotify import Inotify, IN_MODIFY, IN_CLOSE_WRITE, \
+        IN_CREATE, IN_MOVED_TO, IN_Q_OVERFLOW
 import utils
 try:
     #pylint: disable=E0611
@@ -49,6 +54,137 @@
 def replace_with_blanks(match):
     return ' ' * (match.end() - match.start() - 1) + '\n'
 
+_strip_ansi = re.compile("(\033\[[0-9;\?]*[ABCDHfsnuJKmhr])")
+# Replaces ASCII control characters other than tab and newline with spaces
+_strip_control_chars = ''.join(chr(c) for c in range(0, 32) + [127]
+        if chr(c) not in '\t\n')
+_strip_control_table = string.maketrans(_strip_control_chars,
+        ' ' * len(_strip_control_chars))
+
+def _first_candidate_line(prefilter, text):
+    """
+    Returns the index of the first line in text which might match, or None if 
+    no line can match. The prefilter is searched across the whole text in one 
+    pass, and every line which matches on its own is also matched by it.
+    """
+    match = prefilter.search(text)
+    if match is None:
+        return None
+    return text.count('\n', 0, match.start())
+
+class _BatchedCall(object):
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class _BatchedMethod(object):
+
+    def __init__(self, batcher, name):
+        self._batcher = batcher
+        self._name = name
+
+    def __getattr__(self, name):
+        return _BatchedMethod(self._batcher, '%s.%s' % (self._name, name))
+
+    def __call__(self, *params):
+        return self._batcher.call(self._name, *params)
+
+class BatchingHubProxy(object):
+    """
+    Wraps a HubProxy so that calls made through it are coalesced into bulk
+    calls to the server's recipes.tasks.bulk method. Only the methods listed in
+    the server's RecipeTasks.bulk_methods can be called this way.
+
+    Each caller still blocks until its own call has been applied, so that it
+    sees the return value or fault just as if it had called the hub directly.
+    There is no flush interval to wait for: a bulk call is sent as soon as the
+    previous one has finished, carrying every call made in the meantime. Only
+    one bulk call is in flight at a time and the server applies them in order,
+    so calls for the same task are never reordered.
+    """
+
+    #: Maximum number of calls sent in one bulk call.
+    max_batch_size = 100
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.bulk_supported = True
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flushing = False
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _BatchedMethod(self, name)
+
+    def call(self, method, *params):
+        call = _BatchedCall(method, params)
+        with self._lock:
+            self._pending.append(call)
+            start_flusher = not self._flushing
+            self._flushing = True
+        if start_flusher:
+            # Under beaker-proxy this is a greenlet, as threading is
+            # monkey-patched by gevent. It is started outside the lock because
+            # starting it may switch to another greenlet.
+            flusher = threading.Thread(target=self._flush_loop,
+                    name='batching_hub_flush')
+            flusher.daemon = True
+            flusher.start()
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                calls = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+                if not calls:
+                    self._flushing = False
+                    return
+            try:
+                self._send(calls)
+            except Exception, e:
+                for call in calls:
+                    call.error = e
+            for call in calls:
+                call.done.set()
+
+    def _send(self, calls):
+        if self.bulk_supported:
+            try:
+                outcomes = self.hub.recipes.tasks.bulk(
+                        [[call.method, list(call.params)] for call in calls])
+            except xmlrpclib.Fault, fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.warning('Server does not support bulk calls, '
+                        'sending harness calls individually')
+                self.bulk_supported = False
+            else:
+                for call, outcome in zip(calls, outcomes):
+                    if 'faultString' in outcome:
+                        call.error = xmlrpclib.Fault(outcome['faultCode'],
+                                outcome['faultString'])
+                    else:
+                        call.result = outcome['result']
+                return
+        for call in calls:
+            method = self.hub
+            for name in call.method.split('.'):
+                method = getattr(method, name)
+            try:
+                call.result = method(*call.params)
+            except Exception, e:
+                call.error = e
+
 
 class ProxyHelper(object):
 
@@ -72,10 +208,13 @@ def __init__(self, conf=None, hub=None, **kwargs):
         if self.hub is None:
             self.hub = HubProxy(logger=logging.getLogger('bkr.common.hub.HubProxy'), conf=self.conf,
                     **kwargs)
+        # Harness calls go through this, so that they are sent to the server 
+        # in bulk.
+        self.batched_hub = BatchingHubProxy(self.hub)
         self.log_storage = LogStorage(self.conf.get("CACHEPATH"),
                 "%s://%s/beaker/logs" % (self.conf.get('URL_SCHEME',
                 'http'), self.conf.get_url_domain()),
-                self.hub)
+                self.batched_hub)
 
     def close(self):
         if sys.version_info >= (2, 7):
@@ -115,7 +254,7 @@ def task_result(self,
                     result_summary=None):
         """ report a result to the scheduler """
         logger.debug("task_result %s", task_id)
-        return self.hub.recipes.tasks.result(task_id,
+        return self.batched_hub.recipes.tasks.result(task_id,
                                              result_type,
                                              result_path,
                                              result_score,
@@ -199,11 +338,6 @@ class ConsoleLogHelper(object):
     def __init__(self, watchdog, proxy, panic):
         self.watchdog = watchdog
         self.proxy = proxy
-        self.strip_ansi = re.compile("(\033\[[0-9;\?]*[ABCDHfsnuJKmhr])")
-        ascii_control_chars = map(chr, range(0, 32) + [127])
-        keep_chars = '\t\n'
-        strip_control_chars = [c for c in ascii_control_chars if c not in keep_chars]
-        self.strip_cntrl = re.compile('[%s]' % re.escape(''.join(strip_control_chars)))
         self.panic_detector = PanicDetector(panic)
         self.install_failure_detector = InstallFailureDetector()
         self.where = 0
@@ -223,10 +357,9 @@ def process_log(self, block):
         # We can't just strip the ansi codes, that would change the size
         # of the file, so whatever we end up stripping needs to be replaced
         # with spaces and a terminating \n.
-        if self.strip_ansi:
-            block = self.strip_ansi.sub(replace_with_blanks, block)
-        if self.strip_cntrl:
-            block = self.strip_cntrl.sub(' ', block)
+        if '\033' in block:
+            block = _strip_ansi.sub(replace_with_blanks, block)
+        block = block.translate(_strip_control_table)
         # Check for panics
         # Only feed the panic detector complete lines. If we have read a part 
         # of a line, store it in self.incomplete_line and it will be prepended 
@@ -238,6 +371,17 @@ def process_log(self, block):
             lines.append(self.incomplete_line)
             self.incomplete_line = ''
         if self.panic_detector:
+            # Search the whole block at once, and only check individual lines 
+            # from the first one which might match.
+            text = '\n'.join(lines)
+            candidates = [i for i in [
+                    self.panic_detector.first_candidate_line(text),
+                    self.install_failure_detector.first_candidate_line(text)]
+                    if i is not None]
+            if not candidates:
+                lines = []
+            else:
+                lines = lines[min(candidates):]
             for line in lines:
                 panic_found = self.panic_detector.feed(line)
                 if panic_found:
@@ -261,27 +405,53 @@ def process_log(self, block):
 
 class ConsoleWatchFile(ConsoleLogHelper):
 
+    #: Maximum number of bytes read and uploaded in one update.
+    max_read = ConsoleLogHelper.blocksize * 16
+
     def __init__(self, log, watchdog, proxy, panic):
         self.log = log
+        self.file = None
         super(ConsoleWatchFile, self).__init__(watchdog, proxy, panic)
 
-    def update(self):
+    def _open(self):
         """
-        If the log exists and the file has grown then upload the new piece
+        Returns the log, keeping it open between updates. It is re-opened if 
+        the file has been replaced since it was opened.
         """
         try:
-            file = open(self.log, "r")
-        except (OSError, IOError), e:
+            st = os.stat(self.log)
+        except OSError, e:
             if e.errno == errno.ENOENT:
-                return False # doesn't exist
-            else:
+                self.close()
+                return None # doesn't exist
+            raise
+        if self.file is not None and \
+                os.fstat(self.file.fileno()).st_ino != st.st_ino:
+            self.close()
+        if self.file is None:
+            try:
+                self.file = open(self.log, 'r')
+            except (OSError, IOError), e:
+                if e.errno == errno.ENOENT:
+                    return None
                 raise
-        try:
-            file.seek(self.where)
-            block = file.read(self.blocksize)
-            now = file.tell()
-        finally:
-            file.close()
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def update(self):
+        """
+        If the log exists and the file has grown then upload the new piece
+        """
+        file = self._open()
+        if file is None:
+            return False
+        file.seek(self.where)
+        block = file.read(self.max_read)
+        now = file.tell()
         if not block:
             return False # nothing new has been read
         self.process_log(block)
@@ -322,13 +492,22 @@ def update(self):
         self.where = now
         return True
 
+    def close(self):
+        pass
+
 
 class PanicDetector(object):
 
     def __init__(self, pattern):
         self.pattern = re.compile(pattern)
+        self.prefilter = re.compile(pattern, re.MULTILINE)
         self.fired = False
 
+    def first_candidate_line(self, text):
+        if self.fired:
+            return None
+        return _first_candidate_line(self.prefilter, text)
+
     def feed(self, line):
         if self.fired:
             return
@@ -341,19 +520,45 @@ def feed(self, line):
 
 class InstallFailureDetector(object):
 
+    # The patterns are loaded once and shared by all instances.
+    _patterns = None
+    _prefilter = None
+
     def __init__(self):
-        self.patterns = []
-        for raw_pattern in self._load_patterns():
+        if InstallFailureDetector._patterns is None:
+            self._compile_patterns()
+        self.patterns = InstallFailureDetector._patterns
+        self.prefilter = InstallFailureDetector._prefilter
+        self.fired = False
+
+    @classmethod
+    def _compile_patterns(cls):
+        patterns = []
+        for raw_pattern in cls._load_patterns():
             pattern = re.compile(raw_pattern)
             # If the pattern is empty, it is either a mistake or the admin is 
             # trying to override a package pattern to disable it. Either way, 
             # exclude it from the list.
             if pattern.search(''):
                 continue
-            self.patterns.append(pattern)
-        self.fired = False
-
-    def _load_patterns(self):
+            patterns.append(pattern)
+        # All patterns combined into one, for searching a block of lines in 
+        # a single pass. Inline flags would apply to the whole combined 
+        # pattern, so in that case (or if it is too big to compile) every 
+        # line is checked against each pattern instead.
+        prefilter = None
+        if patterns and not any(pattern.flags for pattern in patterns):
+            try:
+                prefilter = re.compile('|'.join('(?:%s)' % pattern.pattern
+                        for pattern in patterns), re.MULTILINE)
+            except (re.error, AssertionError, OverflowError):
+                logger.warning('Cannot combine install failure patterns, '
+                        'checking them individually')
+        cls._patterns = patterns
+        cls._prefilter = prefilter
+
+    @staticmethod
+    def _load_patterns():
         site_dir = '/etc/beaker/install-failure-patterns'
         try:
             site_patterns = os.listdir(site_dir)
@@ -382,6 +587,13 @@ def _load_patterns(self):
                     'install-failure-patterns/' + p))
         return patterns
 
+    def first_candidate_line(self, text):
+        if self.fired or not self.patterns:
+            return None
+        if self.prefilter is None:
+            return 0
+        return _first_candidate_line(self.prefilter, text)
+
     def feed(self, line):
         if self.fired:
             return
@@ -395,6 +607,16 @@ def feed(self, line):
 class Watchdog(ProxyHelper):
 
     watchdogs = dict()
+    #: cursor from the last call to recipes.tasks.watchdog_changes
+    watchdogs_cursor = None
+    watchdog_changes_supported = True
+    files_many_supported = True
+
+    def __init__(self, *args, **kwargs):
+        super(Watchdog, self).__init__(*args, **kwargs)
+        #: list of (time due, recipe ID) for finished recipes whose logs are 
+        #: to be compressed
+        self.logs_to_compress = []
 
     def get_active_watchdogs(self):
         logger.debug('Polling for active watchdogs')
@@ -408,6 +630,53 @@ def get_active_watchdogs(self):
             else:
                 raise
 
+    def get_active_watchdog_changes(self):
+        logger.debug('Polling for changes to active watchdogs')
+        try:
+            return self.hub.recipes.tasks.watchdog_changes(
+                    self.watchdogs_cursor, 'active')
+        except xmlrpclib.Fault as fault:
+            if 'not currently logged in' in fault.faultString:
+                logger.debug('Session expired, re-authenticating')
+                self.hub._login()
+                return self.hub.recipes.tasks.watchdog_changes(
+                        self.watchdogs_cursor, 'active')
+            else:
+                raise
+
+    def update_active_watchdogs(self):
+        """
+        Brings our monitors up to date with the active watchdogs on the 
+        server, fetching only what has changed since the last update.
+        """
+        if self.watchdog_changes_supported:
+            try:
+                changes = self.get_active_watchdog_changes()
+            except xmlrpclib.Fault as fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.warning('Server does not support watchdog changes, '
+                        'polling for all active watchdogs instead')
+                self.watchdog_changes_supported = False
+            else:
+                self.apply_watchdog_changes(changes)
+                return
+        self.active_watchdogs(self.get_active_watchdogs())
+
+    def apply_watchdog_changes(self, changes):
+        if changes['full']:
+            self.active_watchdogs(changes['added'])
+        else:
+            logger.info('Watchdog changes: %d added, %d removed',
+                    len(changes['added']), len(changes['removed']))
+            removed = set(changes['removed'])
+            for watchdog_key, monitor in self.watchdogs.items():
+                if monitor.watchdog['recipe_id'] in removed:
+                    self.purge_old_watchdog(watchdog_key)
+                    logger.info("Removed Monitor for %s", watchdog_key)
+            self.active_watchdogs(changes['added'], purge=False)
+        self.watchdogs_cursor = changes['cursor']
+
     def get_expired_watchdogs(self):
         logger.debug('Polling for expired watchdogs')
         try:
@@ -421,68 +690,161 @@ def get_expired_watchdogs(self):
                 raise
 
     def transfer_logs(self):
-        transfered = False
         server = self.conf.get_url_domain()
+        limit = self.conf.get('TRANSFER_BATCH_SIZE', 50)
         logger.debug('Polling for recipes to be transferred')
         try:
-            recipe_ids = self.hub.recipes.by_log_server(server)
+            recipe_ids = self.hub.recipes.by_log_server(server, limit)
         except xmlrpclib.Fault as fault:
             if 'Anonymous access denied' in fault.faultString:
                 logger.debug('Session expired, re-authenticating')
                 self.hub._login()
-                recipe_ids = self.hub.recipes.by_log_server(server)
+                recipe_ids = self.hub.recipes.by_log_server(server, limit)
             else:
                 raise
-        for recipe_id in recipe_ids:
-            transfered = True
-            self.transfer_recipe_logs(recipe_id)
-        return transfered
+        if not recipe_ids:
+            return False
+        self.transfer_recipes_logs(recipe_ids)
+        return True
 
     def transfer_recipe_logs(self, recipe_id):
         """ If Cache is turned on then move the recipes logs to their final place
         """
-        tmpdir = tempfile.mkdtemp(dir=self.conf.get("CACHEPATH"))
+        self.transfer_recipes_logs([recipe_id])
+
+    def transfer_recipes_logs(self, recipe_ids):
+        """
+        Moves the logs for the given recipes to the archive server.
+
+        The recipes are split into at most TRANSFER_CONCURRENCY groups. The 
+        logs for each group are hard-linked into a temporary tree and copied 
+        by one rsync, with the rsyncs for all groups running at once. Returns 
+        the IDs of the recipes which were transferred.
+        """
+        start = time.time()
+        logger.debug('Fetching files lists for recipes %r', recipe_ids)
+        recipe_logs = self.get_recipe_files(recipe_ids)
+        concurrency = max(1, self.conf.get('TRANSFER_CONCURRENCY', 4))
+        groups = [recipe_ids[i::concurrency] for i in range(concurrency)]
+        batches = []
         try:
-            # Move logs to tmp directory layout
-            logger.debug('Fetching files list for recipe %s', recipe_id)
-            mylogs = self.hub.recipes.files(recipe_id)
-            trlogs = []
-            logger.debug('Building temporary log tree for transfer under %s', tmpdir)
-            for mylog in mylogs:
-                mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
-                mydst = '%s/%s/%s/%s' % (tmpdir, mylog['filepath'], 
-                                          mylog['path'], mylog['filename'])
-                if os.path.exists(mysrc):
-                    if not os.path.exists(os.path.dirname(mydst)):
-                        os.makedirs(os.path.dirname(mydst))
-                    try:
-                        os.link(mysrc,mydst)
-                        trlogs.append(mylog)
-                    except OSError, e:
-                        logger.exception('Error hard-linking %s to %s', mysrc, mydst)
-                        return
-                else:
-                    logger.warn('Recipe %s file %s missing on disk, ignoring',
-                            recipe_id, mysrc)
+            for group in groups:
+                if not group:
+                    continue
+                tmpdir = tempfile.mkdtemp(dir=self.conf.get("CACHEPATH"))
+                # Logs linked into tmpdir, by recipe ID
+                linked = {}
+                batches.append((tmpdir, linked))
+                logger.debug('Building temporary log tree for transfer under %s', tmpdir)
+                for recipe_id in group:
+                    logs = self.link_recipe_logs(tmpdir, recipe_id,
+                            recipe_logs[recipe_id])
+                    if logs is not None:
+                        linked[recipe_id] = logs
             # rsync the logs to their new home
-            rsync_succeeded  = self.rsync('%s/' % tmpdir, '%s' % self.conf.get("ARCHIVE_RSYNC"))
-            if not rsync_succeeded:
-                return
+            rsyncs = [(batch_linked, self.start_rsync('%s/' % batch_dir,
+                        '%s' % self.conf.get("ARCHIVE_RSYNC")))
+                    for batch_dir, batch_linked in batches if batch_linked]
+            transferred = {}
+            for batch_linked, rsync in rsyncs:
+                if self.wait_rsync(*rsync):
+                    transferred.update(batch_linked)
+            if not transferred:
+                return []
             # if the logs have been transferred then tell the server the new location
-            logger.debug('Updating recipe %s file locations on the server', recipe_id)
-            self.hub.recipes.change_files(recipe_id, self.conf.get("ARCHIVE_SERVER"),
-                                                     self.conf.get("ARCHIVE_BASEPATH"))
-            for mylog in trlogs:
-                mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
-                self.rm(mysrc)
-                try:
-                    self.removedirs('%s/%s' % (mylog['basepath'], mylog['path']))
-                except OSError:
-                    # It's ok if it fails, dir may not be empty yet
-                    pass
+            logger.debug('Updating recipes %r file locations on the server',
+                    sorted(transferred))
+            self.change_recipe_files(sorted(transferred))
+            num_files = num_bytes = 0
+            for logs in transferred.itervalues():
+                for mylog in logs:
+                    mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+                    num_files += 1
+                    for path in [mysrc, mysrc + COMPRESSED_SUFFIX]:
+                        if os.path.exists(path):
+                            num_bytes += os.path.getsize(path)
+                        self.rm(path)
+                    try:
+                        self.removedirs('%s/%s' % (mylog['basepath'], mylog['path']))
+                    except OSError:
+                        # It's ok if it fails, dir may not be empty yet
+                        pass
+            elapsed = time.time() - start
+            logger.info('Transferred logs for %d of %d recipes '
+                    '(%d files, %d bytes) in %.1f seconds, %.1f recipes/second',
+                    len(transferred), len(recipe_ids), num_files, num_bytes,
+                    elapsed, len(transferred) / max(elapsed, 0.001))
+            return sorted(transferred)
         finally:
-            # get rid of our tmpdir.
-            shutil.rmtree(tmpdir)
+            # get rid of our tmpdirs.
+            for batch_dir, _ in batches:
+                shutil.rmtree(batch_dir)
+
+    def get_recipe_files(self, recipe_ids):
+        """
+        Returns a dict of (recipe ID -> list of logs) for the given recipes, 
+        fetched from the server in one call if it supports that.
+        """
+        if self.files_many_supported:
+            try:
+                recipe_logs = self.hub.recipes.files_many(recipe_ids)
+            except xmlrpclib.Fault as fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.warning('Server does not support recipes.files_many, '
+                        'fetching files lists one recipe at a time')
+                self.files_many_supported = False
+            else:
+                return dict((int(recipe_id), logs)
+                        for recipe_id, logs in recipe_logs.iteritems())
+        return dict((recipe_id, self.hub.recipes.files(recipe_id))
+                for recipe_id in recipe_ids)
+
+    def change_recipe_files(self, recipe_ids):
+        archive_server = self.conf.get("ARCHIVE_SERVER")
+        archive_basepath = self.conf.get("ARCHIVE_BASEPATH")
+        if self.files_many_supported:
+            self.hub.recipes.change_files_many(recipe_ids, archive_server,
+                    archive_basepath)
+        else:
+            for recipe_id in recipe_ids:
+                self.hub.recipes.change_files(recipe_id, archive_server,
+                        archive_basepath)
+
+    def link_recipe_logs(self, tmpdir, recipe_id, logs):
+        """
+        Hard-links the recipe's logs into the transfer tree under tmpdir. 
+        Returns the logs which were linked, or None if linking failed (in 
+        which case none of the recipe's logs are left in the tree).
+        """
+        linked = []
+        links = []
+        for mylog in logs:
+            mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+            mydst = '%s/%s/%s/%s' % (tmpdir, mylog['filepath'], 
+                                      mylog['path'], mylog['filename'])
+            # Logs are shipped in whichever form is on disk. Ones which the 
+            # compressor has not got to yet are shipped uncompressed, rather 
+            # than holding up the transfer to compress them here.
+            if os.path.exists(mysrc + COMPRESSED_SUFFIX):
+                mysrc += COMPRESSED_SUFFIX
+                mydst += COMPRESSED_SUFFIX
+            if os.path.exists(mysrc):
+                if not os.path.exists(os.path.dirname(mydst)):
+                    os.makedirs(os.path.dirname(mydst))
+                try:
+                    os.link(mysrc,mydst)
+                    links.append(mydst)
+                    linked.append(mylog)
+                except OSError, e:
+                    logger.exception('Error hard-linking %s to %s', mysrc, mydst)
+                    for link in links:
+                        os.unlink(link)
+                    return None
+            else:
+                logger.warn('Recipe %s file %s missing on disk, ignoring',
+                        recipe_id, mysrc)
+        return linked
 
     def rm(self, src):
         """ remove src
@@ -501,21 +863,82 @@ def removedirs(self, path):
     def rsync(self, src, dst):
         """ Run system rsync command to move files
         """
+        return self.wait_rsync(*self.start_rsync(src, dst))
+
+    def start_rsync(self, src, dst):
+        """
+        Starts rsync copying src to dst, without waiting for it. Returns 
+        arguments to pass to :meth:`wait_rsync`.
+        """
         args = ['rsync'] + shlex.split(self.conf.get('RSYNC_FLAGS', '')) + [src, dst]
         logger.debug('Invoking rsync as %r', args)
-        p = subprocess.Popen(args, stderr=subprocess.PIPE)
-        out, err = p.communicate()
+        # stderr goes to a file rather than a pipe, so that several rsyncs can 
+        # run at once without blocking on a full pipe while we wait for 
+        # another one.
+        err = tempfile.TemporaryFile()
+        p = subprocess.Popen(args, stderr=err)
+        return p, err, src, dst
+
+    def wait_rsync(self, p, err, src, dst):
+        p.wait()
+        err.seek(0)
+        stderr = err.read()
+        err.close()
         if p.returncode != 0:
             logger.error('Failed to rsync recipe logs from %s to %s\nExit status: %s\n%s',
-                    src, dst, p.returncode, err)
+                    src, dst, p.returncode, stderr)
             return False
         return True
 
     def purge_old_watchdog(self, watchdog_systems):
         try:
-            del self.watchdogs[watchdog_systems]
+            monitor = self.watchdogs.pop(watchdog_systems)
         except KeyError, e:
             logger.error('Trying to remove a watchdog that is already removed')
+        else:
+            monitor.close()
+            if self.conf.get('COMPRESS_LOGS'):
+                # The recipe has finished, but the system may keep uploading 
+                # logs for a short while, so we wait before compressing them.
+                self.logs_to_compress.append((time.time()
+                        + self.conf.get('COMPRESS_LOGS_DELAY', 300),
+                        monitor.watchdog['recipe_id']))
+
+    #: LogCompressor thread, started when it is first needed
+    log_compressor = None
+
+    def compress_finished_logs(self):
+        """
+        Hands the logs of finished recipes to the background compressor, once 
+        the delay after they finished has passed.
+        """
+        now = time.time()
+        due = [recipe_id for due_time, recipe_id in self.logs_to_compress
+                if due_time <= now]
+        if not due:
+            return
+        self.logs_to_compress = [(due_time, recipe_id)
+                for due_time, recipe_id in self.logs_to_compress
+                if due_time > now]
+        if self.log_compressor is None:
+            # Started lazily, because the daemon context does not preserve 
+            # threads when it detaches.
+            self.log_compressor = LogCompressor()
+            self.log_compressor.start()
+        for recipe_id in due:
+            try:
+                logs = self.hub.recipes.files(recipe_id)
+            except xmlrpclib.Fault:
+                logger.exception('Failed to fetch logs to compress for recipe %s',
+                        recipe_id)
+                continue
+            # Logs which have already moved to the archive server are not 
+            # under our cache path any more.
+            cache_path = os.path.normpath(self.conf.get('CACHEPATH'))
+            self.log_compressor.compress(
+                    '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+                    for mylog in logs
+                    if os.path.normpath(mylog['basepath']).startswith(cache_path))
 
     def expire_watchdogs(self, watchdogs):
         """Clear out expired watchdog entries"""
@@ -545,18 +968,80 @@ def active_watchdogs(self, watchdogs, purge=True):
                     self.purge_old_watchdog(watchdog_system)
                     logger.info("Removed Monitor for %s", watchdog_system)
 
+    #: inotify instance watching CONSOLE_LOGS, or None if not available
+    console_notifier = None
+    _console_notifier_failed = False
+
+    def _get_console_notifier(self):
+        # Created lazily, because the daemon closes all file descriptors 
+        # when it detaches.
+        if self.console_notifier is None and not self._console_notifier_failed:
+            try:
+                notifier = Inotify()
+                try:
+                    notifier.add_watch(self.conf['CONSOLE_LOGS'],
+                            IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO)
+                except Exception:
+                    notifier.close()
+                    raise
+            except OSError, e:
+                logger.warning('Cannot watch %s for changes, console logs '
+                        'will be polled instead: %s', self.conf['CONSOLE_LOGS'], e)
+                self._console_notifier_failed = True
+            else:
+                self.console_notifier = notifier
+        return self.console_notifier
+
+    def _changed_console_logs(self):
+        """
+        Returns the names of console logs which have been written to since the 
+        last call, or None if all of them should be checked.
+        """
+        notifier = self._get_console_notifier()
+        if notifier is None:
+            return None
+        changed = set()
+        for wd, mask, name in notifier.read_events():
+            if mask & IN_Q_OVERFLOW:
+                return None
+            changed.add(name)
+        return changed
+
     def run(self):
         updated = False
+        changed = self._changed_console_logs()
+        now = time.time()
+        sleep_time = self.conf.get('SLEEP_TIME', 20)
         for monitor in self.watchdogs.values():
+            if isinstance(monitor.console_watch, ConsoleWatchFile):
+                # Monitors are only run if their console log has changed, or 
+                # if they had more to read last time.
+                if changed is not None and not monitor.pending and \
+                        os.path.basename(monitor.console_watch.log) not in changed:
+                    continue
+            else:
+                # Virt monitors have no log file to watch, and fetching their 
+                # console is an OpenStack API call, so they are only run every 
+                # SLEEP_TIME no matter how often console writes wake us up.
+                if monitor.last_run is not None and \
+                        now - monitor.last_run < sleep_time:
+                    continue
+                monitor.last_run = now
             try:
-                updated |= monitor.run()
+                monitor.pending = monitor.run()
+                updated |= monitor.pending
             except (xmlrpclib.Fault, OSError):
                 logger.exception('Failed to run monitor for %s', monitor.watchdog['system'])
         return bool(updated)
 
     def sleep(self):
-        # Sleep between polling
-        time.sleep(self.conf.get("SLEEP_TIME", 20))
+        # Sleep between polling, waking up early if a console log is written
+        timeout = self.conf.get("SLEEP_TIME", 20)
+        notifier = self._get_console_notifier()
+        if notifier is None:
+            time.sleep(timeout)
+        else:
+            notifier.wait(timeout)
 
     def abort(self, watchdog):
         """ Abort expired watchdog entry
@@ -603,6 +1088,11 @@ def __init__(self, watchdog, obj, *args, **kwargs):
         self.hub = obj.hub
         self.log_storage = obj.log_storage
         logger.info("Initialize monitor for system: %s", self.watchdog['system'])
+        #: True if the console log should be checked on the next run
+        self.pending = True
+        #: time of the last run, used to limit how often virt consoles are 
+        #: fetched
+        self.last_run = None
         if(self.watchdog['is_virt_recipe']):
             self.console_watch = ConsoleWatchVirt(
                     self.watchdog, self, self.conf["PANIC_REGEX"])
@@ -616,6 +1106,9 @@ def run(self):
         """
         return self.console_watch.update()
 
+    def close(self):
+        self.console_watch.close()
+
     def report_panic(self, watchdog, panic_message):
         logger.info('Panic detected for recipe %s on system %s: '
                 'console log contains string %r', watchdog['recipe_id'],
@@ -672,6 +1165,17 @@ def report_install_failure(self, watchdog, failure_message):
             self.task_result(first_task()['id'], 'fail', '/', 0, failure_message)
             self.recipe_stop(recipe()['id'], 'abort', 'Installation failed')
 
+def _read_range(f, length, chunk_size=65536):
+    try:
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
 class Proxy(ProxyHelper):
     def task_upload_file(self, 
                          task_id, 
@@ -841,6 +1345,7 @@ class ProxyHTTP(object):
 
     def __init__(self, proxy):
         self.hub = proxy.hub
+        self.batched_hub = proxy.batched_hub
         self.log_storage = proxy.log_storage
 
     def get_recipe(self, req, recipe_id):
@@ -864,7 +1369,7 @@ def post_result(self, req, recipe_id, task_id):
         if result not in self._result_types:
             raise BadRequest('Unknown result type %r' % req.form['result'])
         try:
-            result_id = self.hub.recipes.tasks.result(task_id,
+            result_id = self.batched_hub.recipes.tasks.result(task_id,
                     self._result_types[result],
                     req.form.get('path'), req.form.get('score'),
                     req.form.get('message'))
@@ -903,11 +1408,11 @@ def _update_status(self, task_id, status, message):
             raise BadRequest('Unknown status %r' % status)
         try:
             if status == 'running':
-                self.hub.recipes.tasks.start(task_id)
+                self.batched_hub.recipes.tasks.start(task_id)
             elif status == 'completed':
-                self.hub.recipes.tasks.stop(task_id, 'stop')
+                self.batched_hub.recipes.tasks.stop(task_id, 'stop')
             elif status == 'aborted':
-                self.hub.recipes.tasks.stop(task_id, 'abort', message)
+                self.batched_hub.recipes.tasks.stop(task_id, 'abort', message)
         except xmlrpclib.Fault, fault:
             # XXX need to find a less fragile way to do this
             if 'Cannot restart finished task' in fault.faultString:
@@ -929,7 +1434,7 @@ def patch_task(self, request, recipe_id, task_id):
             # we will avoid making a second XML-RPC call.
             updated = {'status': status}
         if data:
-            updated = self.hub.recipes.tasks.update(task_id, data)
+            updated = self.batched_hub.recipes.tasks.update(task_id, data)
         return Response(status=200, response=json.dumps(updated),
                 content_type='application/json')
 
@@ -946,12 +1451,9 @@ def post_watchdog(self, req, recipe_id):
             seconds = int(req.form['seconds'])
         except ValueError:
             raise BadRequest('Invalid "seconds" parameter %r' % req.form['seconds'])
-        self.hub.recipes.extend(recipe_id, seconds)
+        self.batched_hub.recipes.extend(recipe_id, seconds)
         return Response(status=204)
 
-    # XXX should do streaming here, so that clients can send
-    # big files without chunking
-
     def _put_log(self, log_file, req):
         if req.content_length is None:
             raise LengthRequired()
@@ -964,14 +1466,20 @@ def _put_log(self, log_file, req):
                 raise BadRequest('Total length is smaller than range end')
         try:
             with log_file:
+                # The request body is streamed straight to disk, so that 
+                # clients can send big files without chunking them.
                 if content_range:
                     if content_range.length: # length may be '*' meaning unspecified
                         log_file.truncate(content_range.length)
-                    log_file.update_chunk(req.data, content_range.start)
+                    written = log_file.update_from_stream(req.stream,
+                            content_range.start, req.content_length)
                 else:
                     # no Content-Range, therefore the request is the whole file
                     log_file.truncate(req.content_length)
-                    log_file.update_chunk(req.data, 0)
+                    written = log_file.update_from_stream(req.stream, 0,
+                            req.content_length)
+                if written != req.content_length:
+                    raise BadRequest('Request body is shorter than Content-Length')
         # XXX need to find a less fragile way to do this
         except xmlrpclib.Fault, fault:
             if 'Cannot register file for finished ' in fault.faultString:
@@ -992,8 +1500,28 @@ def _get_log(self, log_file, req):
                 raise NotFound()
             else:
                 raise
-        return Response(status=200, response=wrap_file(req.environ, f),
-                content_type='text/plain', direct_passthrough=True)
+        # Logs compressed at rest are served uncompressed, so the length and 
+        # any requested range refer to the uncompressed log.
+        f.seek(0, os.SEEK_END)
+        length = f.tell()
+        f.seek(0)
+        byte_range = None
+        if req.range:
+            # If the range is not one we can satisfy, we ignore it and send 
+            # the whole log, which HTTP allows.
+            byte_range = req.range.range_for_length(length)
+        if byte_range is None:
+            return Response(status=200, response=wrap_file(req.environ, f),
+                    content_type='text/plain', direct_passthrough=True,
+                    headers=[('Content-Length', str(length)),
+                             ('Accept-Ranges', 'bytes')])
+        start, stop = byte_range
+        f.seek(start)
+        return Response(status=206, response=_read_range(f, stop - start),
+                content_type='text/plain', direct_passthrough=True,
+                headers=[('Content-Length', str(stop - start)),
+                         ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, length)),
+                         ('Accept-Ranges', 'bytes')])
 
     def do_recipe_log(self, req, recipe_id, path):
         log_file = self.log_storage.recipe(recipe_id, path)
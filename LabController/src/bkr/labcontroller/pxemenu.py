@@ -10,11 +10,13 @@
 import errno
 import xmlrpclib
 import shutil
-import urllib2
 import urlparse
 import contextlib
 from optparse import OptionParser
-from bkr.common.helpers import atomically_replaced_file, siphon, makedirs_ignore, atomic_symlink
+from multiprocessing.pool import ThreadPool
+from bkr.common.helpers import atomically_replaced_file, makedirs_ignore, \
+        atomic_symlink, atomic_link
+from bkr.labcontroller.netboot import ImageCache
 from jinja2 import Environment, PackageLoader
 
 def _get_url(available):
@@ -37,6 +39,9 @@ def _group_distro_trees(distro_trees):
 def _get_images(tftp_root, distro_tree_id, url, images):
     dest_dir = os.path.join(tftp_root, 'distrotrees', str(distro_tree_id))
     makedirs_ignore(dest_dir, mode=0755)
+    # Images are fetched through the same cache used by beaker-provision, so 
+    # that each one is only downloaded once.
+    image_cache = ImageCache(os.path.join(tftp_root, 'cache'))
     for image_type, path in images:
         if image_type in ('kernel', 'initrd'):
             dest_path = os.path.join(dest_dir, image_type)
@@ -45,25 +50,31 @@ def _get_images(tftp_root, distro_tree_id, url, images):
             else:
                 image_url = urlparse.urljoin(url, path)
                 print 'Fetching %s %s for distro tree %s' % (image_type, image_url, distro_tree_id)
-                with atomically_replaced_file(dest_path) as dest:
-                    siphon(urllib2.urlopen(image_url), dest)
+                atomic_link(image_cache.fetch(distro_tree_id, image_url), dest_path)
 
-def _get_all_images(tftp_root, distro_trees):
+def _get_all_images(tftp_root, distro_trees, parallel=4):
     """
     Fetch all images for the given distro trees and return a new list of distro
-    trees for which image can be fetched.
+    trees for which image can be fetched. Up to *parallel* distro trees are 
+    fetched at once.
     """
-    trees = []
-    for distro_tree in distro_trees:
-         url = _get_url(distro_tree['available'])
-         try:
-             _get_images(tftp_root, distro_tree['distro_tree_id'],
-                     url, distro_tree['images'])
-             trees.append(distro_tree)
-         except IOError, e:
-             sys.stderr.write('Error fetching images for distro tree %s: %s\n' %
-                     (distro_tree['distro_tree_id'], e))
-    return trees
+    def get_images(distro_tree):
+        url = _get_url(distro_tree['available'])
+        try:
+            _get_images(tftp_root, distro_tree['distro_tree_id'],
+                    url, distro_tree['images'])
+            return True
+        except IOError, e:
+            sys.stderr.write('Error fetching images for distro tree %s: %s\n' %
+                    (distro_tree['distro_tree_id'], e))
+            return False
+    pool = ThreadPool(max(parallel, 1))
+    try:
+        fetched = pool.map(get_images, distro_trees)
+    finally:
+        pool.close()
+        pool.join()
+    return [distro_tree for distro_tree, ok in zip(distro_trees, fetched) if ok]
 
 # configure Jinja2 to load menu templates
 template_env = Environment(loader=PackageLoader('bkr.labcontroller', 'pxemenu-templates'),
@@ -76,7 +87,7 @@ def write_menu(menu, template_name, distro_trees):
         template = template_env.get_template(template_name)
         menu.write(template.render({'osmajors': osmajors}))
 
-def write_menus(tftp_root, tags, xml_filter):
+def write_menus(tftp_root, tags, xml_filter, parallel=4):
     # The order of steps for cleaning images is important,
     # to avoid races and to avoid deleting stuff we shouldn't:
     # first read the directory,
@@ -104,7 +115,7 @@ def write_menus(tftp_root, tags, xml_filter):
 
     # Fetch images for all the distro trees first.
     print 'Fetching images for all the distro trees'
-    distro_trees = _get_all_images(tftp_root, distro_trees)
+    distro_trees = _get_all_images(tftp_root, distro_trees, parallel)
 
     x86_distrotrees = [distro for distro in distro_trees if distro['arch'] in ['x86_64', 'i386']]
     print 'Generating PXELINUX menus for %s distro trees' % len(x86_distrotrees)
@@ -143,6 +154,8 @@ def main():
     parser.add_option('--tftp-root', metavar='DIR',
             default='/var/lib/tftpboot',
             help='Path to TFTP root directory [default: %default]')
+    parser.add_option('--parallel', metavar='N', type='int', default=4,
+            help='Fetch images for up to N distro trees at once [default: %default]')
     parser.add_option('-q', '--quiet', action='store_true',
             help='Suppress informational output')
     (opts, args) = parser.parse_args()
@@ -150,7 +163,7 @@ def main():
         parser.error('This command does not accept any arguments')
     if opts.quiet:
         os.dup2(os.open('/dev/null', os.O_WRONLY), 1)
-    write_menus(opts.tftp_root, opts.tags, opts.xml_filter)
+    write_menus(opts.tftp_root, opts.tags, opts.xml_filter, opts.parallel)
     return 0
 
 if __name__ == '__main__':
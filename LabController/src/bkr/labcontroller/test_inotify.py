@@ -0,0 +1,36 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os, os.path
+import shutil
+import tempfile
+import unittest2 as unittest
+from bkr.labcontroller.inotify import Inotify, IN_MODIFY, IN_CREATE
+
+class InotifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.notifier = Inotify()
+        self.addCleanup(self.notifier.close)
+        self.notifier.add_watch(self.dir, IN_MODIFY | IN_CREATE)
+
+    def test_no_events(self):
+        self.assertFalse(self.notifier.wait(0))
+        self.assertEquals(self.notifier.read_events(), [])
+
+    def test_events_for_written_files(self):
+        with open(os.path.join(self.dir, 'a.example.com'), 'w') as f:
+            f.write('hello\n')
+        with open(os.path.join(self.dir, 'b.example.com'), 'w') as f:
+            f.write('hello\n')
+        self.assertTrue(self.notifier.wait(5))
+        events = self.notifier.read_events()
+        self.assertEquals(set(name for wd, mask, name in events),
+                set(['a.example.com', 'b.example.com']))
+        self.assertTrue(any(mask & IN_CREATE for wd, mask, name in events))
+        self.assertTrue(any(mask & IN_MODIFY for wd, mask, name in events))
+        self.assertEquals(self.notifier.read_events(), [])
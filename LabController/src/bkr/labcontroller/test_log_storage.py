@@ -4,8 +4,13 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import os.path
 import unittest
-from bkr.labcontroller.log_storage import LogStorage
+import shutil
+import tempfile
+from cStringIO import StringIO
+from bkr.labcontroller.log_storage import LogStorage, LogFile, compress_log, \
+        COMPRESSED_SUFFIX
 
 def test_log_storage_paths():
     log_storage = LogStorage('/dummy', 'http://dummy/', object())
@@ -29,3 +34,79 @@ def test_log_storage_paths():
     for log_type, id, path, expected in cases:
         actual = getattr(log_storage, log_type)(id, path).path
         assert actual == expected, actual
+
+def test_update_from_stream():
+    base_dir = tempfile.mkdtemp()
+    try:
+        log_file = LogFile(os.path.join(base_dir, 'console.log'), lambda: None)
+        with log_file:
+            written = log_file.update_from_stream(StringIO('a' * 100000), 0,
+                    100000, chunk_size=4096)
+            assert written == 100000, written
+            # stops at the given length, even if the stream has more
+            written = log_file.update_from_stream(StringIO('bbbbcccc'), 10, 4)
+            assert written == 4, written
+            # and returns a short count if the stream ends early
+            written = log_file.update_from_stream(StringIO('dd'), 20, 10)
+            assert written == 2, written
+        contents = open(log_file.path).read()
+        assert contents == 'a' * 10 + 'bbbb' + 'a' * 6 + 'dd' + 'a' * 99978, \
+                contents[:30]
+    finally:
+        shutil.rmtree(base_dir)
+
+def test_compressed_log_is_read_transparently():
+    base_dir = tempfile.mkdtemp()
+    try:
+        log_file = LogFile(os.path.join(base_dir, 'console.log'), lambda: None)
+        contents = ''.join('line %d of the console log\n' % i
+                for i in range(20000))
+        with log_file:
+            log_file.update_chunk(contents, 0)
+        assert compress_log(log_file.path)
+        assert not os.path.exists(log_file.path)
+        compressed_size = os.path.getsize(log_file.path + COMPRESSED_SUFFIX)
+        assert compressed_size < len(contents) / 5, compressed_size
+        f = log_file.open_ro()
+        try:
+            assert f.read() == contents
+            # seeking across block boundaries
+            for offset in [0, 65279, 65280, 300000, len(contents) - 10]:
+                f.seek(offset)
+                assert f.read(100) == contents[offset:offset + 100], offset
+            f.seek(0, os.SEEK_END)
+            assert f.tell() == len(contents)
+        finally:
+            f.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+def test_writing_restores_compressed_log():
+    base_dir = tempfile.mkdtemp()
+    try:
+        registered = []
+        log_file = LogFile(os.path.join(base_dir, 'console.log'),
+                lambda: registered.append(True))
+        with log_file:
+            log_file.update_chunk('a' * 100000, 0)
+        assert compress_log(log_file.path)
+        with log_file:
+            log_file.update_chunk('b' * 10, 100000)
+        assert not os.path.exists(log_file.path + COMPRESSED_SUFFIX)
+        assert open(log_file.path).read() == 'a' * 100000 + 'b' * 10
+        # the log was only registered when it was first created
+        assert registered == [True], registered
+    finally:
+        shutil.rmtree(base_dir)
+
+def test_incompressible_log_is_not_compressed():
+    base_dir = tempfile.mkdtemp()
+    try:
+        log_file = LogFile(os.path.join(base_dir, 'random.bin'), lambda: None)
+        with log_file:
+            log_file.update_chunk(os.urandom(100000), 0)
+        assert not compress_log(log_file.path)
+        assert os.path.exists(log_file.path)
+        assert not os.path.exists(log_file.path + COMPRESSED_SUFFIX)
+    finally:
+        shutil.rmtree(base_dir)
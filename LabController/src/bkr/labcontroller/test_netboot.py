@@ -167,6 +167,37 @@ def test_fetch_twice(self):
         self.assertEquals(os.path.getsize(kernel_path), 4 * 1024 * 1024)
         self.assertEquals(os.path.getsize(initrd_path), 8 * 1024 * 1024)
 
+    def test_images_are_shared_between_systems(self):
+        netboot.fetch_images(1234, 'file://%s' % self.kernel.name,
+                'file://%s' % self.initrd.name,
+                TEST_FQDN)
+        netboot.fetch_images(1234, 'file://%s' % self.kernel.name,
+                'file://%s' % self.initrd.name,
+                'other.example.invalid')
+        for image in ['kernel', 'initrd']:
+            first = os.stat(os.path.join(self.tftp_root, 'images', TEST_FQDN, image))
+            second = os.stat(os.path.join(self.tftp_root, 'images',
+                    'other.example.invalid', image))
+            self.assertEquals(first.st_ino, second.st_ino)
+            # one link in the cache, and one for each system
+            self.assertEquals(first.st_nlink, 3)
+
+    def test_unused_images_are_evicted_from_cache(self):
+        self.fake_conf['IMAGE_CACHE_MAX_SIZE'] = 10 * 1024 * 1024
+        netboot.fetch_images(1234, 'file://%s' % self.kernel.name,
+                'file://%s' % self.initrd.name,
+                TEST_FQDN)
+        cache_dir = os.path.join(self.tftp_root, 'cache')
+        self.assertEquals(len(os.listdir(cache_dir)), 2)
+        # Images still in use are kept, even though the cache is too big
+        netboot.get_image_cache().evict()
+        self.assertEquals(len(os.listdir(cache_dir)), 2)
+        netboot.clear_images(TEST_FQDN)
+        netboot.get_image_cache().evict()
+        # The kernel (4MB) and initrd (8MB) were used at the same time, so 
+        # either might be removed first, but removing one is enough.
+        self.assertEquals(len(os.listdir(cache_dir)), 1)
+
 class ArchBasedConfigTest(ImagesBaseTestCase):
     common_categories = ("images", "armlinux", "efigrub",
                          "elilo", "yaboot", "pxelinux")
@@ -7,6 +7,7 @@
 import os
 import sys
 import signal
+import resource
 import logging
 import time
 import socket
@@ -54,14 +55,15 @@ def main_loop(watchdog, conf):
                 # expired_watchdogs, depending on the configuration
                 # we may have extended the watchdog and its therefore
                 # no longer expired!
+                # Only the changes since the last poll are fetched.
                 try:
-                    active_watchdogs = watchdog.get_active_watchdogs()
+                    watchdog.update_active_watchdogs()
                 except xmlrpclib.Fault:
                     # catch any xmlrpc errors
                     traceback = Traceback()
                     logger.error(traceback.get_traceback())
-                    active_watchdogs = []
-                watchdog.active_watchdogs(active_watchdogs)
+
+                watchdog.compress_finished_logs()
 
             if not watchdog.run():
                 logger.debug(80 * '-')
@@ -99,6 +101,11 @@ def main():
     logging.getLogger().setLevel(logging.DEBUG)
 
     conf = get_conf()
+    # Console logs are kept open while they are being watched, so we need 
+    # a file descriptor for every system in the lab.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
     pid_file = opts.pid_file
     if pid_file is None:
         pid_file = conf.get("WATCHDOG_PID_FILE", "/var/run/beaker-lab-controller/beaker-watchdog.pid")
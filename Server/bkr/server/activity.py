@@ -58,7 +58,8 @@ def get_activity():
     query = Activity.query.order_by(Activity.id.desc())
     json_result = json_collection(query,
             columns=common_activity_search_columns,
-            skip_count=True)
+            skip_count=True,
+            keyset=[Activity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -95,7 +96,8 @@ def get_distro_activity():
                 'distro': Distro.name,
                 'distro.name': Distro.name,
                 }.items()),
-            skip_count=True)
+            skip_count=True,
+            keyset=[DistroActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -141,7 +143,8 @@ def get_distro_tree_activity():
                 'distro_tree.variant': DistroTree.variant,
                 'distro_tree.arch': Arch.arch,
                 }.items()),
-            skip_count=True)
+            skip_count=True,
+            keyset=[DistroTreeActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -177,7 +180,8 @@ def get_group_activity():
             columns=dict(common_activity_search_columns.items() + {
                 'group': Group.group_name,
                 'group.group_name': Group.group_name,
-                }.items()))
+                }.items()),
+            keyset=[GroupActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -213,7 +217,8 @@ def get_lab_controller_activity():
             columns=dict(common_activity_search_columns.items() + {
                 'lab_controller': LabController.fqdn,
                 'lab_controller.fqdn': LabController.fqdn,
-                }.items()))
+                }.items()),
+            keyset=[LabControllerActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -250,7 +255,8 @@ def get_systems_activity(): # distinct from get_system_activity
                 'system': System.fqdn,
                 'system.fqdn': System.fqdn,
                 }.items()),
-            skip_count=True)
+            skip_count=True,
+            keyset=[SystemActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -294,7 +300,8 @@ def get_system_pools_activity():
                 'pool.owner.user_name': User.user_name,
                 'pool.owner.group_name': Group.group_name,
                 }.items()),
-            skip_count=True)
+            skip_count=True,
+            keyset=[SystemPoolActivity.id.desc()])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -0,0 +1,72 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Create system_access_policy_grant table
+
+Revision ID: 2d0d5ba6f26e
+Revises: 4b3a6065eba2
+Create Date: 2026-10-18 14:02:17.306415
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d0d5ba6f26e'
+down_revision = '4b3a6065eba2'
+
+from alembic import op
+from sqlalchemy import Column, Integer, Enum, ForeignKey
+
+def upgrade():
+    op.create_table('system_access_policy_grant',
+        Column('id', Integer, nullable=False, primary_key=True),
+        Column('rule_id', Integer, ForeignKey('system_access_policy_rule.id',
+                name='system_access_policy_grant_rule_id_fk',
+                onupdate='CASCADE', ondelete='CASCADE'), nullable=False),
+        Column('policy_id', Integer, nullable=False),
+        Column('permission', Enum(u'view', u'view_power', u'edit_policy',
+                u'edit_system', u'loan_any', u'loan_self', u'control_system',
+                u'reserve'), nullable=False),
+        Column('user_id', Integer, ForeignKey('tg_user.user_id',
+                name='system_access_policy_grant_user_id_fk',
+                onupdate='CASCADE', ondelete='CASCADE')),
+        Column('inverted_group_id', Integer, ForeignKey('tg_group.group_id',
+                name='system_access_policy_grant_inverted_group_id_fk',
+                onupdate='CASCADE', ondelete='CASCADE')),
+        mysql_engine='InnoDB',
+    )
+    op.create_index('ix_system_access_policy_grant_policy_id_permission_user_id',
+            'system_access_policy_grant', ['policy_id', 'permission', 'user_id'])
+    # Rules for a user or for everybody
+    op.execute("""
+        INSERT INTO system_access_policy_grant
+            (rule_id, policy_id, permission, user_id)
+        SELECT id, policy_id, permission, user_id
+        FROM system_access_policy_rule
+        WHERE group_id IS NULL
+        """)
+    # Rules for inverted groups
+    op.execute("""
+        INSERT INTO system_access_policy_grant
+            (rule_id, policy_id, permission, inverted_group_id)
+        SELECT system_access_policy_rule.id, policy_id, permission,
+            system_access_policy_rule.group_id
+        FROM system_access_policy_rule
+        INNER JOIN tg_group ON system_access_policy_rule.group_id = tg_group.group_id
+        WHERE tg_group.membership_type = 'inverted'
+        """)
+    # Rules for other groups, once for each member
+    op.execute("""
+        INSERT INTO system_access_policy_grant
+            (rule_id, policy_id, permission, user_id)
+        SELECT system_access_policy_rule.id, policy_id, permission,
+            user_group.user_id
+        FROM system_access_policy_rule
+        INNER JOIN tg_group ON system_access_policy_rule.group_id = tg_group.group_id
+        INNER JOIN user_group ON system_access_policy_rule.group_id = user_group.group_id
+        WHERE tg_group.membership_type != 'inverted'
+        """)
+
+def downgrade():
+    op.drop_table('system_access_policy_grant')
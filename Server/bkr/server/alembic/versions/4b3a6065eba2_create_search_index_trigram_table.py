@@ -0,0 +1,39 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Create search_index_trigram table
+
+Revision ID: 4b3a6065eba2
+Revises: f18df089261
+Create Date: 2026-10-18 09:12:41.530197
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b3a6065eba2'
+down_revision = 'f18df089261'
+
+from alembic import op
+from sqlalchemy import Column, Integer, Unicode
+
+def upgrade():
+    op.create_table('search_index_trigram',
+        Column('column_key', Unicode(40), primary_key=True),
+        Column('trigram', Unicode(3), primary_key=True),
+        Column('row_id', Integer, primary_key=True, autoincrement=False),
+        mysql_engine='InnoDB',
+        mysql_collate='utf8_bin',
+    )
+    op.create_index('ix_search_index_trigram_column_key_row_id',
+            'search_index_trigram', ['column_key', 'row_id'])
+    # Existing rows are indexed by the search-index-trigrams data migration.
+
+def downgrade():
+    op.drop_table('search_index_trigram')
+    # The index has to be filled in again if we are upgraded later.
+    op.execute("""
+        DELETE FROM data_migration
+        WHERE name = 'search-index-trigrams'
+        """)
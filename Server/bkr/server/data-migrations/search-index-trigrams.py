@@ -0,0 +1,58 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Data migration script related to Alembic revision 4b3a6065eba2, which creates
+the search_index_trigram table.
+
+Rows are added to the search index as they are inserted or updated, this
+online migration fills in the index for rows which existed before the upgrade.
+The search index is not used for searching until this migration is finished.
+"""
+
+import logging
+from sqlalchemy.sql import select, and_
+from bkr.server.model.base import DeclarativeMappedObject
+from bkr.server.model.search import search_index_trigram, indexed_columns, \
+        trigrams
+
+logger = logging.getLogger(__name__)
+
+batch_size = 2000
+
+# Last row id indexed for each column, or None when the column is done. If
+# beakerd is restarted we start again from the beginning, which is harmless
+# because rows which are already in the index are ignored.
+_progress = {}
+
+def migrate_one_batch(engine):
+    for key in sorted(indexed_columns):
+        last_id = _progress.get(key, 0)
+        if last_id is None:
+            continue
+        table_name, column_name = key.split('.')
+        table = DeclarativeMappedObject.metadata.tables[table_name]
+        primary_key, = table.primary_key.columns
+        column = table.c[column_name]
+        with engine.begin() as connection:
+            rows = connection.execute(select([primary_key, column])
+                    .where(and_(primary_key > last_id, column != None))
+                    .order_by(primary_key)
+                    .limit(batch_size)).fetchall()
+            index_rows = [dict(column_key=key, trigram=trigram, row_id=row_id)
+                    for row_id, value in rows for trigram in trigrams(value)]
+            if index_rows:
+                connection.execute(
+                        search_index_trigram.insert().prefix_with('IGNORE'),
+                        index_rows)
+        if len(rows) < batch_size:
+            logger.info('Finished indexing %s', key)
+            _progress[key] = None
+        else:
+            logger.debug('Indexed %s up to row %s', key, rows[-1][0])
+            _progress[key] = rows[-1][0]
+        return False # more work to do
+    return True # migration complete
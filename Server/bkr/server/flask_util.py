@@ -9,15 +9,28 @@
 """
 import contextlib
 import functools
+import base64
+import datetime
+import decimal
+import json
+import logging
+import threading
+import Queue
+import time
 from werkzeug.exceptions import HTTPException
 from flask import request, redirect
+from turbogears import config
+from sqlalchemy import select, func, and_, or_, false
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import operators
 from bkr.server import identity
 from bkr.server.bexceptions import BX, InsufficientSystemPermissions, DatabaseLookupError, \
     StaleTaskStatusException
 from bkr.server.search_utility import lucene_to_sqlalchemy
 from bkr.server.util import absolute_url, strip_webpath
 
+log = logging.getLogger(__name__)
+
 # http://flask.pocoo.org/snippets/45/
 def request_wants_json():
     best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
@@ -32,8 +45,149 @@ def __init__(self, response):
     def get_response(self, environ):
         return self.response
 
+def _encode_cursor_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, datetime.date):
+        return {'date': value.strftime('%Y-%m-%d')}
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if hasattr(value, '__json__'):
+        return value.__json__()
+    return value
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if 'datetime' in value:
+            return datetime.datetime.strptime(value['datetime'], '%Y-%m-%dT%H:%M:%S.%f')
+        if 'date' in value:
+            return datetime.datetime.strptime(value['date'], '%Y-%m-%d').date()
+        raise ValueError('Invalid cursor value %r' % value)
+    return value
+
+def _encode_cursor(sort_by, sort_order, values):
+    return base64.urlsafe_b64encode(json.dumps({'sort_by': sort_by,
+            'order': sort_order,
+            'values': [_encode_cursor_value(value) for value in values]}))
+
+def _decode_cursor(cursor, sort_by, sort_order, num_values):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if (decoded['sort_by'] != sort_by or decoded['order'] != sort_order
+                or len(decoded['values']) != num_values):
+            raise ValueError('Cursor does not match sort order')
+        return [_decode_cursor_value(value) for value in decoded['values']]
+    except (ValueError, TypeError, KeyError, UnicodeError), e:
+        raise BadRequest400('Invalid cursor %r: %s' % (cursor, e))
+
+def _after_keyset(keyset, values):
+    """
+    Returns a filter clause matching rows which sort after the given values 
+    of the keyset columns. NULLs sort first in ascending order, as they do in 
+    MySQL.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(keyset):
+        value = values[i]
+        if descending:
+            after = (column < value) | (column == None) if value is not None else false()
+        else:
+            after = (column > value) if value is not None else (column != None)
+        equal = [(c == v) if v is not None else (c == None)
+                for (c, _), v in zip(keyset[:i], values[:i])]
+        clauses.append(and_(*(equal + [after])))
+    return or_(*clauses)
+
+def _parse_order_by(clause):
+    """
+    Splits an ORDER BY expression like Activity.id.desc() into (column, 
+    descending).
+    """
+    if getattr(clause, 'modifier', None) is operators.desc_op:
+        return clause.element, True
+    if getattr(clause, 'modifier', None) is operators.asc_op:
+        return clause.element, False
+    return clause, False
+
+class CountCache(object):
+    """
+    Remembers the total number of rows for queries, so that collections can 
+    return a recent total instead of counting every time. Totals older than 
+    the TTL are returned as they are, and refreshed in the background.
+
+    All counting is done one query at a time by a single worker thread, using 
+    a separate database connection. At most *max_pending* counts wait for the 
+    worker. When that many are already waiting, missing totals are not 
+    counted and stale ones are not refreshed.
+    """
+
+    max_entries = 1000
+    max_pending = 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: dict of (key -> (count, time counted))
+        self.counts = {}
+        #: keys waiting for or being counted by the worker
+        self.refreshing = set()
+        self.queue = Queue.Queue(maxsize=self.max_pending)
+        #: worker thread, started when it is first needed
+        self.worker = None
+
+    def get(self, query):
+        """
+        Returns the cached total for the given query, or None if it has not 
+        been counted yet. Schedules a refresh if the total is missing or 
+        stale, and there is room in the queue.
+        """
+        count_statement = select([func.count()]).select_from(
+                query.order_by(None).limit(None).offset(None).statement.alias())
+        engine = query.session.get_bind()
+        compiled = count_statement.compile(bind=engine)
+        key = (unicode(compiled), repr(sorted(compiled.params.items())))
+        ttl = config.get('beaker.collection_count_cache_ttl', 300)
+        with self.lock:
+            count, counted = self.counts.get(key, (None, None))
+            if (counted is None or counted < time.time() - ttl) \
+                    and key not in self.refreshing:
+                try:
+                    self.queue.put_nowait((key, engine, count_statement))
+                except Queue.Full:
+                    log.debug('Count queue is full, not counting rows for %s',
+                            key[0])
+                else:
+                    self.refreshing.add(key)
+                    if self.worker is None:
+                        self.worker = threading.Thread(target=self._work)
+                        self.worker.daemon = True
+                        self.worker.start()
+        return count
+
+    def _work(self):
+        while True:
+            key, engine, count_statement = self.queue.get()
+            self._refresh(key, engine, count_statement)
+
+    def _refresh(self, key, engine, count_statement):
+        try:
+            count = engine.execute(count_statement).scalar()
+            with self.lock:
+                if len(self.counts) >= self.max_entries and key not in self.counts:
+                    # evict the oldest entry
+                    oldest = min(self.counts, key=lambda k: self.counts[k][1])
+                    del self.counts[oldest]
+                self.counts[key] = (count, time.time())
+        except Exception:
+            log.exception('Failed to count rows for %s', key[0])
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+_count_cache = CountCache()
+
 def json_collection(query, columns=None, extra_sort_columns=None, max_page_size=500,
-                    default_page_size=20, force_paging_for_count=500,skip_count=False):
+                    default_page_size=20, force_paging_for_count=500,skip_count=False,
+                    keyset=None):
     """
     Helper function for Flask request handlers which want to return 
     a collection of resources as JSON.
@@ -43,6 +197,12 @@ def json_collection(query, columns=None, extra_sort_columns=None, max_page_size=
     (defined in documentation/server-api/http.rst). The caller can either 
     return a JSON response directly by passing the return value to 
     flask.jsonify(), or serialize it and embed it in an HTML response.
+
+    If *keyset* is given, the collection can also be paged with cursors. It is 
+    a list of ORDER BY expressions (for example ``[Activity.id.desc()]``) 
+    giving the default sort order of the collection, and the last expression 
+    must be on a unique column. It is used to break ties when sorting by 
+    other columns.
     """
     if columns is None:
         columns = {}
@@ -54,16 +214,34 @@ def json_collection(query, columns=None, extra_sort_columns=None, max_page_size=
                 search_columns=columns,
                 default_columns=set(columns.values())))
         result['q'] = request.args['q']
-    if not skip_count:
+    # Counting every row is slow for big collections, so clients can ask for 
+    # a recently counted total instead. Collections which skip counting only 
+    # offer that.
+    count_mode = request.args.get('count', 'none' if skip_count else 'exact')
+    if count_mode not in ('exact', 'cached', 'none'):
+        raise BadRequest400('Invalid count mode %r' % count_mode)
+    if skip_count and count_mode == 'exact':
+        raise BadRequest400('This collection does not support exact counts')
+    total_count = None
+    if count_mode == 'exact':
         total_count = query.order_by(None).count()
         result['count'] = total_count
+    elif count_mode == 'cached':
+        total_count = _count_cache.get(query)
+        if total_count is not None:
+            result['count'] = total_count
+            result['count_is_cached'] = True
+    if total_count is not None:
         force_paging = (total_count > force_paging_for_count)
     else:
         force_paging = True
     total_columns = columns.copy()
     total_columns.update(extra_sort_columns)
+    sort_by = sort_order = None
+    if keyset:
+        keyset = [_parse_order_by(clause) for clause in keyset]
     if request.args.get('sort_by') in total_columns:
-        result['sort_by'] = request.args['sort_by']
+        sort_by = result['sort_by'] = request.args['sort_by']
         sort_columns = total_columns[request.args['sort_by']]
         if not isinstance(sort_columns, tuple):
             sort_columns = (sort_columns,)
@@ -72,12 +250,28 @@ def json_collection(query, columns=None, extra_sort_columns=None, max_page_size=
         else:
             sort_order = 'asc'
         result['order'] = sort_order
+        if keyset:
+            # break ties using the unique column at the end of the keyset
+            unique_key = keyset[-1][0]
+            keyset = [(column, sort_order == 'desc')
+                    for column in sort_columns + (unique_key,)]
+            sort_columns = [column for column, _ in keyset]
         query = query.order_by(None)
         for sort_column in sort_columns:
             if sort_order == 'desc':
                query = query.order_by(sort_column.desc())
             else:
                query = query.order_by(sort_column)
+    elif keyset:
+        query = query.order_by(None).order_by(*[
+                column.desc() if descending else column
+                for column, descending in keyset])
+    cursor = request.args.get('cursor')
+    if cursor is not None and not keyset:
+        raise BadRequest400('This collection does not support cursors')
+    if cursor:
+        values = _decode_cursor(cursor, sort_by, sort_order, len(keyset))
+        query = query.filter(_after_keyset(keyset, values))
     with convert_internal_errors():
         if 'page_size' in request.args:
             page_size = int(request.args['page_size'])
@@ -102,15 +296,30 @@ def json_collection(query, columns=None, extra_sort_columns=None, max_page_size=
             page_size = default_page_size
         else:
             page_size = None
+        page = None
         if page_size:
             query = query.limit(page_size)
-            page = int(request.args.get('page', 1))
-            if page > 1:
-                query = query.offset((page - 1) * page_size)
-            result['page'] = page
+            if cursor is not None:
+                # The cursor replaces the page number.
+                result['cursor'] = cursor
+            else:
+                page = int(request.args.get('page', 1))
+                if page > 1:
+                    query = query.offset((page - 1) * page_size)
+                result['page'] = page
             result['page_size'] = page_size
-        result['entries'] = query.all()
-        if len(result['entries']) < page_size and 'count' not in result:
+        if page_size and keyset:
+            # Fetch the keyset values along with each row, to build the 
+            # cursor for the next page.
+            rows = query.add_columns(*[column for column, _ in keyset]).all()
+            result['entries'] = [row[0] for row in rows]
+            if len(rows) == page_size:
+                result['next_cursor'] = _encode_cursor(sort_by, sort_order,
+                        rows[-1][1:])
+        else:
+            result['entries'] = query.all()
+        if len(result['entries']) < page_size and 'count' not in result \
+                and page is not None:
             # Even if we're not counting rows for performance reason, we know 
             # we have reached the end of the rows if we returned fewer than the 
             # page size. In this case we can infer the total count and return 
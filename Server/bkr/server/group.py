@@ -353,7 +353,7 @@ def get_groups():
         'owner.user_name': (Group.dyn_owners, User.user_name),
         'owner.display_name': (Group.dyn_owners, User.display_name),
         'owner.email_address': (Group.dyn_owners, User.email_address),
-    })
+    }, keyset=[Group.group_name])
     # Need to call .to_json() on the groups because the default __json__ 
     # representation is the minimal cut-down one, we want the complete 
     # representation here (including members and owners etc).
@@ -71,6 +71,89 @@ def update_params(self, d):
             d['xsd_errors'] = d['options']['xsd_errors']
             d['submit_text'] = _(u'Queue despite validation errors')
 
+class JobSubmissionLookups(object):
+    """
+    Remembers the task library, package and distro tree lookups made while
+    processing job XML. Calling :meth:`prefetch` first resolves every task
+    name and package in the given jobs using a few bulk queries, and
+    identical <distroRequires/> and <hostRequires/> blocks are only evaluated
+    once, so a job with hundreds of recipes (or a batch of jobs submitted
+    together) does not need several queries for every recipe and task.
+    """
+
+    def __init__(self):
+        self.tasks = {} #: dict of (lowercased name -> valid Task)
+        self.packages = {} #: dict of (package name -> TaskPackage)
+        self.distro_trees = {} #: dict of (distroRequires XML -> DistroTree)
+        self.valid_host_requires = set() #: hostRequires XML known to be valid
+
+    def prefetch(self, xmljobs):
+        task_names = set()
+        package_names = set()
+        for xmljob in xmljobs:
+            for xmltask in xmljob.iter('task'):
+                if xmltask.find('fetch') is None and xmltask.get('name'):
+                    task_names.add(xmltask.get('name'))
+            for xmlpackage in xmljob.xpath('.//packages/package'):
+                package_names.add('%s' % xmlpackage.get('name', u'None'))
+            for installPackage in xmljob.iter('installPackage'):
+                package_names.add('%s' % installPackage.text)
+        task_names = [name for name in task_names
+                if name.lower() not in self.tasks]
+        if task_names:
+            for task in Task.query.filter(Task.name.in_(task_names))\
+                    .filter(Task.valid == True):
+                self.tasks[task.name.lower()] = task
+        package_names = [name for name in package_names
+                if name not in self.packages]
+        if package_names:
+            for package in TaskPackage.query\
+                    .filter(TaskPackage.package.in_(package_names)):
+                self.packages[package.package] = package
+        for name in package_names:
+            if name not in self.packages:
+                self.packages[name] = TaskPackage.lazy_create(package=name)
+
+    def task(self, name):
+        """
+        Returns the valid task with the given name, or None if there is no
+        such task.
+        """
+        # The task name column is case insensitive, so anything which was not
+        # found by the prefetch is looked up again to get the same result as
+        # before.
+        if name is not None and name.lower() in self.tasks:
+            return self.tasks[name.lower()]
+        try:
+            task = Task.by_name(name, valid=True)
+        except DatabaseLookupError:
+            return None
+        self.tasks[task.name.lower()] = task
+        return task
+
+    def package(self, name):
+        if name not in self.packages:
+            self.packages[name] = TaskPackage.lazy_create(package=name)
+        return self.packages[name]
+
+    def distro_tree(self, distro_requires):
+        if distro_requires not in self.distro_trees:
+            try:
+                self.distro_trees[distro_requires] = \
+                        DistroTree.by_filter(distro_requires)[0]
+            except IndexError:
+                raise BX(_('No distro tree matches Recipe: %s') % distro_requires)
+        return self.distro_trees[distro_requires]
+
+    def check_host_requires(self, host_requires):
+        if host_requires not in self.valid_host_requires:
+            try:
+                # try evaluating the host_requires, to make sure it's valid
+                XmlHost.from_string(host_requires).apply_filter(System.query)
+            except StandardError, e:
+                raise BX(_('Error in hostRequires: %s' % e))
+            self.valid_host_requires.add(host_requires)
+
 class Jobs(RPCRoot):
     # For XMLRPC methods in this class.
     exposed = True 
@@ -353,6 +436,39 @@ def upload(self, jobxml, ignore_missing_tasks=False):
         session.flush()  # so that we get an id
         return "J:%s" % job.id
 
+    # XMLRPC method
+    @cherrypy.expose
+    @identity.require(identity.not_anonymous())
+    def upload_many(self, jobxmls, ignore_missing_tasks=False):
+        """
+        Queues several new jobs at once. This is faster than calling
+        :meth:`upload` for each job, because the tasks, packages and distro
+        trees used by all of the jobs are looked up together.
+
+        Either all of the jobs are queued, or (if any of them is invalid) none
+        of them are.
+
+        :param jobxmls: XML descriptions of jobs to be queued
+        :type jobxmls: list of strings
+        :param ignore_missing_tasks: pass True for this parameter to cause 
+            unknown tasks to be silently discarded (default is False)
+        :type ignore_missing_tasks: bool
+        :returns: list of job ids, in the same order as *jobxmls*
+        """
+        xmljobs = []
+        for jobxml in jobxmls:
+            if isinstance(jobxml, unicode):
+                jobxml = jobxml.encode('utf8')
+            xmljobs.append(parse_untrusted_xml(jobxml))
+        lookups = JobSubmissionLookups()
+        lookups.prefetch(xmljobs)
+        jobs = [self.process_xmljob(xmljob, identity.current.user,
+                                    ignore_missing_tasks=ignore_missing_tasks,
+                                    lookups=lookups)
+                for xmljob in xmljobs]
+        session.flush()  # so that we get ids
+        return ["J:%s" % job.id for job in jobs]
+
     @identity.require(identity.not_anonymous())
     @expose(template="bkr.server.templates.form-post")
     @validate(validators={'confirmed': validators.StringBool()})
@@ -427,7 +543,8 @@ def clone(self, job_id=None, recipe_id=None, recipeset_id=None,
         )
 
 
-    def _handle_recipe_set(self, xmlrecipeSet, user, ignore_missing_tasks=False):
+    def _handle_recipe_set(self, xmlrecipeSet, user, ignore_missing_tasks=False,
+                           lookups=None):
         """
         Handles the processing of recipesets into DB entries from their xml
         """
@@ -448,7 +565,8 @@ def _handle_recipe_set(self, xmlrecipeSet, user, ignore_missing_tasks=False):
 
         for xmlrecipe in xmlrecipeSet.iter('recipe'):
             recipe = self.handleRecipe(xmlrecipe, user,
-                                       ignore_missing_tasks=ignore_missing_tasks)
+                                       ignore_missing_tasks=ignore_missing_tasks,
+                                       lookups=lookups)
             recipe.ttasks = len(recipe.tasks)
             recipeSet.ttasks += recipe.ttasks
             recipeSet.recipes.append(recipe)
@@ -488,7 +606,8 @@ def _process_job_tag_product(self, retention_tag=None, product=None, *args, **kw
         else:
             return tag, None
 
-    def process_xmljob(self, xmljob, user, ignore_missing_tasks=False):
+    def process_xmljob(self, xmljob, user, ignore_missing_tasks=False,
+                       lookups=None):
         # We start with the assumption that the owner == 'submitting user', until
         # we see otherwise.
         submitter = user
@@ -516,6 +635,21 @@ def process_xmljob(self, xmljob, user, ignore_missing_tasks=False):
         job_retention = xmljob.get('retention_tag')
         job_product = xmljob.get('product')
         tag, product = self._process_job_tag_product(retention_tag=job_retention, product=job_product)
+        if lookups is None:
+            lookups = JobSubmissionLookups()
+            lookups.prefetch([xmljob])
+        # Everything the job refers to has been looked up by now, so there is
+        # no need to flush the half-built job before every query below. It is
+        # inserted in one go when the caller flushes.
+        with session.no_autoflush:
+            job = self._build_job(xmljob, owner, group, submitter, tag, product,
+                                  ignore_missing_tasks, lookups)
+        session.add(job)
+        metrics.measure('counters.recipes_submitted', len(list(job.all_recipes)))
+        return job
+
+    def _build_job(self, xmljob, owner, group, submitter, tag, product,
+                   ignore_missing_tasks, lookups):
         job = Job(whiteboard=xmljob.findtext('whiteboard', default='').strip(),
                   ttasks=0,
                   owner=owner,
@@ -537,14 +671,13 @@ def process_xmljob(self, xmljob, user, ignore_missing_tasks=False):
                 raise BX(_('Invalid e-mail address %r in <cc/>: %s') % (addr, str(e)))
         for xmlrecipeSet in xmljob.iter('recipeSet'):
             recipe_set = self._handle_recipe_set(xmlrecipeSet, owner,
-                                                 ignore_missing_tasks=ignore_missing_tasks)
+                                                 ignore_missing_tasks=ignore_missing_tasks,
+                                                 lookups=lookups)
             job.recipesets.append(recipe_set)
             job.ttasks += recipe_set.ttasks
 
         if not job.recipesets:
             raise BX(_('No RecipeSets! You can not have a Job with no recipeSets!'))
-        session.add(job)
-        metrics.measure('counters.recipes_submitted', len(list(job.all_recipes)))
         return job
 
     def _jobs(self,job,**kw):
@@ -583,12 +716,16 @@ def _job_search(self,task,**kw):
             job_search.append_results(search['value'],col,search['operation'],**kw)
         return job_search.return_results()
 
-    def handleRecipe(self, xmlrecipe, user, guest=False, ignore_missing_tasks=False):
+    def handleRecipe(self, xmlrecipe, user, guest=False, ignore_missing_tasks=False,
+                     lookups=None):
+        if lookups is None:
+            lookups = JobSubmissionLookups()
         if not guest:
             recipe = MachineRecipe(ttasks=0)
             for xmlguest in xmlrecipe.iter('guestrecipe'):
                 guestrecipe = self.handleRecipe(xmlguest, user, guest=True,
-                                                ignore_missing_tasks=ignore_missing_tasks)
+                                                ignore_missing_tasks=ignore_missing_tasks,
+                                                lookups=lookups)
                 recipe.guests.append(guestrecipe)
         else:
             recipe = GuestRecipe(ttasks=0)
@@ -601,15 +738,8 @@ def handleRecipe(self, xmlrecipe, user, guest=False, ignore_missing_tasks=False)
         if partitions is not None:
             recipe.partitions = lxml.etree.tostring(partitions, encoding=unicode)
 
-        try:
-            recipe.distro_tree = DistroTree.by_filter("%s" % recipe.distro_requires)[0]
-        except IndexError:
-            raise BX(_('No distro tree matches Recipe: %s') % recipe.distro_requires)
-        try:
-            # try evaluating the host_requires, to make sure it's valid
-            XmlHost.from_string(recipe.host_requires).apply_filter(System.query)
-        except StandardError, e:
-            raise BX(_('Error in hostRequires: %s' % e))
+        recipe.distro_tree = lookups.distro_tree("%s" % recipe.distro_requires)
+        lookups.check_host_requires(recipe.host_requires)
         recipe.whiteboard = xmlrecipe.get('whiteboard')
         recipe.kickstart = xmlrecipe.findtext('kickstart')
 
@@ -645,10 +775,10 @@ def handleRecipe(self, xmlrecipe, user, guest=False, ignore_missing_tasks=False)
 
         custom_packages = set()
         for xmlpackage in xmlrecipe.xpath('packages/package'):
-            package = TaskPackage.lazy_create(package='%s' % xmlpackage.get('name', u'None'))
+            package = lookups.package('%s' % xmlpackage.get('name', u'None'))
             custom_packages.add(package)
         for installPackage in xmlrecipe.iter('installPackage'):
-            package = TaskPackage.lazy_create(package='%s' % installPackage.text)
+            package = lookups.package('%s' % installPackage.text)
             custom_packages.add(package)
         recipe.custom_packages = list(custom_packages)
         for xmlrepo in xmlrecipe.xpath('repos/repo'):
@@ -663,20 +793,22 @@ def handleRecipe(self, xmlrecipe, user, guest=False, ignore_missing_tasks=False)
         for xmltask in xmlrecipe.xpath('task'):
             if xmltask.xpath('fetch'):
                 # If fetch URL is given, the task doesn't need to exist.
-                xmltasks.append(xmltask)
-            elif Task.exists_by_name(xmltask.get('name'), valid=True):
-                xmltasks.append(xmltask)
+                xmltasks.append((xmltask, None))
+                continue
+            task = lookups.task(xmltask.get('name'))
+            if task is not None:
+                xmltasks.append((xmltask, task))
             else:
                 invalid_tasks.append(xmltask.get('name', ''))
         if invalid_tasks and not ignore_missing_tasks:
             raise BX(_('Invalid task(s): %s') % ', '.join(invalid_tasks))
-        for xmltask in xmltasks:
+        for xmltask, task in xmltasks:
             fetch = xmltask.find('fetch')
             if fetch is not None:
                 recipetask = RecipeTask.from_fetch_url(
                     fetch.get('url'), subdir=fetch.get('subdir', u''), name=xmltask.get('name'))
             else:
-                recipetask = RecipeTask.from_task(Task.by_name(xmltask.get('name')))
+                recipetask = RecipeTask.from_task(task)
             recipetask.role = xmltask.get('role', u'None')
             for xmlparam in xmltask.xpath('params/param'):
                 param = RecipeTaskParam(name=xmlparam.get('name', u'None'),
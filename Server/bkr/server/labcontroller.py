@@ -28,11 +28,29 @@
     Arch, Distro, DistroTree, DistroTreeRepo, DistroTreeImage, \
     DistroTreeActivity, LabControllerDistroTree, ImageType, KernelType, \
     System, SystemStatus, Watchdog, Command, CommandStatus
+from bkr.server.model.distrolibrary import distro_tree_lab_cache
 
 import logging
 log = logging.getLogger(__name__)
 
 
+def _netboot_images(distro_tree, kernel_type, lab_controller):
+    """
+    Returns a tuple of (netboot details, error message) for booting the given 
+    distro tree in the given lab.
+    """
+    try:
+        kernel_url, initrd_url = distro_tree.netboot_images(lab_controller,
+                kernel_type, scheme=['http', 'ftp'])
+    except ValueError, e:
+        return None, unicode(e)
+    return {
+        'arch': distro_tree.arch.arch,
+        'distro_tree_id': distro_tree.id,
+        'kernel_url': kernel_url,
+        'initrd_url': initrd_url,
+    }, None
+
 def find_labcontroller_or_raise404(fqdn):
     """Returns a lab controller object or raises a NotFound404 error if the lab
     controller does not exist in the database."""
@@ -381,6 +399,8 @@ def add_distro_tree(self, new_distro):
                     action=u'Added', field_name=u'lab_controller_assocs',
                     old_value=None, new_value=u'%s %s' % (lab_controller, url)))
 
+        # Images are created without going through the ORM
+        distro_tree_lab_cache.invalidate(distro_tree.id)
         return distro_tree.id
 
     @cherrypy.expose
@@ -390,6 +410,7 @@ def remove_distro_trees(self, distro_tree_ids):
         for distro_tree_id in distro_tree_ids:
             distro_tree = DistroTree.by_id(distro_tree_id)
             distro_tree.expire(lab_controller=lab_controller)
+            distro_tree_lab_cache.invalidate(distro_tree.id)
         return True
 
     @cherrypy.expose
@@ -403,10 +424,7 @@ def get_running_command_ids(self):
             .values(Command.id)
         return [id for id, in running_commands]
 
-    @cherrypy.expose
-    @identity.require(identity.in_group('lab_controller'))
-    def get_queued_command_details(self):
-        lab_controller = identity.current.user.lab_controller
+    def _queued_command_details(self, lab_controller, after=None):
         max_running_commands = config.get('beaker.max_running_commands')
         if max_running_commands:
             running_commands = Command.query\
@@ -422,8 +440,14 @@ def get_queued_command_details(self):
                 .filter(System.lab_controller == lab_controller)\
                 .filter(Command.status == CommandStatus.queued)\
                 .order_by(Command.id)
+        if after is not None:
+            query = query.filter(Command.id > after)
         if max_running_commands:
             query = query.limit(max_running_commands - running_commands)
+        # Many queued commands often share the same distro tree (for example, 
+        # a multi-host job) so we only look up the netboot images once for 
+        # each distro tree and kernel type.
+        netboot_images = {}
         result = []
         for cmd in query:
             d = {
@@ -450,38 +474,43 @@ def get_queued_command_details(self):
             elif cmd.action == u'configure_netboot':
                 installation = cmd.installation
                 distro_tree = cmd.installation.distro_tree
-                distro_tree_url = distro_tree.url_in_lab(lab_controller,
-                        scheme=['http', 'ftp'])
-                if not distro_tree_url:
-                    cmd.abort(u'No usable URL found for distro tree %s in lab %s'
-                            % (distro_tree.id, lab_controller.fqdn))
-                    continue
-
-                if cmd.system.kernel_type.uboot:
-                    by_kernel = ImageType.uimage
-                    by_initrd = ImageType.uinitrd
-                else:
-                    by_kernel = ImageType.kernel
-                    by_initrd = ImageType.initrd
-
-                kernel = distro_tree.image_by_type(by_kernel, cmd.system.kernel_type)
-                if not kernel:
-                    cmd.abort(u'Kernel image not found for distro tree %s' % distro_tree.id)
-                    continue
-                initrd = distro_tree.image_by_type(by_initrd, cmd.system.kernel_type)
-                if not initrd:
-                    cmd.abort(u'Initrd image not found for distro tree %s' % distro_tree.id)
+                key = (distro_tree.id, cmd.system.kernel_type.id)
+                if key not in netboot_images:
+                    netboot_images[key] = _netboot_images(distro_tree,
+                            cmd.system.kernel_type, lab_controller)
+                images, error = netboot_images[key]
+                if error:
+                    cmd.abort(error)
                     continue
-                d['netboot'] = {
-                    'arch': distro_tree.arch.arch,
-                    'distro_tree_id': distro_tree.id,
-                    'kernel_url': urlparse.urljoin(distro_tree_url, kernel.path),
-                    'initrd_url': urlparse.urljoin(distro_tree_url, initrd.path),
-                    'kernel_options': installation.kernel_options or '',
-                }
+                d['netboot'] = dict(images,
+                        kernel_options=installation.kernel_options or '')
             result.append(d)
         return result
 
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def get_queued_command_details(self):
+        lab_controller = identity.current.user.lab_controller
+        return self._queued_command_details(lab_controller)
+
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def get_new_queued_command_details(self, cursor=None):
+        """
+        Returns details of queued commands whose id is greater than *cursor*, 
+        in the same form as get_queued_command_details. beaker-provision calls 
+        this frequently between its full polls, so that new commands are 
+        picked up promptly without fetching every queued command each time.
+
+        The return value is a struct with keys ``commands`` and ``cursor``. 
+        The cursor should be passed in the next call.
+        """
+        lab_controller = identity.current.user.lab_controller
+        commands = self._queued_command_details(lab_controller, after=cursor)
+        if commands:
+            cursor = max(command['id'] for command in commands)
+        return {'commands': commands, 'cursor': cursor}
+
     @cherrypy.expose
     def get_installation_for_system(self, fqdn):
         system = System.by_fqdn(fqdn, identity.current.user)
@@ -489,30 +518,14 @@ def get_installation_for_system(self, fqdn):
             raise ValueError('System %s has never been provisioned' % fqdn)
         installation = system.installations[0]
         distro_tree = installation.distro_tree
-        distro_tree_url = distro_tree.url_in_lab(system.lab_controller, 'http')
-        if not distro_tree_url:
-            raise ValueError('No usable URL found for distro tree %s in lab %s'
-                    % (distro_tree.id, system.lab_controller.fqdn))
-
-        if system.kernel_type.uboot:
-            by_kernel = ImageType.uimage
-            by_initrd = ImageType.uinitrd
-        else:
-            by_kernel = ImageType.kernel
-            by_initrd = ImageType.initrd
-
-        kernel = distro_tree.image_by_type(by_kernel, system.kernel_type)
-        if not kernel:
-            raise ValueError('Kernel image not found for distro tree %s' % distro_tree.id)
-        initrd = distro_tree.image_by_type(by_initrd, system.kernel_type)
-        if not initrd:
-            raise ValueError('Initrd image not found for distro tree %s' % distro_tree.id)
+        kernel_url, initrd_url = distro_tree.netboot_images(
+                system.lab_controller, system.kernel_type, scheme='http')
         return {
-            'kernel_url': urlparse.urljoin(distro_tree_url, kernel.path),
-            'initrd_url': urlparse.urljoin(distro_tree_url, initrd.path),
+            'kernel_url': kernel_url,
+            'initrd_url': initrd_url,
             'kernel_options': installation.kernel_options or '',
-            'distro_tree_urls': [lca.url for lca in distro_tree.lab_controller_assocs
-                    if lca.lab_controller == system.lab_controller],
+            'distro_tree_urls': distro_tree.urls_in_lab(
+                    system.lab_controller).values(),
         }
 
     @cherrypy.expose
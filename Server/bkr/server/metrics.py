@@ -1,4 +1,3 @@
-
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; either version 2 of the License, or
@@ -10,44 +9,134 @@
 
 import socket
 import time
+import atexit
+import threading
 import logging
 from turbogears import config
 
 log = logging.getLogger(__name__)
 
 class CarbonSender(object):
+    """
+    Sends metrics to carbon using the plaintext protocol over UDP.
+
+    Metrics are buffered and as many as will fit are packed into each datagram,
+    which is sent when it is full or every *flush_interval* seconds from
+    a background thread. Counters are summed in memory and sent once per flush.
+    If *flush_interval* is zero, every metric is sent as soon as it is given.
 
-    def __init__(self, address, prefix):
+    Metrics given without a timestamp are stamped with the time when their
+    datagram is sent, so they are at most *flush_interval* seconds late.
+    """
+
+    def __init__(self, address, prefix, flush_interval=1,
+            max_datagram_size=1400):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.address = address
         self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_datagram_size = max_datagram_size
+        self._lock = threading.Lock()
+        self._lines = []
+        self._size = 0
+        self._counters = {}
+        self._stopped = threading.Event()
+        self._flush_thread = None
+        if flush_interval:
+            self._flush_thread = threading.Thread(target=self._flush_loop,
+                    name='carbon_flush')
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+
+    def send(self, name, value, timestamp=None):
+        line = '%s%s %s' % (self.prefix, name, value)
+        with self._lock:
+            self._append(line, timestamp)
+            if not self.flush_interval:
+                self._send_buffered()
+
+    def add_counter(self, name, value=1):
+        if not self.flush_interval:
+            return self.send(name, value)
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            for name, value in counters.iteritems():
+                self._append('%s%s %s' % (self.prefix, name, value), None)
+            self._send_buffered()
+
+    def close(self):
+        self._stopped.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        self.flush()
 
-    def send(self, name, value, timestamp):
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Error flushing metrics to carbon')
+
+    # Callers of these must hold self._lock.
+
+    def _append(self, line, timestamp):
+        # room for the timestamp and newline which are added when sending
+        size = len(line) + (12 if timestamp is None else len(' %s\n' % timestamp))
+        if self._lines and self._size + size > self.max_datagram_size:
+            self._send_buffered()
+        self._lines.append((line, timestamp))
+        self._size += size
+
+    def _send_buffered(self):
+        if not self._lines:
+            return
+        now = int(time.time())
+        msg = ''.join('%s %s\n' % (line, now if timestamp is None else timestamp)
+                for line, timestamp in self._lines)
+        self._lines = []
+        self._size = 0
         try:
-            msg = '%s%s %s %s' % (self.prefix, name, value, timestamp)
             self.sock.sendto(msg, self.address)
         except socket.error:
             log.exception('Error writing to carbon')
 
 _carbon = None
+_carbon_configured = False
+_carbon_lock = threading.Lock()
 def get_carbon():
-    global _carbon
-    if _carbon is not None:
+    """
+    Returns the CarbonSender, or None if carbon.address is not set. The 
+    configuration is only read the first time this is called.
+    """
+    global _carbon, _carbon_configured
+    if _carbon_configured:
         return _carbon
-    _carbon = CarbonSender(config.get('carbon.address'),
-            config.get('carbon.prefix', 'beaker.'))
+    with _carbon_lock:
+        if not _carbon_configured:
+            address = config.get('carbon.address')
+            if address:
+                _carbon = CarbonSender(address,
+                        config.get('carbon.prefix', 'beaker.'),
+                        flush_interval=config.get('carbon.flush_interval', 1),
+                        max_datagram_size=config.get('carbon.max_datagram_size', 1400))
+                atexit.register(_carbon.close)
+            _carbon_configured = True
     return _carbon
 
-def increment(name):
-    if not config.get('carbon.address'):
-        return
+def increment(name, value=1):
     carbon = get_carbon()
-    carbon.send(name, 1, int(time.time()))
+    if carbon is None:
+        return
+    carbon.add_counter(name, value)
 
 def measure(name, value):
-    if not config.get('carbon.address'):
+    carbon = get_carbon()
+    if carbon is None:
         return
     if not isinstance(value, (long, int, float)):
         raise TypeError('value %r should be a number' % value)
-    carbon = get_carbon()
-    carbon.send(name, value, int(time.time()))
+    carbon.send(name, value)
@@ -49,6 +49,7 @@
 from .reviewing import RecipeSetComment, RecipeReviewedState, RecipeTaskComment,\
     RecipeTaskResultComment
 from .openstack import OpenStackRegion
+from .search import search_index_trigram
 
 # Delayed property definitions due to circular dependencies
 class_mapper(Group).add_properties({
@@ -5,18 +5,21 @@
 # (at your option) any later version.
 
 import re
+import time
+import threading
 from datetime import datetime
 import urlparse
 import xml.dom.minidom
 import lxml.etree
 from sqlalchemy import (Table, Column, ForeignKey, UniqueConstraint, Integer,
-        String, Unicode, DateTime, UnicodeText, Boolean)
+        String, Unicode, DateTime, UnicodeText, Boolean, event)
 from sqlalchemy.sql import select, exists, or_
 from sqlalchemy.orm import (relationship, backref, dynamic_loader, synonym,
                             validates)
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.associationproxy import association_proxy
+from turbogears import config
 from turbogears.database import session
 from bkr.server import identity
 from bkr.server.helpers import make_link
@@ -576,6 +579,57 @@ def add_tag(self, tag):
                 {distro_tag_map.c.distro_id: self.id,
                  distro_tag_map.c.distro_tag_id: tagobj.id}))
 
+class DistroTreeLabCache(object):
+    """
+    Remembers the URLs of each distro tree in each lab, and the paths of the 
+    images for netbooting it, keyed by (distro tree id, lab controller id, 
+    kernel type id). Provisioning looks these up for every command, 
+    kickstart and installation, usually for the same few distro trees.
+
+    Entries are discarded when a distro tree's lab controllers or images are 
+    changed in this process, and expire after beaker.distro_tree_cache_ttl 
+    seconds so that changes made by other processes are seen eventually. Only 
+    distro trees which are available in the lab are cached, so newly imported 
+    distro trees are seen immediately.
+    """
+
+    max_entries = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: dict of (key -> (value, time cached))
+        self.entries = {}
+
+    def get(self, key, compute):
+        """
+        Returns the cached value for *key*, or calls *compute* to produce it. 
+        Nothing is cached if *compute* returns None or raises.
+        """
+        ttl = config.get('beaker.distro_tree_cache_ttl', 60)
+        with self.lock:
+            value, cached = self.entries.get(key, (None, None))
+        if cached is not None and cached >= time.time() - ttl:
+            return value
+        value = compute()
+        if value is not None:
+            with self.lock:
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+                self.entries[key] = (value, time.time())
+        return value
+
+    def invalidate(self, distro_tree_id):
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == distro_tree_id:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+distro_tree_lab_cache = DistroTreeLabCache()
+
 class DistroTree(DeclarativeMappedObject, ActivityMixin):
 
     __tablename__ = 'distro_tree'
@@ -697,9 +751,7 @@ def url_in_lab(self, lab_controller, scheme=None, required=False):
         """
         if isinstance(scheme, basestring):
             scheme = [scheme]
-        urls = dict((urlparse.urlparse(lca.url).scheme, lca.url)
-                for lca in self.lab_controller_assocs
-                if lca.lab_controller.fqdn == lab_controller.fqdn)
+        urls = self.urls_in_lab(lab_controller)
         if scheme is not None:
             for s in scheme:
                 if s in urls:
@@ -717,6 +769,53 @@ def url_in_lab(self, lab_controller, scheme=None, required=False):
         else:
             return None
 
+    def urls_in_lab(self, lab_controller):
+        """
+        Returns a dict of (scheme -> URL) for this distro tree in the given 
+        lab. The dict is empty if this distro tree is not in the lab.
+        """
+        def compute():
+            urls = dict((urlparse.urlparse(lca.url).scheme, lca.url)
+                    for lca in self.lab_controller_assocs
+                    if lca.lab_controller.fqdn == lab_controller.fqdn)
+            return urls or None
+        return dict(distro_tree_lab_cache.get(
+                (self.id, lab_controller.id, None), compute) or {})
+
+    def netboot_images(self, lab_controller, kernel_type, scheme=None):
+        """
+        Returns a tuple of (kernel URL, initrd URL) for netbooting this distro 
+        tree in the given lab with the given kernel type. The *scheme* 
+        argument is the same as for :meth:`url_in_lab`.
+
+        Raises ValueError if the distro tree is not available in the lab, or 
+        if it has no netboot images for the kernel type.
+        """
+        distro_tree_url = self.url_in_lab(lab_controller, scheme=scheme)
+        if not distro_tree_url:
+            raise ValueError(u'No usable URL found for distro tree %s in lab %s'
+                    % (self.id, lab_controller.fqdn))
+        def compute():
+            if kernel_type.uboot:
+                by_kernel = ImageType.uimage
+                by_initrd = ImageType.uinitrd
+            else:
+                by_kernel = ImageType.kernel
+                by_initrd = ImageType.initrd
+            kernel = self.image_by_type(by_kernel, kernel_type)
+            if not kernel:
+                raise ValueError(u'Kernel image not found for distro tree %s'
+                        % self.id)
+            initrd = self.image_by_type(by_initrd, kernel_type)
+            if not initrd:
+                raise ValueError(u'Initrd image not found for distro tree %s'
+                        % self.id)
+            return (kernel.path, initrd.path)
+        kernel_path, initrd_path = distro_tree_lab_cache.get(
+                (self.id, lab_controller.id, kernel_type.id), compute)
+        return (urlparse.urljoin(distro_tree_url, kernel_path),
+                urlparse.urljoin(distro_tree_url, initrd_path))
+
     def repo_by_id(self, repoid):
         for repo in self.repos:
             if repo.repo_id == repoid:
@@ -831,6 +930,21 @@ def lazy_create(cls, distro_tree, image_type, kernel_type, path):
                 image_type=image_type, kernel_type_id=kernel_type.id,
                 _extra_attrs=dict(path=path))
 
+# Discard cached lab URLs and images as soon as they change
+@event.listens_for(DistroTree.lab_controller_assocs, 'append')
+@event.listens_for(DistroTree.lab_controller_assocs, 'remove')
+@event.listens_for(DistroTree.images, 'append')
+@event.listens_for(DistroTree.images, 'remove')
+def _distro_tree_lab_details_changed(distro_tree, value, initiator):
+    if distro_tree.id is not None:
+        distro_tree_lab_cache.invalidate(distro_tree.id)
+
+@event.listens_for(LabControllerDistroTree.url, 'set')
+@event.listens_for(DistroTreeImage.path, 'set')
+def _distro_tree_lab_detail_changed(target, value, oldvalue, initiator):
+    if target.distro_tree_id is not None:
+        distro_tree_lab_cache.invalidate(target.distro_tree_id)
+
 class DistroTag(DeclarativeMappedObject):
 
     __tablename__ = 'distro_tag'
@@ -18,12 +18,12 @@
 from sqlalchemy import (Table, Column, ForeignKey, UniqueConstraint, Index,
         Integer, Unicode, UnicodeText, DateTime, String, Boolean, Numeric, Float,
         BigInteger, VARCHAR, TEXT, event)
-from sqlalchemy.sql import select, and_, or_, not_, case, func
+from sqlalchemy.sql import select, and_, or_, not_, case, func, exists
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import (mapper, relationship, synonym,
         column_property, dynamic_loader, contains_eager, validates,
-        object_mapper)
-from sqlalchemy.orm.attributes import NEVER_SET
+        object_mapper, Session)
+from sqlalchemy.orm.attributes import NEVER_SET, get_history
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -39,9 +39,9 @@
 from bkr.server.util import is_valid_fqdn, convert_db_lookup_error
 from .base import DeclarativeMappedObject
 from .types import (SystemType, SystemStatus, ReleaseAction, CommandStatus,
-        SystemPermission, TaskStatus)
+        SystemPermission, TaskStatus, GroupMembershipType)
 from .activity import Activity, ActivityMixin
-from .identity import User, Group
+from .identity import User, Group, UserGroup
 from .lab import LabController
 from .distrolibrary import (Arch, KernelType, OSMajor, OSVersion, Distro, DistroTree,
         LabControllerDistroTree)
@@ -2040,13 +2040,19 @@ def grants(self, user, permission):
 
     @grants.expression
     def grants(cls, user, permission): #pylint: disable=E0213
-        # need to avoid passing an empty list to in_
-        clauses = [SystemAccessPolicyRule.user == user, SystemAccessPolicyRule.everybody]
-        if user.groups:
-            clauses.append(SystemAccessPolicyRule.group_id.in_(
-                    [g.group_id for g in user.groups]))
-        return cls.rules.any(and_(SystemAccessPolicyRule.permission == permission,
-                or_(*clauses)))
+        grant = system_access_policy_grant
+        # Rules for everybody and for inverted groups are stored without
+        # a user, they apply unless the user is excluded from the group
+        unassigned = grant.c.user_id == None
+        excluded_group_ids = [assoc.group_id
+                for assoc in user.excluded_group_user_assocs]
+        if excluded_group_ids:
+            unassigned = and_(unassigned, or_(grant.c.inverted_group_id == None,
+                    not_(grant.c.inverted_group_id.in_(excluded_group_ids))))
+        return exists([1], from_obj=[grant], whereclause=and_(
+                grant.c.policy_id == cls.id,
+                grant.c.permission == permission,
+                or_(grant.c.user_id == user.user_id, unassigned)))
 
     @hybrid_method
     def grants_everybody(self, permission):
@@ -2058,8 +2064,12 @@ def grants_everybody(self, permission):
 
     @grants_everybody.expression
     def grants_everybody(cls, permission): #pylint: disable=E0213
-        return cls.rules.any(and_(SystemAccessPolicyRule.permission == permission,
-                SystemAccessPolicyRule.everybody))
+        grant = system_access_policy_grant
+        return exists([1], from_obj=[grant], whereclause=and_(
+                grant.c.policy_id == cls.id,
+                grant.c.permission == permission,
+                grant.c.user_id == None,
+                grant.c.inverted_group_id == None))
 
     def add_rule(self, permission, user=None, group=None, everybody=False):
         """
@@ -2070,10 +2080,12 @@ def add_rule(self, permission, user=None, group=None, everybody=False):
         if user is None and group is None and not everybody:
             raise RuntimeError('Did you mean to pass everybody=True to add_rule?')
         session.flush() # make sure self is persisted, for lazy_create
-        self.rules.append(SystemAccessPolicyRule.lazy_create(policy_id=self.id,
+        rule = SystemAccessPolicyRule.lazy_create(policy_id=self.id,
                 permission=permission,
                 user_id=user.user_id if user else None,
-                group_id=group.group_id if group else None))
+                group_id=group.group_id if group else None)
+        refresh_access_policy_grants(rule_ids=[rule.id])
+        self.rules.append(rule)
         return self.rules[-1]
 
 class SystemAccessPolicyRule(DeclarativeMappedObject):
@@ -2132,6 +2144,116 @@ def record_deletion(self, service=u'WEBUI'):
                                action=u'Removed',
                                field=u'Access Policy Rule', old=repr(self))
 
+# Denormalised copy of the access policy rules, so that checking whether
+# a policy grants a permission to a user is a single index lookup instead of
+# a search through the rules for the user and each of their groups. Rules for
+# a user or for everybody are copied as they are. Rules for a group are copied
+# once for each member of the group, except for inverted groups which are
+# copied once with inverted_group_id set, because they apply to everybody
+# apart from the users excluded from the group.
+system_access_policy_grant = Table('system_access_policy_grant',
+        DeclarativeMappedObject.metadata,
+    Column('id', Integer, nullable=False, primary_key=True),
+    Column('rule_id', Integer, ForeignKey('system_access_policy_rule.id',
+            name='system_access_policy_grant_rule_id_fk',
+            onupdate='CASCADE', ondelete='CASCADE'), nullable=False),
+    Column('policy_id', Integer, nullable=False),
+    Column('permission', SystemPermission.db_type(), nullable=False),
+    Column('user_id', Integer, ForeignKey('tg_user.user_id',
+            name='system_access_policy_grant_user_id_fk',
+            onupdate='CASCADE', ondelete='CASCADE')),
+    Column('inverted_group_id', Integer, ForeignKey('tg_group.group_id',
+            name='system_access_policy_grant_inverted_group_id_fk',
+            onupdate='CASCADE', ondelete='CASCADE')),
+    mysql_engine='InnoDB',
+)
+Index('ix_system_access_policy_grant_policy_id_permission_user_id',
+        system_access_policy_grant.c.policy_id,
+        system_access_policy_grant.c.permission,
+        system_access_policy_grant.c.user_id)
+
+def _insert_access_policy_grants(rule_clause, user_id=None):
+    """
+    Copies the rules matching *rule_clause* into system_access_policy_grant.
+    If *user_id* is given, only group rules are copied and only for that user.
+    """
+    rule = SystemAccessPolicyRule.__table__
+    grant = system_access_policy_grant
+    group = Group.__table__
+    user_group = UserGroup.__table__
+    if user_id is None:
+        session.execute(grant.insert().from_select(
+                ['rule_id', 'policy_id', 'permission', 'user_id'],
+                select([rule.c.id, rule.c.policy_id, rule.c.permission,
+                        rule.c.user_id])
+                .where(and_(rule_clause, rule.c.group_id == None))))
+        session.execute(grant.insert().from_select(
+                ['rule_id', 'policy_id', 'permission', 'inverted_group_id'],
+                select([rule.c.id, rule.c.policy_id, rule.c.permission,
+                        rule.c.group_id])
+                .select_from(rule.join(group,
+                        rule.c.group_id == group.c.group_id))
+                .where(and_(rule_clause, group.c.membership_type
+                        == GroupMembershipType.inverted))))
+        member_clause = true()
+    else:
+        member_clause = user_group.c.user_id == user_id
+    session.execute(grant.insert().from_select(
+            ['rule_id', 'policy_id', 'permission', 'user_id'],
+            select([rule.c.id, rule.c.policy_id, rule.c.permission,
+                    user_group.c.user_id])
+            .select_from(rule
+                .join(group, rule.c.group_id == group.c.group_id)
+                .join(user_group, rule.c.group_id == user_group.c.group_id))
+            .where(and_(rule_clause, member_clause, group.c.membership_type
+                    != GroupMembershipType.inverted))))
+
+def refresh_access_policy_grants(rule_ids=None, group_ids=None, member=None):
+    """
+    Brings system_access_policy_grant up to date after the given rules were
+    added or removed, after the membership type of the given groups changed,
+    or after the given (group id, user id) membership was added or removed.
+    """
+    rule = SystemAccessPolicyRule.__table__
+    grant = system_access_policy_grant
+    user_id = None
+    if rule_ids:
+        rule_clause = rule.c.id.in_(rule_ids)
+        stale_clause = grant.c.rule_id.in_(rule_ids)
+    elif group_ids:
+        rule_clause = rule.c.group_id.in_(group_ids)
+        stale_clause = grant.c.rule_id.in_(select([rule.c.id]).where(rule_clause))
+    elif member:
+        group_id, user_id = member
+        rule_clause = rule.c.group_id == group_id
+        stale_clause = and_(grant.c.user_id == user_id,
+                grant.c.rule_id.in_(select([rule.c.id]).where(rule_clause)))
+    else:
+        return
+    session.execute(grant.delete().where(stale_clause))
+    _insert_access_policy_grants(rule_clause, user_id=user_id)
+
+@event.listens_for(Session, 'after_flush')
+def _update_access_policy_grants(session, flush_context):
+    # Rules created by SystemAccessPolicy.add_rule() bypass the ORM and are
+    # copied there instead.
+    rule_ids = set()
+    group_ids = set()
+    members = set()
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, SystemAccessPolicyRule):
+            rule_ids.add(obj.id)
+        elif isinstance(obj, UserGroup):
+            members.add((obj.group_id, obj.user_id))
+    for obj in session.dirty:
+        if isinstance(obj, Group) and \
+                get_history(obj, 'membership_type').has_changes():
+            group_ids.add(obj.group_id)
+    refresh_access_policy_grants(rule_ids=rule_ids)
+    refresh_access_policy_grants(group_ids=group_ids)
+    for member in members:
+        refresh_access_policy_grants(member=member)
+
 class Provision(DeclarativeMappedObject):
 
     __tablename__ = 'provision'
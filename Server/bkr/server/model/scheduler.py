@@ -36,7 +36,7 @@
 from turbogears.database import session
 from lxml import etree
 from lxml.builder import E
-from bkr.common.helpers import makedirs_ignore, total_seconds
+from bkr.common.helpers import makedirs_ignore, unlink_ignore, total_seconds
 from bkr.server import identity, metrics, mail
 from bkr.server.bexceptions import BX, BeakerException, StaleTaskStatusException, DatabaseLookupError
 from bkr.server.helpers import make_link, make_fake_link
@@ -472,6 +472,35 @@ def get_by_t_id(cls, t_id, *args, **kw):
 
         return obj_ref
 
+    @classmethod
+    def get_many_by_t_id(cls, t_ids):
+        """
+        Like get_by_t_id, but looks up many objects with one query per type.
+        Returns a dict of (t_id -> object).
+        """
+        ids_by_class = defaultdict(set)
+        for t_id in t_ids:
+            task_type, id = t_id.split(':')
+            try:
+                class_str = cls.t_id_types[task_type]
+            except KeyError:
+                raise BeakerException(_('You have specified an invalid task type:%s' % task_type))
+            ids_by_class[class_str].add(int(id))
+        found = {}
+        for class_str, ids in ids_by_class.iteritems():
+            class_ref = globals()[class_str]
+            for obj in class_ref.query.filter(class_ref.id.in_(ids)):
+                found[class_str, obj.id] = obj
+        objs = {}
+        for t_id in t_ids:
+            task_type, id = t_id.split(':')
+            class_str = cls.t_id_types[task_type]
+            try:
+                objs[t_id] = found[class_str, int(id)]
+            except KeyError:
+                raise BeakerException(_('%s is not a valid %s id' % (id, class_str)))
+        return objs
+
     def _change_status(self, new_status, **kw):
         """
         _change_status will update the status if needed
@@ -1307,7 +1336,14 @@ def all_recipes(self):
     def recipe_count(self):
         return Recipe.query.join(Recipe.recipeset).filter(RecipeSet.job == self).count()
 
-    def update_status(self):
+    def update_status(self, task_rollups=None):
+        """
+        Recomputes the status and result of this job from its tasks.
+
+        If *task_rollups* is given, it must be the result of 
+        :meth:`Recipe.task_rollups_for_jobs` for this job. In that case the 
+        per-task loops are skipped in favour of the pre-computed counts.
+        """
         if not self.is_dirty:
             # This error should be impossible to trigger in beakerd's 
             # update_dirty_jobs thread.
@@ -1318,7 +1354,13 @@ def update_status(self):
             # For example: https://bugzilla.redhat.com/show_bug.cgi?id=991245#c15
             raise RuntimeError('Invoked update_status on '
                     'job %s which was not dirty' % self.id)
-        self._update_status()
+        dirty_version = self.dirty_version
+        self._update_status(task_rollups)
+        if task_rollups is not None and self.dirty_version != dirty_version:
+            # Something during the update (for example aborting the guests of 
+            # a finished host) changed tasks after the rollups were computed, 
+            # so go around again using the in-memory task state.
+            self._update_status()
         self._mark_clean()
 
     def _mark_dirty(self):
@@ -1331,7 +1373,7 @@ def _mark_clean(self):
     def is_dirty(self):
         return (self.dirty_version != self.clean_version)
 
-    def _update_status(self):
+    def _update_status(self, task_rollups=None):
         """
         Update number of passes, failures, warns, panics..
         """
@@ -1343,7 +1385,7 @@ def _update_status(self):
         max_result = TaskResult.min()
         min_status = TaskStatus.max()
         for recipeset in self.recipesets:
-            recipeset._update_status()
+            recipeset._update_status(task_rollups)
             self.ntasks += recipeset.ntasks
             self.ptasks += recipeset.ptasks
             self.wtasks += recipeset.wtasks
@@ -1847,7 +1889,7 @@ def abort(self, msg=None):
     def is_dirty(self):
         return self.job.is_dirty
 
-    def _update_status(self):
+    def _update_status(self, task_rollups=None):
         """
         Update number of passes, failures, warns, panics..
         """
@@ -1859,7 +1901,10 @@ def _update_status(self):
         max_result = TaskResult.min()
         min_status = TaskStatus.max()
         for recipe in self.recipes:
-            recipe._update_status()
+            if task_rollups is not None:
+                recipe._update_status(task_rollups.get(recipe.id, []))
+            else:
+                recipe._update_status()
             self.ntasks += recipe.ntasks
             self.ptasks += recipe.ptasks
             self.wtasks += recipe.wtasks
@@ -2394,8 +2439,15 @@ def createRepo(self):
         # The repo may already exist if beakerd.virt_recipes() creates a
         # repo but the subsequent virt provisioning fails and the recipe
         # falls back to being queued on a regular system
-        makedirs_ignore(snapshot_repo, 0755)
-        Task.make_snapshot_repo(snapshot_repo)
+        if os.path.isdir(os.path.join(snapshot_repo, 'repodata')):
+            log.info("Destination repodata already exists, skipping snapshot")
+        else:
+            if os.path.isdir(snapshot_repo) and not os.path.islink(snapshot_repo):
+                # incomplete repo left behind by an older version
+                shutil.rmtree(snapshot_repo)
+            makedirs_ignore(self.repopath, 0755)
+            Task.link_snapshot_repo(snapshot_repo,
+                    os.path.join(self.repopath, 'snapshots'))
         # Record task versions as they existed at this point in time, since we 
         # just created the task library snapshot for this recipe.
         for recipetask in self.tasks:
@@ -2408,7 +2460,11 @@ def destroyRepo(self):
         Done with Repo, destroy it.
         """
         directory = '%s/%s' % (self.repopath, self.id)
-        if os.path.isdir(directory):
+        if os.path.islink(directory):
+            # The snapshot it points to is shared, and is cleaned up when 
+            # no longer used by any recipe
+            unlink_ignore(directory)
+        elif os.path.isdir(directory):
             try:
                 shutil.rmtree(directory)
             except OSError:
@@ -2478,9 +2534,42 @@ def abort(self, msg=None):
     def is_dirty(self):
         return self.recipeset.job.is_dirty
 
-    def _update_status(self):
+    @classmethod
+    def task_rollups_for_jobs(cls, job_ids):
+        """
+        Returns a dict of recipe id -> list of (status, result, count) tuples 
+        covering every task in the given jobs, computed with a single 
+        aggregate query. The result can be passed to :meth:`Job.update_status` 
+        to avoid loading and walking every task in Python.
+        """
+        # Finished tasks whose result has not been computed yet still need 
+        # the per-task treatment, but there are normally very few of those.
+        unresolved_tasks = RecipeTask.query\
+                .join(RecipeTask.recipe).join(Recipe.recipeset)\
+                .filter(RecipeSet.job_id.in_(job_ids))\
+                .filter(RecipeTask.is_finished())\
+                .filter(RecipeTask.result == TaskResult.new)
+        for task in unresolved_tasks:
+            task._update_status()
+        session.flush()
+        counts = session.query(RecipeTask.recipe_id, RecipeTask.status,
+                    RecipeTask.result, func.count(RecipeTask.id))\
+                .join(RecipeTask.recipe).join(Recipe.recipeset)\
+                .filter(RecipeSet.job_id.in_(job_ids))\
+                .group_by(RecipeTask.recipe_id, RecipeTask.status,
+                    RecipeTask.result)
+        rollups = defaultdict(list)
+        for recipe_id, status, result, count in counts:
+            rollups[recipe_id].append((status, result, count))
+        return dict(rollups)
+
+    def _update_status(self, task_rollup=None):
         """
         Update number of passes, failures, warns, panics..
+
+        If *task_rollup* is given it is a list of (status, result, count) 
+        tuples for the tasks in this recipe, otherwise the tasks are loaded 
+        and counted one by one.
         """
         self.ntasks = 0
         self.ptasks = 0
@@ -2498,24 +2587,26 @@ def _update_status(self):
                 and not self.first_task.is_finished():
             min_status = TaskStatus.installing
 
-        # I think this loop could be replaced with some sql which would be more efficient.
-        for task in self.tasks:
-            task._update_status()
-            if task.is_finished():
-                if task.result == TaskResult.pass_:
-                    self.ptasks += 1
-                elif task.result == TaskResult.warn:
-                    self.wtasks += 1
-                elif task.result == TaskResult.fail:
-                    self.ftasks += 1
-                elif task.result == TaskResult.panic:
-                    self.ktasks += 1
+        if task_rollup is None:
+            for task in self.tasks:
+                task._update_status()
+            task_rollup = [(task.status, task.result, 1) for task in self.tasks]
+        for status, result, count in task_rollup:
+            if status.finished:
+                if result == TaskResult.pass_:
+                    self.ptasks += count
+                elif result == TaskResult.warn:
+                    self.wtasks += count
+                elif result == TaskResult.fail:
+                    self.ftasks += count
+                elif result == TaskResult.panic:
+                    self.ktasks += count
                 else:
-                    self.ntasks += 1
-            if task.status.severity < min_status.severity:
-                min_status = task.status
-            if task.result.severity > max_result.severity:
-                max_result = task.result
+                    self.ntasks += count
+            if status.severity < min_status.severity:
+                min_status = status
+            if result.severity > max_result.severity:
+                max_result = result
         if self.status.finished and not min_status.finished:
             min_status = self._fix_zombie_tasks()
 
@@ -3029,11 +3120,8 @@ def to_xml(self, clone=False, **kwargs):
                     self.recipeset.lab_controller, scheme=method)
             if location:
                 recipe.set("location", location)
-            scheme_locations = {}
-            for lca in self.distro_tree.lab_controller_assocs:
-                if lca.lab_controller == self.recipeset.lab_controller:
-                    scheme = urlparse.urlparse(lca.url).scheme
-                    scheme_locations[scheme] = lca.url
+            scheme_locations = self.distro_tree.urls_in_lab(
+                    self.recipeset.lab_controller)
             for scheme, location in sorted(scheme_locations.iteritems()):
                 attr = '%s_location' % re.sub(r'[^a-z0-9]+', '_', scheme.lower())
                 recipe.set(attr, location)
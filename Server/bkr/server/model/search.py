@@ -0,0 +1,195 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Trigram index used to speed up searching for substrings in text columns.
+
+Searching a text column for a substring (for example fqdn:*example* in the
+search bar) normally means a LIKE comparison against every row in the table,
+because an ordinary index can't help with a leading wildcard. For the columns listed in :data:`indexed_columns`,
+Beaker also records every three-character sequence (trigram) occurring in each
+value. A row can only match a term if its value contains all of the term's
+trigrams, so the index is used to find the few candidate rows first, and the
+original comparison is then applied to only those rows.
+
+The index is updated whenever an indexed column is flushed by the ORM. Rows
+which existed before the index was created are filled in by the
+search-index-trigrams online data migration, and the index is not used for
+searching until that migration is finished.
+"""
+
+import re
+import time
+import unicodedata
+from itertools import chain
+from sqlalchemy import Table, Column, Index, Integer, Unicode, event
+from sqlalchemy.sql import select, and_, false, func
+from sqlalchemy.orm import Session, class_mapper, object_mapper
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.exc import UnmappedClassError
+from turbogears import config
+from turbogears.database import session
+from .base import DeclarativeMappedObject
+from .migration import DataMigration
+
+#: Columns covered by the search index, as table.column
+indexed_columns = frozenset([
+    u'system.fqdn',
+    u'job.whiteboard',
+    u'task.name',
+    u'activity.old_value',
+    u'activity.new_value',
+])
+
+search_index_trigram = Table('search_index_trigram', DeclarativeMappedObject.metadata,
+    Column('column_key', Unicode(40), primary_key=True),
+    Column('trigram', Unicode(3), primary_key=True),
+    Column('row_id', Integer, primary_key=True, autoincrement=False),
+    # Trigrams are already case folded, they must be compared exactly
+    mysql_engine='InnoDB',
+    mysql_collate='utf8_bin',
+)
+# for updating the trigrams of a row
+Index('ix_search_index_trigram_column_key_row_id',
+        search_index_trigram.c.column_key, search_index_trigram.c.row_id)
+
+def _fold(text):
+    # Approximates MySQL's case and accent insensitive collation
+    if isinstance(text, str):
+        text = text.decode('utf8')
+    decomposed = unicodedata.normalize('NFKD', text)
+    return u''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+def trigrams(text):
+    """
+    Returns the set of trigrams occurring in *text*.
+    """
+    text = _fold(text)
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+def pattern_trigrams(pattern):
+    """
+    Returns the set of trigrams which must occur in every value matching the
+    SQL LIKE *pattern*.
+    """
+    result = set()
+    for fragment in re.split(r'[%_\\]', pattern):
+        result.update(trigrams(fragment))
+    return result
+
+def _indexed_table_column(column):
+    """
+    If *column* (a mapped attribute or a table column) is in the search index,
+    returns its key and the primary key column of its table. Otherwise returns
+    None.
+    """
+    if hasattr(column, '__clause_element__'):
+        column = column.__clause_element__()
+    # Columns of aliased tables and other expressions can't use the index
+    table = getattr(column, 'table', None)
+    if not isinstance(column, Column) or not isinstance(table, Table):
+        return None
+    key = u'%s.%s' % (table.name, column.name)
+    if key not in indexed_columns:
+        return None
+    primary_key, = table.primary_key.columns
+    return key, primary_key
+
+_index_ready = False
+_index_checked = 0
+
+def _index_is_ready():
+    global _index_ready, _index_checked
+    if not _index_ready and time.time() - _index_checked > 60:
+        _index_checked = time.time()
+        finish_time = session.query(DataMigration.finish_time)\
+                .filter(DataMigration.name == u'search-index-trigrams').scalar()
+        _index_ready = finish_time is not None
+    return _index_ready
+
+def search_index_filter(column, pattern):
+    """
+    Returns a clause limiting the search to rows whose value of *column* could
+    match the SQL LIKE *pattern*, according to the search index. This clause
+    is meant to be combined with the actual comparison.
+
+    Returns None if *column* is not indexed, or if the index does not narrow
+    down the search enough to be worth using.
+    """
+    indexed = _indexed_table_column(column)
+    if indexed is None:
+        return None
+    key, primary_key = indexed
+    needed = pattern_trigrams(pattern)
+    if not needed or not _index_is_ready():
+        return None
+    max_rows = config.get('beaker.search_index_max_rows', 10000)
+    t = search_index_trigram.c
+    row_ids = [row_id for row_id, in session.execute(
+            select([t.row_id])
+            .where(and_(t.column_key == key, t.trigram.in_(needed)))
+            .group_by(t.row_id)
+            .having(func.count() == len(needed))
+            .limit(max_rows + 1))]
+    if len(row_ids) > max_rows:
+        return None
+    if not row_ids:
+        return false()
+    return primary_key.in_(row_ids)
+
+_indexed_attributes_by_class = {}
+
+def _indexed_attributes(cls):
+    """
+    Returns a list of (column key, attribute name) for the indexed columns
+    mapped by *cls*.
+    """
+    if cls not in _indexed_attributes_by_class:
+        result = []
+        try:
+            mapper = class_mapper(cls)
+        except UnmappedClassError:
+            mapper = None
+        if mapper is not None:
+            for prop in mapper.column_attrs:
+                for column in prop.columns:
+                    if not isinstance(column.table, Table):
+                        continue
+                    key = u'%s.%s' % (column.table.name, column.name)
+                    if key in indexed_columns:
+                        result.append((key, prop.key))
+        _indexed_attributes_by_class[cls] = result
+    return _indexed_attributes_by_class[cls]
+
+@event.listens_for(Session, 'after_flush')
+def _update_search_index(session, flush_context):
+    stale = {} # column key -> set of row ids
+    new_rows = []
+    for obj in chain(session.new, session.dirty, session.deleted):
+        attributes = _indexed_attributes(type(obj))
+        if not attributes:
+            continue
+        row_id, = object_mapper(obj).primary_key_from_instance(obj)
+        is_new = obj in session.new
+        is_deleted = obj in session.deleted
+        for key, attribute in attributes:
+            if not is_new and not is_deleted \
+                    and not get_history(obj, attribute).has_changes():
+                continue
+            if not is_new:
+                stale.setdefault(key, set()).add(row_id)
+            if is_deleted:
+                continue
+            value = getattr(obj, attribute)
+            if value:
+                new_rows.extend(dict(column_key=key, trigram=trigram,
+                        row_id=row_id) for trigram in trigrams(value))
+    t = search_index_trigram.c
+    for key, row_ids in stale.iteritems():
+        session.execute(search_index_trigram.delete().where(
+                and_(t.column_key == key, t.row_id.in_(row_ids))))
+    if new_rows:
+        session.execute(search_index_trigram.insert(), new_rows)
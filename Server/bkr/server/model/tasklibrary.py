@@ -8,6 +8,8 @@
 from datetime import datetime
 import subprocess
 import shutil
+import tempfile
+import hashlib
 import logging
 import rpm
 import lxml.etree
@@ -19,7 +21,7 @@
 from sqlalchemy.orm import relationship
 from turbogears.config import get
 from bkr.common.helpers import (AtomicFileReplacement, Flock,
-                                makedirs_ignore, unlink_ignore)
+                                makedirs_ignore, unlink_ignore, atomic_symlink)
 from bkr.server import identity, testinfo
 from bkr.server.bexceptions import BX
 from bkr.server.hybrid import hybrid_method
@@ -158,23 +160,74 @@ def _link_rpms(self, dst):
             unlink_ignore(dstpath)
             os.link(srcpath, dstpath)
 
-    def make_snapshot_repo(self, repo_dir):
-        """Create a snapshot of the current state of the task library"""
+    def _ensure_repodata(self):
         # This should only run if we are missing repodata in the rpms path
         # since this should normally be updated when new tasks are uploaded
         src_meta = os.path.join(self.rpmspath, 'repodata')
         if not os.path.isdir(src_meta):
             log.info("Task library repodata missing, generating...")
             self.update_repo()
-        dst_meta = os.path.join(repo_dir, 'repodata')
-        if os.path.isdir(dst_meta):
-            log.info("Destination repodata already exists, skipping snapshot")
-        else:
-            # Copy updated repo to recipe specific repo
-            log.debug("Generating task library snapshot")
-            with Flock(self.rpmspath):
-                self._link_rpms(repo_dir)
-                shutil.copytree(src_meta, dst_meta)
+        return src_meta
+
+    def _current_generation(self):
+        # Internal call that assumes the flock is already held
+        # Every createrepo run produces a different repomd.xml (it includes 
+        # timestamps and checksums of the other metadata files) so its hash 
+        # identifies the current state of the library.
+        repomd = os.path.join(self.rpmspath, 'repodata', 'repomd.xml')
+        with open(repomd, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def link_snapshot_repo(self, repo_link, snapshots_dir):
+        """
+        Points repo_link at a snapshot of the current state of the task 
+        library.
+
+        Snapshots are created in snapshots_dir, one for each state of the 
+        library, and are shared by every recipe which links to them. The first 
+        recipe after the library changes pays for creating the snapshot. 
+        Snapshots which are no longer linked from any recipe in the same 
+        directory as repo_link are removed at that point too.
+        """
+        self._ensure_repodata()
+        makedirs_ignore(snapshots_dir, 0755)
+        with Flock(self.rpmspath):
+            generation = self._current_generation()
+            snapshot = os.path.join(snapshots_dir, generation)
+            if not os.path.isdir(snapshot):
+                log.debug("Generating task library snapshot %s", generation)
+                temp_dir = tempfile.mkdtemp(prefix='.' + generation,
+                        dir=snapshots_dir)
+                try:
+                    os.chmod(temp_dir, 0755)
+                    self._link_rpms(temp_dir)
+                    shutil.copytree(os.path.join(self.rpmspath, 'repodata'),
+                            os.path.join(temp_dir, 'repodata'))
+                    os.rename(temp_dir, snapshot)
+                except:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    raise
+                self._remove_unused_snapshots(os.path.dirname(repo_link),
+                        snapshots_dir, keep=generation)
+            # The link is created while holding the lock, so that the 
+            # snapshot cannot be removed before it is in use.
+            atomic_symlink(os.path.relpath(snapshot, os.path.dirname(repo_link)),
+                    repo_link)
+
+    def _remove_unused_snapshots(self, repos_dir, snapshots_dir, keep):
+        # Internal call that assumes the flock is already held
+        in_use = set([keep])
+        for name in os.listdir(repos_dir):
+            path = os.path.join(repos_dir, name)
+            if os.path.islink(path):
+                in_use.add(os.path.basename(os.readlink(path)))
+        for name in os.listdir(snapshots_dir):
+            # Names starting with . are left behind by a crash while creating 
+            # a snapshot, nothing else can be using them.
+            if name not in in_use:
+                log.debug("Removing unused task library snapshot %s", name)
+                shutil.rmtree(os.path.join(snapshots_dir, name),
+                        ignore_errors=True)
 
     def update_task(self, rpm_name, write_rpm):
         tasks = self.update_tasks([(rpm_name, write_rpm)])
@@ -400,8 +453,8 @@ def update_task(cls, rpm_name, write_rpm):
         return cls.library.update_task(rpm_name, write_rpm)
 
     @classmethod
-    def make_snapshot_repo(cls, repo_dir):
-        return cls.library.make_snapshot_repo(repo_dir)
+    def link_snapshot_repo(cls, repo_link, snapshots_dir):
+        return cls.library.link_snapshot_repo(repo_link, snapshots_dir)
 
     @staticmethod
     def check_downgrade(old_version, new_version):
@@ -5,13 +5,17 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import re
 import operator
+import threading
 from sqlalchemy import or_, and_, not_, exists
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm import aliased
 import datetime
 from lxml import etree
+from turbogears import config
 
+from bkr.server import metrics
 from bkr.server.model import (Arch, Distro, DistroTree, DistroTag,
                               OSMajor, OSVersion, SystemPool, System, User,
                               Key, Key_Value_Int, Key_Value_String,
@@ -125,7 +129,7 @@ def get_xml_attr(self, attr, typeCast, defaultValue):
     # Note that unrecognised elements become XmlAnd!
 
     def apply_filter(self, query):
-        query, clause = self.filter(query)
+        query, clause = self.compiled_filter(query)
         if clause is not None:
             query = query.filter(clause)
         return query
@@ -133,6 +137,55 @@ def apply_filter(self, query):
     def filter(self, joins):
         return (joins, None)
 
+    #: False if the clause produced by this element's filter() depends on
+    #: anything besides the XML, such as rows looked up in the database, so
+    #: it cannot be reused by :meth:`compiled_filter`.
+    reusable_filter = True
+
+    _compiled_filter = None
+
+    def _filter_is_reusable(self):
+        if not self.reusable_filter:
+            return False
+        for child in self:
+            if isinstance(child, ElementWrapper) and not child._filter_is_reusable():
+                return False
+        return True
+
+    def compiled_filter(self, joins):
+        """
+        Equivalent to :meth:`filter`, except that the joins and clause are
+        only built the first time, and are reused for later calls on this
+        instance. Instances returned by :meth:`from_string` are shared, so
+        recipes with the same XML share the compiled filter too.
+        """
+        compiled = self._compiled_filter
+        if compiled is None:
+            compiled = False
+            if self._filter_is_reusable():
+                recorder = _JoinRecorder()
+                try:
+                    recorder, clause = self.filter(recorder)
+                except _NotRecordable:
+                    pass
+                else:
+                    compiled = (recorder.calls, clause)
+            self._compiled_filter = compiled
+        if compiled is False:
+            return self.filter(joins)
+        calls, clause = compiled
+        for method, args in calls:
+            joins = getattr(joins, method)(*args)
+        return (joins, clause)
+
+    @classmethod
+    def from_string(cls, xml_string):
+        """
+        Returns the wrapped element for the given XML. Parsed filters are
+        cached, so the returned instance is shared and must not be modified.
+        """
+        return filter_cache.get(cls, xml_string)
+
     def filter_disk(self):
         return None
 
@@ -149,6 +202,74 @@ def virtualisable(self):
         return False
 
 
+class _NotRecordable(Exception):
+    pass
+
+class _JoinRecorder(object):
+    """
+    Stands in for the query passed to filter(), recording the joins so that
+    they can be repeated on other queries.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def join(self, *args):
+        self.calls.append(('join', args))
+        return self
+
+    def outerjoin(self, *args):
+        self.calls.append(('outerjoin', args))
+        return self
+
+    def __getattr__(self, name):
+        # the filter did something besides joining
+        raise _NotRecordable(name)
+
+class FilterCache(object):
+    """
+    Remembers parsed hostRequires and distroRequires filters, keyed by their
+    XML with the whitespace between elements removed, so that recipes with
+    identical requirements are parsed and compiled into clauses only once
+    per process. The least recently used filters are discarded once there
+    are more than beaker.filter_cache_size of them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: dict of (key -> [wrapped element, time last used])
+        self.entries = {}
+        self.clock = 0
+
+    def get(self, cls, xml_string):
+        if isinstance(xml_string, unicode):
+            xml_string = xml_string.encode('utf8')
+        key = (cls, re.sub(r'>\s+<', '><', xml_string.strip()))
+        with self.lock:
+            self.clock += 1
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[1] = self.clock
+        if entry is not None:
+            metrics.increment('counters.filter_cache_hits')
+            return entry[0]
+        metrics.increment('counters.filter_cache_misses')
+        wrapped = cls(etree.fromstring(xml_string))
+        max_entries = config.get('beaker.filter_cache_size', 1000)
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= max_entries:
+                # evict the least recently used entry
+                oldest = min(self.entries, key=lambda k: self.entries[k][1])
+                del self.entries[oldest]
+            self.entries[key] = [wrapped, self.clock]
+        return wrapped
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+filter_cache = FilterCache()
+
 class XmlAnd(ElementWrapper):
     subclassDict = None
 
@@ -337,6 +458,8 @@ class XmlPool(ElementWrapper):
     Filter based on pool
     """
 
+    reusable_filter = False
+
     op_table = { '=' : '__eq__',
                  '==' : '__eq__',
                  '!=' : '__ne__'}
@@ -369,6 +492,9 @@ class XmlKeyValue(ElementWrapper):
     """
     Filter based on key_value
     """
+
+    reusable_filter = False
+
     def filter(self, joins):
         key = self.get_xml_attr('key', unicode, None)
         op = self.op_table[self.get_xml_attr('op', unicode, '==')]
@@ -933,6 +1059,8 @@ class XmlArch(ElementWrapper):
     Pick a system with the correct arch
     """
 
+    reusable_filter = False
+
     op_table = { '=' : '__eq__',
                  '==' : '__eq__',
                  '!=' : '__ne__'}
@@ -1201,7 +1329,7 @@ class XmlHost(XmlAnd):
     @classmethod
     def from_string(cls, xml_string):
         try:
-            return cls(etree.fromstring(xml_string))
+            return super(XmlHost, cls).from_string(xml_string)
         except etree.XMLSyntaxError as e:
             raise ValueError('Invalid XML syntax for host filter: %s' % e)
 
@@ -1250,13 +1378,5 @@ class XmlDistro(XmlAnd):
 
 def apply_distro_filter(filter, query):
     if isinstance(filter, basestring):
-        filter = XmlDistro(etree.fromstring(filter))
-    clauses = []
-    for child in filter:
-        if callable(getattr(child, 'filter', None)):
-            (query, clause) = child.filter(query)
-            if clause is not None:
-                clauses.append(clause)
-    if clauses:
-        query = query.filter(and_(*clauses))
-    return query
+        filter = XmlDistro.from_string(filter)
+    return filter.apply_filter(query)
@@ -54,7 +54,7 @@ def get_pools():
         'name': SystemPool.name,
         'owner.user_name': User.user_name,
         'owner.group_name': Group.group_name,
-    })
+    }, keyset=[SystemPool.name])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
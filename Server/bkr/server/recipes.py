@@ -128,6 +128,32 @@ def files(self, recipe_id):
             recipe = Recipe.by_id(recipe_id)
         except InvalidRequestError:
             raise BX(_('Invalid recipe ID: %s' % recipe_id))
+        return self._recipe_files(recipe)
+
+    @cherrypy.expose
+    @identity.require(identity.not_anonymous())
+    def files_many(self, recipe_ids):
+        """
+        Returns the logs for each of the given recipes, as a dict mapping each
+        recipe ID (as a string) to an array of logs like :meth:`files`.
+
+        beaker-transfer uses this to fetch the logs for a whole batch of
+        recipes in one call.
+        """
+        recipes = self._recipes_by_ids(recipe_ids)
+        return dict((str(recipe.id), self._recipe_files(recipe))
+                for recipe in recipes)
+
+    def _recipes_by_ids(self, recipe_ids):
+        if not recipe_ids:
+            return []
+        recipes = Recipe.query.filter(Recipe.id.in_(recipe_ids)).all()
+        if len(recipes) != len(set(recipe_ids)):
+            missing = set(recipe_ids) - set(recipe.id for recipe in recipes)
+            raise BX(_('Invalid recipe ID: %s' % min(missing)))
+        return recipes
+
+    def _recipe_files(self, recipe):
         # Build a list of logs excluding duplicate paths, to mitigate:
         # https://bugzilla.redhat.com/show_bug.cgi?id=963492
         logdicts = []
@@ -158,11 +184,25 @@ def change_files(self, recipe_id, server, basepath):
             recipe = Recipe.by_id(recipe_id)
         except InvalidRequestError:
             raise BX(_('Invalid recipe ID: %s' % recipe_id))
+        self._change_recipe_files(recipe, server, basepath)
+        return True
+
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def change_files_many(self, recipe_ids, server, basepath):
+        """
+        Like :meth:`change_files`, but for each of the given recipes at once.
+        """
+        recipes = self._recipes_by_ids(recipe_ids)
+        for recipe in recipes:
+            self._change_recipe_files(recipe, server, basepath)
+        return True
+
+    def _change_recipe_files(self, recipe, server, basepath):
         for mylog in recipe.all_logs():
             mylog.server = '%s/%s/' % (server, mylog.parent.filepath)
             mylog.basepath = '%s/%s/' % (basepath, mylog.parent.filepath)
         recipe.log_server = urlparse.urlparse(server)[1]
-        return True
 
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
@@ -12,7 +12,12 @@
 from bkr.server.xmlrpccontroller import RPCRoot
 #from bkr.server.helpers import *
 from bkr.common.bexceptions import BX
+import sys
+import base64
+import struct
+import zlib
 import urlparse
+import xmlrpclib
 #from turbogears.scheduler import add_interval_task
 
 import cherrypy
@@ -20,12 +25,41 @@
 from bkr.server.model import (session, RecipeTask, LogRecipeTask,
                               RecipeTaskResult, LogRecipeTaskResult,
                               LabController, Watchdog, ResourceType,
+                              Recipe, RecipeResource,
                               RecipeTaskComment, RecipeTaskResultComment)
 from flask import redirect, request, jsonify
 from bkr.server.app import app
 from bkr.server.flask_util import auth_required, convert_internal_errors, \
     BadRequest400, NotFound404, Forbidden403, read_json_request
 
+_watchdog_cursor_entry = struct.Struct('!II') # recipe id, crc32 of the rest
+
+def _watchdog_entry_checksum(watchdog):
+    return zlib.crc32('%s %s' % (watchdog['system'],
+            watchdog['is_virt_recipe'])) & 0xffffffff
+
+def _encode_watchdog_cursor(watchdogs):
+    entries = sorted((w['recipe_id'], _watchdog_entry_checksum(w))
+            for w in watchdogs)
+    packed = ''.join(_watchdog_cursor_entry.pack(*entry) for entry in entries)
+    return '1:' + base64.b64encode(zlib.compress(packed))
+
+def _decode_watchdog_cursor(cursor):
+    """
+    Returns a dict of recipe id -> checksum for the watchdogs which the cursor 
+    was issued for, or None if the cursor is not valid.
+    """
+    if not cursor or not cursor.startswith('1:'):
+        return None
+    try:
+        packed = zlib.decompress(base64.b64decode(cursor[2:]))
+    except (TypeError, zlib.error):
+        return None
+    if len(packed) % _watchdog_cursor_entry.size:
+        return None
+    return dict(_watchdog_cursor_entry.unpack_from(packed, offset)
+            for offset in xrange(0, len(packed), _watchdog_cursor_entry.size))
+
 class RecipeTasks(RPCRoot):
     # For XMLRPC methods in this class.
     exposed = True
@@ -122,13 +156,7 @@ def register_result_file(self, server, result_id, path, filename, basepath):
         return '%s' % result.filepath
 
 
-    @cherrypy.expose
-    def watchdogs(self, status='active',lc=None):
-        """ Return all active/expired tasks for this lab controller
-            The lab controllers login with host/fqdn
-        """
-        # TODO work on logic that determines whether or not originator
-        # was qpid or kobo ?
+    def _get_labcontroller(self, lc=None):
         if lc is None:
             try:
                 labcontroller = identity.current.user.lab_controller
@@ -142,10 +170,64 @@ def watchdogs(self, status='active',lc=None):
                 labcontroller = LabController.by_name(lc)
             except InvalidRequestError:
                 raise BX(_(u'Invalid lab controller: %s' % lc))
+        return labcontroller
+
+    def _watchdogs(self, labcontroller, status):
+        query = Watchdog.by_status(labcontroller, status)
+        if query is None:
+            raise BX(_(u'Invalid watchdog status: %s' % status))
+        # Fetch just the columns we need in one query, rather than loading 
+        # each recipe and its resource in turn.
+        rows = query.join(Recipe.resource).with_entities(Recipe.id,
+                RecipeResource.fqdn, RecipeResource.type)
+        return [dict(recipe_id=recipe_id,
+                     system=fqdn,
+                     is_virt_recipe=(resource_type == ResourceType.virt))
+                for recipe_id, fqdn, resource_type in rows]
 
-        return [dict(recipe_id = w.recipe.id,
-                     system = w.recipe.resource.fqdn,
-                     is_virt_recipe = (w.recipe.resource.type == ResourceType.virt)) for w in Watchdog.by_status(labcontroller, status)]
+    @cherrypy.expose
+    def watchdogs(self, status='active',lc=None):
+        """ Return all active/expired tasks for this lab controller
+            The lab controllers login with host/fqdn
+        """
+        # TODO work on logic that determines whether or not originator
+        # was qpid or kobo ?
+        return self._watchdogs(self._get_labcontroller(lc), status)
+
+    @cherrypy.expose
+    def watchdog_changes(self, cursor=None, status='active', lc=None):
+        """
+        Returns the changes to the watchdogs for this lab controller since 
+        *cursor* was issued, as a struct with the following keys:
+
+        ``cursor``
+            Opaque string to pass in the next call.
+        ``full``
+            True if *cursor* was not given or not valid, in which case 
+            ``added`` holds every watchdog and the caller should forget any 
+            others it knows about.
+        ``added``
+            Watchdogs which have appeared (or whose system has changed), in 
+            the same form returned by :meth:`watchdogs`.
+        ``removed``
+            Recipe ids of watchdogs which have gone away (or whose system has 
+            changed).
+        """
+        current = self._watchdogs(self._get_labcontroller(lc), status)
+        new_cursor = _encode_watchdog_cursor(current)
+        previous = _decode_watchdog_cursor(cursor)
+        if previous is None:
+            return {'cursor': new_cursor, 'full': True,
+                    'added': current, 'removed': []}
+        added = []
+        for watchdog in current:
+            checksum = previous.pop(watchdog['recipe_id'], None)
+            if checksum != _watchdog_entry_checksum(watchdog):
+                if checksum is not None:
+                    previous[watchdog['recipe_id']] = checksum
+                added.append(watchdog)
+        return {'cursor': new_cursor, 'full': False,
+                'added': added, 'removed': sorted(previous)}
 
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
@@ -235,6 +317,58 @@ def result(self, task_id, result_type, path=None, score=None, summary=None):
         kwargs = dict(path=path, score=score, summary=summary)
         return getattr(task,result_type)(**kwargs)
 
+    # Methods which the lab controller is allowed to batch through bulk()
+    bulk_methods = frozenset([
+        'recipes.register_file',
+        'recipes.extend',
+        'recipes.tasks.register_file',
+        'recipes.tasks.register_result_file',
+        'recipes.tasks.start',
+        'recipes.tasks.extend',
+        'recipes.tasks.stop',
+        'recipes.tasks.update',
+        'recipes.tasks.result',
+    ])
+
+    @cherrypy.expose
+    @identity.require(identity.not_anonymous())
+    def bulk(self, calls):
+        """
+        XML-RPC method used by the lab controller to submit many harness calls
+        in a single request. *calls* is a list of [method, params] pairs, which
+        are applied in order. Each call is applied in its own savepoint, so
+        a call which fails does not affect the others.
+
+        Returns a list with one struct for each call, either {'result': ...}
+        or {'faultCode': ..., 'faultString': ...}.
+        """
+        outcomes = []
+        for method, params in calls:
+            if method not in self.bulk_methods:
+                outcomes.append({'faultCode': 1, 'faultString':
+                        'XML-RPC method %s cannot be called in bulk' % method})
+                continue
+            savepoint = session.begin_nested()
+            try:
+                result = self.process_rpc(method, params)
+            except xmlrpclib.Fault, fault:
+                outcome = {'faultCode': fault.faultCode,
+                           'faultString': fault.faultString}
+            except Exception:
+                outcome = {'faultCode': 1,
+                           'faultString': '%s:%s' % sys.exc_info()[:2]}
+            else:
+                outcome = {'result': result}
+            # _warn_once() commits the savepoint itself before raising, so
+            # that its warning is kept.
+            if savepoint.is_active:
+                if 'result' in outcome:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+            outcomes.append(outcome)
+        return outcomes
+
     @expose(format='json')
     def to_xml(self, id):
         taskxml = RecipeTask.by_id(id).to_xml().toprettyxml()
@@ -20,6 +20,7 @@
 from sqlalchemy.orm import aliased, joinedload
 from turbogears.database import session
 from bkr.server.model import Key as KeyModel
+from bkr.server.model.search import search_index_filter
 from bkr.common.bexceptions import BeakerException
 import logging
 log = logging.getLogger(__name__)
@@ -54,6 +55,17 @@ def _lucene_coerce_for_column(column, term):
     else: # treat everything else as a string
         return term
 
+def _narrow_with_search_index(column, pattern, clause):
+    """
+    Combines *clause*, which matches *column* against the SQL LIKE *pattern*, 
+    with a lookup in the search index if the column is indexed. LIKE patterns 
+    with a leading wildcard can't use an ordinary index on the column.
+    """
+    index_clause = search_index_filter(column, pattern)
+    if index_clause is None:
+        return clause
+    return and_(index_clause, clause)
+
 class _LuceneTermQuery(object):
 
     def __init__(self, text):
@@ -71,7 +83,9 @@ def apply(self, column):
             return and_(column >= value,
                     column <= value.replace(hour=23, minute=59, second=59))
         if isinstance(column.type, sqlalchemy.types.String) and '*' in value:
-            return column.like(value.replace('*', '%'))
+            pattern = value.replace('*', '%')
+            return _narrow_with_search_index(column, pattern,
+                    column.like(pattern))
         return column == value
 
 class _LuceneRangeQuery(object):
@@ -119,16 +133,109 @@ def _apply_lucene_query(lucene_query, chain):
     else:
         return chain[0].any(_apply_lucene_query(lucene_query, chain[1:]))
 
-_lucene_query_pattern = re.compile(r"""
-    (?P<negation>-)?
-    (?:(?P<field>[^'"\s]+):)?
-    (?:['"](?P<quoted_term>[^'"]*)['"]
-    |  (?P<range_term>[\[{] \s* (?P<range_start>[^\]}]*) \s+ TO \s+ (?P<range_end>[^\]}]*) \s* [\]}])
-    |  (?P<malformed_range>[\[{] [^\]}]* [\]}])
-    |  (?P<term>\S+)
-    )""",
+_lucene_token_pattern = re.compile(r"""
+    (?P<open>(?P<group_negation>-)?(?:(?P<group_field>[^'"\s()]+):)?\()
+    |  (?P<close>\))
+    |  (?P<operator>AND|OR|NOT|&&|\|\|)(?=[\s()]|$)
+    |  (?P<negation>-)?
+       (?:(?P<field>[^'"\s()]+):)?
+       (?:['"](?P<quoted_term>[^'"]*)['"]
+       |  (?P<range_term>[\[{] \s* (?P<range_start>[^\]}]*) \s+ TO \s+ (?P<range_end>[^\]}]*) \s* [\]}])
+       |  (?P<malformed_range>[\[{] [^\]}]* [\]}])
+       |  (?P<term>[^\s()]+)
+       )""",
     re.VERBOSE)
 
+class _LuceneQueryParser(object):
+    """
+    Recursive descent parser for the subset of Lucene syntax understood by 
+    :func:`lucene_to_sqlalchemy`.
+    """
+
+    def __init__(self, querystring, search_columns, default_columns):
+        self.tokens = list(_lucene_token_pattern.finditer(querystring))
+        self.position = 0
+        self.search_columns = search_columns
+        self.default_columns = default_columns
+
+    def parse(self):
+        clause = self._parse_clauses(field=None, nested=False)
+        if clause is None:
+            return and_()
+        return clause
+
+    def _parse_clauses(self, field, nested):
+        # Clauses are ANDed together unless they are separated by OR, and AND 
+        # binds more tightly, so "a b OR c" means "(a AND b) OR c". Returns 
+        # None if there are no clauses.
+        alternatives = [[]]
+        negate_next = False
+        while self.position < len(self.tokens):
+            match = self.tokens[self.position]
+            self.position += 1
+            if match.group('close') is not None:
+                if nested:
+                    break
+                continue # unbalanced, ignore it
+            operator = match.group('operator')
+            if operator in ('OR', '||'):
+                if alternatives[-1]:
+                    alternatives.append([])
+                continue
+            elif operator == 'NOT':
+                negate_next = True
+                continue
+            elif operator is not None: # AND is the default anyway
+                continue
+            if match.group('open') is not None:
+                # An unbalanced group extends to the end of the query.
+                clause = self._parse_clauses(
+                        field=match.group('group_field') or field, nested=True)
+                negated = match.group('group_negation')
+            else:
+                clause = self._parse_term(match, field)
+                negated = match.group('negation')
+            if clause is None:
+                negate_next = False
+                continue
+            if negated:
+                clause = not_(clause)
+            if negate_next:
+                clause = not_(clause)
+                negate_next = False
+            alternatives[-1].append(clause)
+        alternatives = [clauses for clauses in alternatives if clauses]
+        if not alternatives:
+            return None
+        if len(alternatives) == 1:
+            return and_(*alternatives[0])
+        return or_(*[and_(*clauses) for clauses in alternatives])
+
+    def _parse_term(self, match, field):
+        if match.group('range_term') is not None:
+            start = match.group('range_start')
+            end = match.group('range_end')
+            start_inclusive = match.group('range_term').startswith('[')
+            end_inclusive = match.group('range_term').endswith(']')
+            lucene_query = _LuceneRangeQuery(start, end,
+                    start_inclusive, end_inclusive)
+        elif match.group('malformed_range') is not None:
+            lucene_query = _LuceneTermQuery(match.group('malformed_range'))
+        elif match.group('quoted_term') is not None:
+            lucene_query = _LuceneTermQuery(match.group('quoted_term'))
+        else:
+            lucene_query = _LuceneTermQuery(match.group('term'))
+        field = match.group('field') or field
+        if field is None:
+            alternatives = []
+            for column in self.default_columns:
+                alternatives.append(_apply_lucene_query(lucene_query, column))
+            return or_(*alternatives)
+        elif field in self.search_columns:
+            return _apply_lucene_query(lucene_query, self.search_columns[field])
+        else:
+            return false()
+
 def lucene_to_sqlalchemy(querystring, search_columns, default_columns):
     """
     Parses the given *querystring* using a Lucene-like syntax and converts it 
@@ -155,40 +262,19 @@ def lucene_to_sqlalchemy(querystring, search_columns, default_columns):
     which will be used for matching terms in the query string which don't have 
     an explicit field name.
 
+    Terms can be grouped with parentheses, as in -(a b) or field:(a OR b), 
+    and combined with the AND, OR and NOT operators. Terms are ANDed together 
+    by default. Wildcard terms matched against a column in the search index 
+    (see :mod:`bkr.server.model.search`) use the index to narrow down the 
+    search.
+
     Maybe one day we will be using Lucene/Solr for real...
     """
     # This only understands the subset of Lucene syntax used by the search 
-    # bar. In particular, grouping using parentheses is not supported.
-    # We should probably use a proper parser instead of a hacky regexp.
-    clauses = []
-    for match in _lucene_query_pattern.finditer(querystring):
-        if match.group('range_term') is not None:
-            start = match.group('range_start')
-            end = match.group('range_end')
-            start_inclusive = match.group('range_term').startswith('[')
-            end_inclusive = match.group('range_term').endswith(']')
-            lucene_query = _LuceneRangeQuery(start, end,
-                    start_inclusive, end_inclusive)
-        elif match.group('malformed_range') is not None:
-            lucene_query = _LuceneTermQuery(match.group('malformed_range'))
-        elif match.group('quoted_term') is not None:
-            lucene_query = _LuceneTermQuery(match.group('quoted_term'))
-        else:
-            lucene_query = _LuceneTermQuery(match.group('term'))
-        if match.group('field') is None:
-            alternatives = []
-            for column in default_columns:
-                alternatives.append(_apply_lucene_query(lucene_query, column))
-            clause = or_(*alternatives)
-        elif match.group('field') in search_columns:
-            column = search_columns[match.group('field')]
-            clause = _apply_lucene_query(lucene_query, column)
-        else:
-            clause = false()
-        if match.group('negation'):
-            clause = not_(clause)
-        clauses.append(clause)
-    return and_(*clauses)
+    # bar. Malformed queries are interpreted as best we can, rather than 
+    # rejected.
+    return _LuceneQueryParser(querystring, search_columns,
+            default_columns).parse()
 
 class MyColumn(object):
     """
@@ -461,13 +547,14 @@ def not_equal(self,x,y):
     def equals(self,x,y):    
         wildcard_y = re.sub('\*','%',y)
         if wildcard_y != y: #looks like we found a wildcard
-            return x.like(wildcard_y)
+            return _narrow_with_search_index(x, wildcard_y, x.like(wildcard_y))
         if not y:
             return or_(x == None,x==y)
         return x == y
 
     def contains(self,x,y): 
-        return x.like('%%%s%%' % y )
+        pattern = '%%%s%%' % y
+        return _narrow_with_search_index(x, pattern, x.like(pattern))
  
     def return_function(self,type,operator,loose_match=True):
         """
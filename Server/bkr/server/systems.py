@@ -7,7 +7,6 @@
 import logging
 import xmlrpclib
 import datetime
-import urlparse
 from sqlalchemy import and_, desc
 from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm.exc import NoResultFound
@@ -17,7 +16,7 @@
 from bkr.server.bexceptions import BX, InsufficientSystemPermissions
 from bkr.server.model import System, SystemActivity, SystemStatus, SystemPool, \
         DistroTree, OSMajor, DistroTag, Arch, Distro, User, Group, SystemAccessPolicy, \
-        SystemPermission, SystemAccessPolicyRule, ImageType, KernelType, \
+        SystemPermission, SystemAccessPolicyRule, KernelType, \
         VirtResource, Hypervisor, Numa, LabController, SystemType, \
         Command, Power, PowerType, ReleaseAction, Task, \
         Recipe, RecipeSet, RecipeTask, RecipeResource, Job, TaskStatus, \
@@ -1242,7 +1241,7 @@ def get_system_command_queue(fqdn):
         'action': Command.action,
         'message': Command.error_message,
         'status': Command.status,
-    })
+    }, keyset=[Command.queue_time.desc(), Command.id.desc()])
     return jsonify(json_result)
 
 @app.route('/systems/<fqdn>/commands/', methods=['POST'])
@@ -1341,7 +1340,7 @@ def get_system_activity(fqdn):
         'action': SystemActivity.action,
         'old_value': SystemActivity.old_value,
         'new_value': SystemActivity.new_value,
-    })
+    }, keyset=[SystemActivity.id.desc()])
     return jsonify(json_result)
 
 @app.route('/systems/<fqdn>/executed-tasks/', methods=['GET'])
@@ -1396,7 +1395,7 @@ def get_system_executed_tasks(fqdn):
     }, extra_sort_columns={
         't_id': RecipeTask.id,
         'distro_tree': (Distro.name, DistroTree.variant, Arch.arch),
-    })
+    }, keyset=[RecipeTask.id.desc()])
     return jsonify(json_result)
 
 # This is part of the iPXE-based installation support for OpenStack instances.
@@ -1412,21 +1411,12 @@ def ipxe_script(uuid):
         # We need to handle this case because the VM is created and boots up 
         # *before* we generate the kickstart etc
         raise ServiceUnavailable503('Recipe has not been provisioned yet')
-    distro_tree = recipe.distro_tree
-    distro_tree_url = distro_tree.url_in_lab(resource.lab_controller,
-            scheme=['http', 'ftp'])
-    kernel = distro_tree.image_by_type(ImageType.kernel,
-            KernelType.by_name(u'default'))
-    if not kernel:
-        raise BadRequest400('Kernel image not found for distro tree %s'
-                % distro_tree.id)
-    initrd = recipe.distro_tree.image_by_type(ImageType.initrd,
-            KernelType.by_name(u'default'))
-    if not initrd:
-        raise BadRequest400('Initrd image not found for distro tree %s'
-                % distro_tree.id)
-    kernel_url = urlparse.urljoin(distro_tree_url, kernel.path)
-    initrd_url = urlparse.urljoin(distro_tree_url, initrd.path)
+    try:
+        kernel_url, initrd_url = recipe.distro_tree.netboot_images(
+                resource.lab_controller, KernelType.by_name(u'default'),
+                scheme=['http', 'ftp'])
+    except ValueError as e:
+        raise BadRequest400(unicode(e))
     kernel_options = recipe.installation.kernel_options + ' netboot_method=ipxe'
 
     # strip out netbootloader=.. string since it doesn't make sense for
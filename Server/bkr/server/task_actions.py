@@ -21,8 +21,14 @@
 * TR: Result within a task
 """
 
+import time
+import zlib
+from collections import defaultdict
 import lxml.etree
+from sqlalchemy import select
 from sqlalchemy.exc import InvalidRequestError
+from turbogears import config
+from turbogears.database import session
 from bkr.server import identity
 from bkr.server.model import (Job, RecipeSet, Recipe,
                               RecipeTask, RecipeTaskResult, TaskBase)
@@ -56,6 +62,89 @@ def task_info(self, taskid,flat=True):
         """
         return TaskBase.get_by_t_id(taskid).task_info()
 
+    #: How often task_info_many checks for changes while it is waiting.
+    task_poll_interval = 2
+
+    @cherrypy.expose
+    def task_info_many(self, taskids, version=None, timeout=0):
+        """
+        Bulk version of :meth:`task_info`, used by :program:`bkr job-watch`.
+
+        Returns the state of each of the given job components whose state has
+        changed since *version*, which is the version string returned by
+        a previous call. If *version* is not given, the state of every
+        component is returned.
+
+        If nothing has changed, waits up to *timeout* seconds (capped by the 
+        server) for the status or result of any of the components to change, 
+        and returns as soon as one does. The new state is returned by the 
+        next call, so the caller should call again straight away.
+
+        The return value is a struct with keys ``tasks``, a struct of (taskid
+        -> struct in the same form as :meth:`task_info`), and ``version``,
+        which should be passed in the next call.
+
+        :param taskids: see above
+        :type taskids: array of strings
+        :param version: version string returned by a previous call
+        :type version: string
+        :param timeout: seconds to wait for a change
+        :type timeout: number
+        """
+        last_seen = {}
+        if version:
+            for item in version.split():
+                taskid, fingerprint = item.rsplit('=', 1)
+                last_seen[taskid] = fingerprint
+        tasks = TaskBase.get_many_by_t_id(taskids)
+        changed = {}
+        fingerprints = {}
+        for taskid, task in tasks.iteritems():
+            info = task.task_info()
+            fingerprints[taskid] = '%08x' % (
+                    zlib.crc32(repr(sorted(info.items()))) & 0xffffffff)
+            if last_seen.get(taskid) != fingerprints[taskid]:
+                changed[taskid] = info
+        if not changed and timeout:
+            self._wait_for_change(tasks.values(), min(float(timeout),
+                    config.get('beaker.max_task_poll_timeout', 10)))
+        version = ' '.join('%s=%s' % (taskid, fingerprint)
+                for taskid, fingerprint in sorted(fingerprints.iteritems()))
+        return {'tasks': changed, 'version': version}
+
+    def _wait_for_change(self, tasks, timeout):
+        """
+        Waits up to *timeout* seconds for the status or result of any of the 
+        given job components to differ from what this request has loaded.
+
+        The checks are plain queries of the status and result columns, run on 
+        their own connection so that they see changes committed by other 
+        processes without touching the request's transaction.
+        """
+        columns_by_table = {}
+        ids_by_table = defaultdict(list)
+        seen = {}
+        for task in tasks:
+            table = task.__table__
+            if table not in columns_by_table:
+                columns_by_table[table] = [column for column in
+                        (table.c.get('status'), table.c.result)
+                        if column is not None]
+            ids_by_table[table].append(task.id)
+            seen[table.name, task.id] = tuple(getattr(task, column.name)
+                    for column in columns_by_table[table])
+        engine = session.get_bind()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(min(self.task_poll_interval,
+                    max(0, deadline - time.time())))
+            for table, ids in ids_by_table.iteritems():
+                query = select([table.c.id] + columns_by_table[table])\
+                        .where(table.c.id.in_(ids))
+                for row in engine.execute(query):
+                    if tuple(row)[1:] != seen[table.name, row[0]]:
+                        return
+
     @cherrypy.expose
     def to_xml(self, taskid, clone=False, exclude_enclosing_job=True, include_logs=True):
         """
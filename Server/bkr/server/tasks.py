@@ -457,7 +457,7 @@ def get_tasks():
         'type': (Task.types, TaskType.type),
         'excluded_arch': (Task.excluded_arches, Arch.arch),
         'excluded_osmajor': (Task.excluded_osmajors, OSMajor.osmajor),
-    })
+    }, keyset=[Task.name])
 
     if request_wants_json():
         return jsonify(json_result)
@@ -0,0 +1,75 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import socket
+import time
+import unittest2 as unittest
+from bkr.server.metrics import CarbonSender
+
+class CarbonSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(5)
+        self.addCleanup(self.receiver.close)
+
+    def receive_all(self):
+        datagrams = []
+        self.receiver.setblocking(False)
+        while True:
+            try:
+                datagrams.append(self.receiver.recv(65536))
+            except socket.error:
+                return datagrams
+
+    def test_metrics_are_batched_into_datagrams(self):
+        # long interval so that only our explicit flush sends anything
+        sender = CarbonSender(self.receiver.getsockname(), 'beaker.',
+                flush_interval=3600, max_datagram_size=200)
+        self.addCleanup(sender.close)
+        for i in range(50):
+            sender.send('gauges.test_%d' % i, i, 1234567890)
+        sender.flush()
+        datagrams = self.receive_all()
+        self.assertGreater(len(datagrams), 1)
+        self.assertLess(len(datagrams), 50)
+        lines = []
+        for datagram in datagrams:
+            self.assertLessEqual(len(datagram), 200)
+            lines.extend(datagram.splitlines())
+        self.assertEquals(lines, ['beaker.gauges.test_%d %d 1234567890' % (i, i)
+                for i in range(50)])
+
+    def test_counters_are_aggregated(self):
+        sender = CarbonSender(self.receiver.getsockname(), 'beaker.',
+                flush_interval=3600)
+        self.addCleanup(sender.close)
+        for _ in range(10):
+            sender.add_counter('counters.a')
+        sender.add_counter('counters.b', 5)
+        sender.flush()
+        lines = ''.join(self.receive_all()).splitlines()
+        self.assertEquals(sorted(line.rsplit(' ', 1)[0] for line in lines),
+                ['beaker.counters.a 10', 'beaker.counters.b 5'])
+
+    def test_unbuffered(self):
+        sender = CarbonSender(self.receiver.getsockname(), 'beaker.',
+                flush_interval=0)
+        sender.send('gauges.test', 1, 1234567890)
+        self.assertEquals(self.receiver.recv(65536),
+                'beaker.gauges.test 1 1234567890\n')
+
+    def test_timestamped_when_sent(self):
+        sender = CarbonSender(self.receiver.getsockname(), 'beaker.',
+                flush_interval=3600)
+        self.addCleanup(sender.close)
+        sender.send('gauges.test', 1)
+        before = int(time.time())
+        sender.flush()
+        after = int(time.time())
+        name, value, timestamp = self.receiver.recv(65536).split()
+        self.assertEquals((name, value), ('beaker.gauges.test', '1'))
+        self.assertTrue(before <= int(timestamp) <= after)
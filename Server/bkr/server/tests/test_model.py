@@ -8,12 +8,10 @@
 # talk to external services belong in the IntegrationTests subdir.
 
 import unittest2 as unittest
-import gzip
 import os
 import re
 import pkg_resources
 import errno
-from lxml import etree
 from tempfile import mkdtemp
 from shutil import copy, rmtree
 from sqlalchemy.schema import MetaData, Table, Column
@@ -116,32 +114,6 @@ def tearDown(self):
         # Make sure sane value is left after test run
         update({'beaker.createrepo_command': 'createrepo_c'})
 
-    def _hash_repodata_file(self, content, total=0):
-        """Returns an int type representation of the XML contents.
-
-        Ordering is not important, as the int representations (returned
-        via the hash() function) are all just added together.
-        """
-        for child in content.getchildren():
-            for pck in child.keys():
-                pck_k_v_text = '%s%s' % (pck.strip(), child.get(pck).strip())
-                total += hash(pck_k_v_text)
-            if child.text is not None:
-                child_text = child.text.strip()
-                if child_text:
-                    total += hash(child_text)
-            total += hash(child.tag.strip())
-            total += self._hash_repodata_file(child, total)
-        return total
-
-    def _assert_xml_equivalence(self, file1, file2):
-        file1_content = etree.fromstring(file1.read().strip())
-        file2_content = etree.fromstring(file2.read().strip())
-        hashed_file1 = self._hash_repodata_file(file1_content)
-        hashed_file2 = self._hash_repodata_file(file2_content)
-        # Assert the contents of the files are indeed the same
-        self.assertEquals(hashed_file2, hashed_file1)
-
     def test_createrepo_c_command(self):
         update({'beaker.createrepo_command': 'createrepo_c'})
         rpm_file = pkg_resources.resource_filename('bkr.server.tests', \
@@ -194,34 +166,36 @@ def test_unlink_rpm(self):
         # if the file has been removed
         self.tasklibrary.unlink_rpm('tmp-distribution-beaker-task_test-2.0-5.noarch.rpm')
 
-    def test_make_snapshot_repo(self):
-        recipe_repo_parent = mkdtemp(prefix='beaker-test_make_snapshot_repo')
-        self.addCleanup(rmtree, recipe_repo_parent)
-        rpm_file = pkg_resources.resource_filename('bkr.server.tests', \
-            'tmp-distribution-beaker-task_test-2.0-5.noarch.rpm')
+    def test_link_snapshot_repo(self):
+        repos_dir = mkdtemp(prefix='beaker-test_link_snapshot_repo')
+        self.addCleanup(rmtree, repos_dir)
+        snapshots_dir = os.path.join(repos_dir, 'snapshots')
+        rpm_name = 'tmp-distribution-beaker-task_test-2.0-5.noarch.rpm'
+        rpm_file = pkg_resources.resource_filename('bkr.server.tests', rpm_name)
         copy(rpm_file, self.tasklibrary.rpmspath)
-        repo_dir = os.path.join(self.tasklibrary.rpmspath, 'repodata')
-        # Assert we don't already have a repodata folder
-        self.assertFalse(os.path.exists(repo_dir))
-        self.tasklibrary.make_snapshot_repo(recipe_repo_parent)
-        # It should now be there in the rpmspath
-        self.assertTrue(os.path.exists(repo_dir))
-        repo_dir_list = os.listdir(repo_dir)
-        recipe_repo_dir = os.path.join(recipe_repo_parent, 'repodata')
-        recipe_repo_dir_list = os.listdir(recipe_repo_dir)
-        # Assert the contents at least appear to be the same
-        self.assertItemsEqual(recipe_repo_dir_list, repo_dir_list)
-        # Now test the actual content
-        for filename in repo_dir_list:
-            if filename.endswith(".gz"):
-                open_file = gzip.open
-            elif filename.endswith(".xml"):
-                open_file = open
-            else:
-                raise AssertionError('Expected gzip or xml, not %r' %
-                                                                 filename)
-            repo_filename = os.path.join(repo_dir, filename)
-            recipe_repo_filename = os.path.join(recipe_repo_dir, filename)
-            repo_file = open_file(repo_filename)
-            recipe_repo_file = open_file(recipe_repo_filename)
-            self._assert_xml_equivalence(repo_file, recipe_repo_file)
+        # Two recipes share the same snapshot
+        self.tasklibrary.link_snapshot_repo(os.path.join(repos_dir, '1'), snapshots_dir)
+        self.tasklibrary.link_snapshot_repo(os.path.join(repos_dir, '2'), snapshots_dir)
+        self.assertEquals(len(os.listdir(snapshots_dir)), 1)
+        self.assertEquals(os.readlink(os.path.join(repos_dir, '1')),
+                os.readlink(os.path.join(repos_dir, '2')))
+        self.assertTrue(os.path.exists(os.path.join(repos_dir, '1', rpm_name)))
+        self.assertTrue(os.path.exists(os.path.join(repos_dir, '1',
+                'repodata', 'repomd.xml')))
+        old_snapshot = os.readlink(os.path.join(repos_dir, '1'))
+        # After the library changes, new recipes get a new snapshot
+        self.tasklibrary.unlink_rpm(rpm_name)
+        self.tasklibrary.update_repo()
+        self.tasklibrary.link_snapshot_repo(os.path.join(repos_dir, '3'), snapshots_dir)
+        self.assertNotEquals(os.readlink(os.path.join(repos_dir, '3')), old_snapshot)
+        self.assertEquals(len(os.listdir(snapshots_dir)), 2)
+        # Once no recipe is using the old snapshot, it is removed when the 
+        # next one is created
+        os.unlink(os.path.join(repos_dir, '1'))
+        os.unlink(os.path.join(repos_dir, '2'))
+        copy(rpm_file, self.tasklibrary.rpmspath)
+        self.tasklibrary.update_repo()
+        self.tasklibrary.link_snapshot_repo(os.path.join(repos_dir, '4'), snapshots_dir)
+        self.assertItemsEqual(os.listdir(snapshots_dir),
+                [os.path.basename(os.readlink(os.path.join(repos_dir, '3'))),
+                 os.path.basename(os.readlink(os.path.join(repos_dir, '4')))])
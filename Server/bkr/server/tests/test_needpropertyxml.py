@@ -5,6 +5,7 @@
 # (at your option) any later version.
 
 import unittest
+from turbogears import config
 from bkr.server import needpropertyxml
 
 decimal_prefixes = {
@@ -33,3 +34,58 @@ def check_bytes_multiplier(units, expected):
     actual = needpropertyxml.bytes_multiplier(units)
     assert actual == expected, 'Units %s, expected %s, actual %s' % (
             units, expected, actual)
+
+class FilterCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        needpropertyxml.filter_cache.clear()
+
+    def test_identical_xml_is_parsed_once(self):
+        first = needpropertyxml.XmlHost.from_string(
+                '<hostRequires><hostname op="=" value="a.example.com"/></hostRequires>')
+        second = needpropertyxml.XmlHost.from_string(
+                '<hostRequires>\n  <hostname op="=" value="a.example.com"/>\n</hostRequires>\n')
+        self.assertIs(first, second)
+        other = needpropertyxml.XmlHost.from_string(
+                '<hostRequires><hostname op="=" value="b.example.com"/></hostRequires>')
+        self.assertIsNot(first, other)
+
+    def test_least_recently_used_filter_is_evicted(self):
+        config.update({'beaker.filter_cache_size': 2})
+        self.addCleanup(config.update, {'beaker.filter_cache_size': 1000})
+        xml = '<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+        first = needpropertyxml.XmlHost.from_string(xml % 'first')
+        second = needpropertyxml.XmlHost.from_string(xml % 'second')
+        self.assertIs(needpropertyxml.XmlHost.from_string(xml % 'first'), first)
+        needpropertyxml.XmlHost.from_string(xml % 'third')
+        self.assertEquals(len(needpropertyxml.filter_cache.entries), 2)
+        self.assertIs(needpropertyxml.XmlHost.from_string(xml % 'first'), first)
+        self.assertIsNot(needpropertyxml.XmlHost.from_string(xml % 'second'), second)
+
+    def test_invalid_xml(self):
+        self.assertRaises(ValueError, needpropertyxml.XmlHost.from_string,
+                '<hostRequires>')
+
+    def test_compiled_filter_repeats_joins(self):
+        host_filter = needpropertyxml.XmlHost.from_string('''
+            <hostRequires>
+                <system><owner op="=" value="someone"/></system>
+                <cpu><cores op="&gt;" value="4"/></cpu>
+            </hostRequires>''')
+        first_joins, first_clause = host_filter.compiled_filter(
+                needpropertyxml._JoinRecorder())
+        second_joins, second_clause = host_filter.compiled_filter(
+                needpropertyxml._JoinRecorder())
+        self.assertIs(first_clause, second_clause)
+        self.assertEquals(len(first_joins.calls), 2)
+        self.assertEquals(first_joins.calls, second_joins.calls)
+
+    def test_filters_with_lookups_are_not_reused(self):
+        host_filter = needpropertyxml.XmlHost.from_string('''
+            <hostRequires>
+                <and><key_value key="NETWORK" op="=" value="e1000"/></and>
+            </hostRequires>''')
+        self.assertFalse(host_filter._filter_is_reusable())
+        host_filter = needpropertyxml.XmlHost.from_string(
+                '<hostRequires><hostname op="=" value="a.example.com"/></hostRequires>')
+        self.assertTrue(host_filter._filter_is_reusable())
@@ -0,0 +1,23 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import unittest2 as unittest
+from bkr.server.model.search import trigrams, pattern_trigrams
+
+class TrigramTest(unittest.TestCase):
+
+    def test_trigrams(self):
+        self.assertEquals(trigrams(u'Example'),
+                set([u'exa', u'xam', u'amp', u'mpl', u'ple']))
+        self.assertEquals(trigrams(u'ab'), set())
+
+    def test_trigrams_are_accent_insensitive(self):
+        self.assertEquals(trigrams(u'Caf\xe9'), trigrams(u'cafe'))
+
+    def test_pattern_trigrams(self):
+        # only trigrams which do not span a wildcard
+        self.assertEquals(pattern_trigrams(u'%exa_ple%'),
+                set([u'exa', u'ple']))
+        self.assertEquals(pattern_trigrams(u'ab%'), set())
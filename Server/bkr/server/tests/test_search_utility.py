@@ -7,7 +7,7 @@
 import unittest2 as unittest
 import datetime
 from decimal import Decimal
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql import and_, or_, not_
 from sqlalchemy.sql.expression import true, false
 from bkr.server.model import User, System, LabInfo, Device
 from bkr.server.search_utility import lucene_to_sqlalchemy
@@ -70,6 +70,54 @@ def test_negation(self):
                 [User.user_name])
         self.assert_clause_equals(clause, User.user_name != u'rmancy')
 
+    def test_grouping(self):
+        clause = lucene_to_sqlalchemy(
+                u'-(user_name:rmancy email_address:rmancy@redhat.com)',
+                {'user_name': User.user_name, 'email_address': User.email_address},
+                [User.user_name, User.email_address])
+        self.assert_clause_equals(clause,
+                not_(and_(User.user_name == u'rmancy',
+                          User.email_address == u'rmancy@redhat.com')))
+
+    def test_or(self):
+        clause = lucene_to_sqlalchemy(
+                u'user_name:rmancy OR user_name:dcallagh',
+                {'user_name': User.user_name}, [User.user_name])
+        self.assert_clause_equals(clause,
+                or_(User.user_name == u'rmancy', User.user_name == u'dcallagh'))
+        # AND binds more tightly than OR
+        clause = lucene_to_sqlalchemy(
+                u'user_name:rmancy email_address:*redhat* OR user_name:dcallagh',
+                {'user_name': User.user_name, 'email_address': User.email_address},
+                [User.user_name, User.email_address])
+        self.assert_clause_equals(clause,
+                or_(and_(User.user_name == u'rmancy',
+                         User.email_address.like(u'%redhat%')),
+                    User.user_name == u'dcallagh'))
+
+    def test_not_operator(self):
+        clause = lucene_to_sqlalchemy(u'NOT user_name:rmancy',
+                {'user_name': User.user_name}, [User.user_name])
+        self.assert_clause_equals(clause, User.user_name != u'rmancy')
+
+    def test_field_applies_to_group(self):
+        clause = lucene_to_sqlalchemy(u'user_name:(rmancy OR dcallagh)',
+                {'user_name': User.user_name, 'email_address': User.email_address},
+                [User.user_name, User.email_address])
+        self.assert_clause_equals(clause,
+                or_(User.user_name == u'rmancy', User.user_name == u'dcallagh'))
+
+    def test_unbalanced_parentheses(self):
+        clause = lucene_to_sqlalchemy(u'(user_name:rmancy',
+                {'user_name': User.user_name}, [User.user_name])
+        self.assert_clause_equals(clause, User.user_name == u'rmancy')
+        clause = lucene_to_sqlalchemy(u'user_name:rmancy)',
+                {'user_name': User.user_name}, [User.user_name])
+        self.assert_clause_equals(clause, User.user_name == u'rmancy')
+        clause = lucene_to_sqlalchemy(u'user_name:rmancy ()',
+                {'user_name': User.user_name}, [User.user_name])
+        self.assert_clause_equals(clause, User.user_name == u'rmancy')
+
     def test_integer_column(self):
         clause = lucene_to_sqlalchemy(u'memory:1024',
                 {'memory': System.memory}, [System.memory])
@@ -16,8 +16,10 @@
 import os
 import random
 from bkr.common import __version__
+from bkr.common.helpers import total_seconds
 from bkr.log import log_to_stream, log_to_syslog
-from bkr.server import needpropertyxml, utilisation, metrics, dynamic_virt
+from bkr.server import needpropertyxml, utilisation, metrics, dynamic_virt, \
+        wakeup
 from bkr.server.bexceptions import BX, \
     StaleTaskStatusException, InsufficientSystemPermissions, \
     StaleSystemUserException
@@ -26,8 +28,8 @@
         Watchdog, System, DistroTree, LabControllerDistroTree, SystemStatus,
         SystemResource, GuestResource, Arch,
         SystemAccessPolicy, SystemPermission, ConfigItem, Command,
-        Power, PowerType, DataMigration)
-from bkr.server.model.scheduler import machine_guest_map
+        Power, PowerType, DataMigration, Cpu)
+from bkr.server.model.scheduler import machine_guest_map, system_recipe_map
 from bkr.server.needpropertyxml import XmlHost
 from bkr.server.util import load_config_or_exit, log_traceback, \
         get_reports_engine
@@ -36,11 +38,13 @@
 from turbogears import config
 from turbomail.control import interface
 from xmlrpclib import ProtocolError
+from sqlalchemy import event as orm_event
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.expression import func, select, and_, or_, not_
-from sqlalchemy.orm import aliased, create_session
+from sqlalchemy.orm import aliased, create_session, subqueryload_all
 
 import socket
+import errno
 import exceptions
 from datetime import datetime, timedelta
 import time
@@ -52,11 +56,18 @@
 import threading
 import os
 import concurrent.futures
+import functools
 import logging
+from collections import defaultdict
 
 log = logging.getLogger(__name__)
 running = True
 event = threading.Event()
+# Set to wake up the main recipes loop: by the periodic poll in schedule(), by 
+# notifications from the web application (see bkr.server.wakeup), and on 
+# shutdown. Unlike event, it stays set until the loop starts its next pass, so 
+# that a notification arriving during a pass is not lost.
+wakeup_event = threading.Event()
 _threadpool_executor = None
 
 from optparse import OptionParser
@@ -88,47 +99,279 @@ def get_virt_executor():
        _threadpool_executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
     return _threadpool_executor
 
+_worker_executors = None
+def get_worker_executors():
+    """
+    Returns a list of single-threaded executors, one per worker. Work for 
+    a given job is always handed to the same worker (see _run_sharded) so 
+    that it is processed in order, while different jobs are processed in 
+    parallel.
+    """
+    global _worker_executors
+    if _worker_executors is None:
+        num_workers = config.get('beaker.scheduler_workers', 1)
+        _worker_executors = [concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                for _ in range(num_workers)]
+    return _worker_executors
+
+# Instrumentation of the main loop. Each stage is timed and counted, and the 
+# time recipes spend in each status on their way to being scheduled is 
+# recorded. Everything is sent to Graphite (if configured) and also kept 
+# locally, so that it can be dumped to the log by sending SIGUSR1 to beakerd.
+
+class StageStats(object):
+
+    def __init__(self):
+        self.runs = 0
+        self.items = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        self.last_items = 0
+
+    def record(self, elapsed, items):
+        self.runs += 1
+        self.items += items
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.last_time = elapsed
+        self.last_items = items
+
+    def __str__(self):
+        return ('runs=%d items=%d total=%.3fs mean=%.3fs max=%.3fs '
+                'last=%.3fs last_items=%d' % (self.runs, self.items,
+                self.total_time, self.total_time / max(self.runs, 1),
+                self.max_time, self.last_time, self.last_items))
+
+class LatencyHistogram(object):
+
+    #: upper bounds of each bucket, in seconds
+    buckets = [1, 5, 15, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += seconds
+
+    def __str__(self):
+        labels = ['<=%ss' % bound for bound in self.buckets] + ['more']
+        return 'count=%d mean=%.1fs %s' % (self.count,
+                self.total / max(self.count, 1),
+                ' '.join('%s:%d' % (label, count)
+                    for label, count in zip(labels, self.counts)))
+
+_stats_lock = threading.Lock()
+_stage_stats = defaultdict(StageStats)
+_recipe_latencies = defaultdict(LatencyHistogram)
+# recipe id -> time of its last status transition, for recipes on their way 
+# from New to Scheduled. Recipes which are cancelled part way are never 
+# removed, so the dict is simply cleared if it grows too large.
+_recipe_transition_times = {}
+_max_recipe_transition_times = 100000
+_current_stage = threading.local()
+
+def instrumented_stage(func):
+    """
+    Decorator for the stage functions called by _main_recipes(), which records 
+    how long each call took and how many items it handled.
+    """
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _current_stage.items = 0
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            items = _current_stage.items
+            with _stats_lock:
+                _stage_stats[name].record(elapsed, items)
+            metrics.measure('timers.beakerd_stages.%s' % name, elapsed)
+            metrics.increment('counters.beakerd_stage_items.%s' % name, items)
+    return wrapper
+
+def _record_stage_items(count):
+    _current_stage.items = getattr(_current_stage, 'items', 0) + count
+
+def _record_recipe_transition(recipe, old_status, new_status):
+    # The transition is only counted once the transaction which made it has 
+    # been committed, see _commit_recipe_transitions().
+    now = time.time()
+    if old_status == TaskStatus.new:
+        # The submission time is stored, so this one survives restarts
+        since = now - total_seconds(datetime.utcnow() - recipe.recipeset.queue_time)
+    else:
+        since = None
+    session.info.setdefault('recipe_transitions', []).append(
+            (recipe.id, old_status, new_status, now, since))
+
+def _pending_recipe_transitions():
+    return len(session.info.get('recipe_transitions', []))
+
+def _discard_recipe_transitions(mark=0):
+    """
+    Forgets the transitions recorded since mark, because the transaction or 
+    savepoint which made them was rolled back.
+    """
+    del session.info.get('recipe_transitions', [])[mark:]
+
+def _commit_recipe_transitions():
+    """
+    Updates the recipe latencies for the transitions made by the transaction 
+    which was just committed.
+    """
+    for recipe_id, old_status, new_status, now, since in \
+            session.info.pop('recipe_transitions', []):
+        with _stats_lock:
+            if since is None:
+                since = _recipe_transition_times.get(recipe_id)
+            if new_status == TaskStatus.scheduled:
+                _recipe_transition_times.pop(recipe_id, None)
+            else:
+                if len(_recipe_transition_times) >= _max_recipe_transition_times:
+                    _recipe_transition_times.clear()
+                _recipe_transition_times[recipe_id] = now
+            if since is not None:
+                name = '%s_to_%s' % (old_status.name, new_status.name)
+                _recipe_latencies[name].observe(now - since)
+        if since is not None:
+            metrics.measure('timers.recipe_latency.%s' % name, now - since)
+
+def dump_stats():
+    """
+    Writes the locally collected stage timings and recipe latencies to the log.
+    """
+    with _stats_lock:
+        for name, stats in sorted(_stage_stats.items()):
+            log.info('Stage %s: %s', name, stats)
+        for name, histogram in sorted(_recipe_latencies.items()):
+            log.info('Recipe latency %s: %s', name, histogram)
+
+def _run_in_transaction(func, obj_id):
+    # Each thread has its own session, since the TurboGears session is 
+    # a thread-local scoped session.
+    session.begin()
+    try:
+        func(obj_id)
+        session.commit()
+        _commit_recipe_transitions()
+    except Exception, e:
+        log.exception('Error in %s(%s)', func.__name__, obj_id)
+        session.rollback()
+        _discard_recipe_transitions()
+    finally:
+        session.close()
+
+def _run_sharded(func, items):
+    """
+    Calls func(obj_id), each in its own transaction, for every (job id, obj id) 
+    pair in items. If beaker.scheduler_workers is greater than 1, the calls are 
+    sharded by job id across that many worker threads.
+
+    Returns True if there were any items.
+    """
+    _record_stage_items(len(items))
+    if config.get('beaker.scheduler_workers', 1) <= 1:
+        for job_id, obj_id in items:
+            _run_in_transaction(func, obj_id)
+        return bool(items)
+    executors = get_worker_executors()
+    futures = [executors[job_id % len(executors)].submit(
+            _run_in_transaction, func, obj_id)
+            for job_id, obj_id in items]
+    concurrent.futures.wait(futures)
+    return bool(futures)
+
+@instrumented_stage
 def update_dirty_jobs():
     work_done = False
+    batch_size = config.get('beaker.dirty_job_batch_size', 20)
     dirty_jobs = Job.query.filter(Job.dirty_version != Job.clean_version)
-    for job_id, in dirty_jobs.values(Job.id):
-        session.begin()
-        try:
-            update_dirty_job(job_id)
-            session.commit()
-        except Exception, e:
-            log.exception('Error in update_dirty_job(%s)', job_id)
-            session.rollback()
-        finally:
-            session.close()
+    job_ids = [job_id for job_id, in dirty_jobs.values(Job.id)]
+    _record_stage_items(len(job_ids))
+    for i in xrange(0, len(job_ids), max(batch_size, 1)):
+        if batch_size > 1:
+            failed_job_ids = update_dirty_jobs_batch(job_ids[i:i + batch_size])
+        else:
+            failed_job_ids = job_ids[i:i + 1]
+        # Jobs which could not be updated as part of a batch are retried 
+        # individually, so that one bad job cannot hold up the others.
+        for job_id in failed_job_ids:
+            session.begin()
+            try:
+                update_dirty_job(job_id)
+                session.commit()
+            except Exception, e:
+                log.exception('Error in update_dirty_job(%s)', job_id)
+                session.rollback()
+            finally:
+                session.close()
         work_done = True
         if event.is_set():
             break
     return work_done
 
+def update_dirty_jobs_batch(job_ids):
+    """
+    Updates the given dirty jobs in a single transaction. The recipe sets and 
+    recipes are loaded up front and the task counts are computed with 
+    aggregate queries, rather than walking every task of every job.
+
+    Returns a list of job ids which could not be updated and should be retried 
+    on their own.
+    """
+    log.debug('Updating dirty jobs %s', ', '.join(str(job_id) for job_id in job_ids))
+    failed_job_ids = []
+    session.begin()
+    try:
+        jobs = Job.query.filter(Job.id.in_(job_ids))\
+                .filter(Job.dirty_version != Job.clean_version)\
+                .options(subqueryload_all(Job.recipesets, RecipeSet.recipes))\
+                .all()
+        task_rollups = Recipe.task_rollups_for_jobs(job_ids)
+        for job in jobs:
+            session.begin(nested=True)
+            try:
+                job.update_status(task_rollups=task_rollups)
+                session.commit()
+            except Exception, e:
+                log.warn('Error updating dirty job %s in batch, '
+                        'will retry it on its own: %s', job.id, e)
+                session.rollback()
+                failed_job_ids.append(job.id)
+        session.commit()
+    except Exception, e:
+        log.exception('Error in update_dirty_jobs_batch(%s)', job_ids)
+        session.rollback()
+        failed_job_ids = job_ids
+    finally:
+        session.close()
+    return failed_job_ids
+
 def update_dirty_job(job_id):
     log.debug('Updating dirty job %s', job_id)
     job = Job.by_id(job_id)
     job.update_status()
 
+@instrumented_stage
 def process_new_recipes(*args):
-    work_done = False
     recipes = MachineRecipe.query\
             .join(MachineRecipe.recipeset).join(RecipeSet.job)\
             .filter(Job.dirty_version == Job.clean_version)\
             .filter(Recipe.status == TaskStatus.new)
-    for recipe_id, in recipes.values(MachineRecipe.id):
-        session.begin()
-        try:
-            process_new_recipe(recipe_id)
-            session.commit()
-        except Exception, e:
-            log.exception('Error in process_new_recipe(%s)', recipe_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    return _run_sharded(process_new_recipe,
+            list(recipes.values(Job.id, MachineRecipe.id)))
 
 def process_new_recipe(recipe_id):
     recipe = MachineRecipe.by_id(recipe_id)
@@ -176,28 +419,19 @@ def process_new_recipe(recipe_id):
         recipe.recipeset.abort(u'Recipe ID %s does not match any systems' % recipe.id)
         return
     recipe.process()
+    _record_recipe_transition(recipe, TaskStatus.new, TaskStatus.processed)
     log.info("recipe ID %s moved from New to Processed" % recipe.id)
     for guestrecipe in recipe.guests:
         guestrecipe.process()
 
+@instrumented_stage
 def queue_processed_recipesets(*args):
-    work_done = False
     recipesets = RecipeSet.query.join(RecipeSet.job)\
             .filter(and_(Job.dirty_version == Job.clean_version, Job.deleted == None))\
             .filter(not_(RecipeSet.recipes.any(
                 Recipe.status != TaskStatus.processed)))
-    for rs_id, in recipesets.values(RecipeSet.id):
-        session.begin()
-        try:
-            queue_processed_recipeset(rs_id)
-            session.commit()
-        except Exception, e:
-            log.exception('Error in queue_processed_recipeset(%s)', rs_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    return _run_sharded(queue_processed_recipeset,
+            list(recipesets.values(Job.id, RecipeSet.id)))
 
 def queue_processed_recipeset(recipeset_id):
     recipeset = RecipeSet.by_id(recipeset_id)
@@ -206,6 +440,7 @@ def queue_processed_recipeset(recipeset_id):
     if len(list(recipeset.machine_recipes)) == 1:
         recipe = recipeset.machine_recipes.next()
         recipe.queue()
+        _record_recipe_transition(recipe, TaskStatus.processed, TaskStatus.queued)
         log.info("recipe ID %s moved from Processed to Queued", recipe.id)
         for guestrecipe in recipe.guests:
             guestrecipe.queue()
@@ -306,9 +541,11 @@ def queue_processed_recipeset(recipeset_id):
             # Set status to Queued
             log.info("recipe: %s moved from Processed to Queued" % recipe.id)
             recipe.queue()
+            _record_recipe_transition(recipe, TaskStatus.processed, TaskStatus.queued)
             for guestrecipe in recipe.guests:
                 guestrecipe.queue()
 
+@instrumented_stage
 def abort_dead_recipes(*args):
     work_done = False
     filters = [not_(DistroTree.lab_controller_assocs.any())]
@@ -324,6 +561,7 @@ def abort_dead_recipes(*args):
             .filter(Recipe.status == TaskStatus.queued)\
             .filter(or_(*filters))
     for recipe_id, in recipes.values(MachineRecipe.id):
+        _record_stage_items(1)
         session.begin()
         try:
             abort_dead_recipe(recipe_id)
@@ -349,10 +587,258 @@ def abort_dead_recipe(recipe_id):
         log.info(msg)
         recipe.recipeset.abort(msg)
 
+class _IndexedSystem(object):
+
+    __slots__ = ['id', 'lab_controller_id', 'loan_id', 'owner_id', 'in_pool',
+            'single_processor_bare_metal']
+
+    def __init__(self, id, lab_controller_id, loan_id, owner_id, in_pool,
+            single_processor_bare_metal):
+        self.id = id
+        self.lab_controller_id = lab_controller_id
+        self.loan_id = loan_id
+        self.owner_id = owner_id
+        self.in_pool = in_pool
+        self.single_processor_bare_metal = single_processor_bare_metal
+
+    def scheduler_ordering(self, owner_id):
+        # Same ordering as System.scheduler_ordering: systems owned by the job 
+        # owner first, then systems in pools, then everything else, with 
+        # single processor bare metal systems last within each group.
+        if self.owner_id == owner_id:
+            owner_rank = 1
+        elif self.in_pool:
+            owner_rank = 2
+        else:
+            owner_rank = 3
+        if self.single_processor_bare_metal is None:
+            # NULLs sort first in the database
+            bare_metal_rank = -1
+        else:
+            bare_metal_rank = int(self.single_processor_bare_metal)
+        return (owner_rank, bare_metal_rank, self.id)
+
+class SystemIndex(object):
+    """
+    In-memory index of free systems, used by schedule_queued_recipes() to hand 
+    systems to queued recipes without re-querying the inventory for every 
+    recipe.
+
+    The index is kept between scheduling passes. Most changes to systems 
+    (returns, loans, lab controller changes) happen in the web application 
+    where we cannot observe them, so at the start of each pass a few 
+    aggregate queries compute a signature of the free systems, queued recipes 
+    and distro tree locations. The index is only rebuilt when the signature 
+    differs from the one it was last in step with, or when it is older than 
+    *max_age* seconds. Within a pass it is kept up to date by ORM events, so 
+    that a system which is reserved or changes hands is never handed out 
+    again.
+    """
+
+    #: The index is rebuilt at least this often (in seconds), to pick up 
+    #: changes which the signature does not cover, such as pool membership.
+    max_age = 600
+
+    def __init__(self):
+        #: system id -> _IndexedSystem, for every free system in an enabled lab
+        self.systems = {}
+        #: distro tree id -> set of lab controller ids where it is available
+        self.distro_tree_labs = {}
+        #: recipe id -> set of ids of free systems in its candidate systems
+        self.recipe_candidates = {}
+        #: signature of the database state the index is in step with, or None 
+        #: if it must be rebuilt
+        self.signature = None
+        #: time the index was last rebuilt
+        self.refreshed = None
+
+    def current_signature(self):
+        """
+        Returns a tuple which summarises the free systems, queued recipes and 
+        distro tree locations, and changes when any of them do.
+        """
+        free_systems = session.query(func.count(System.id),
+                    func.sum(System.id),
+                    func.sum(func.coalesce(System.loan_id, 0)),
+                    func.sum(System.lab_controller_id),
+                    func.max(System.date_modified))\
+                .join(System.lab_controller)\
+                .filter(System.user == None)\
+                .filter(LabController.disabled == False)\
+                .one()
+        queued_recipes = session.query(func.count(Recipe.id), func.sum(Recipe.id))\
+                .filter(Recipe.status == TaskStatus.queued)\
+                .one()
+        distro_tree_labs = session.query(
+                    func.count(LabControllerDistroTree.id),
+                    func.max(LabControllerDistroTree.id))\
+                .one()
+        return tuple(free_systems) + tuple(queued_recipes) + tuple(distro_tree_labs)
+
+    def refresh_if_changed(self):
+        """
+        Rebuilds the index if the database has changed since it was last in 
+        step, or if it is too old.
+        """
+        signature = self.current_signature()
+        if signature == self.signature \
+                and time.time() - self.refreshed < self.max_age:
+            log.debug('System index is up to date')
+            return
+        self.refresh()
+        self.signature = signature
+        self.refreshed = time.time()
+
+    def remember_signature(self):
+        """
+        Records the signature after a scheduling pass, including the pass's 
+        own changes which the index already reflects, so that the next pass 
+        only rebuilds the index if something else has changed.
+        """
+        if self.signature is not None:
+            self.signature = self.current_signature()
+
+    def invalidate(self):
+        """
+        Forces a rebuild in the next pass, for when the index may have been 
+        updated with changes which were then rolled back.
+        """
+        self.signature = None
+
+    def refresh(self):
+        self.systems = {}
+        self.distro_tree_labs = {}
+        self.recipe_candidates = {}
+        free_systems = session.query(System.id, System.lab_controller_id,
+                    System.loan_id, System.owner_id, System.pools.any(),
+                    and_(System.hypervisor_id == None, Cpu.processors == 1))\
+                .join(System.lab_controller)\
+                .outerjoin(System.cpu)\
+                .filter(System.user == None)\
+                .filter(LabController.disabled == False)
+        for row in free_systems:
+            self.systems[row[0]] = _IndexedSystem(*row)
+        queued_distro_trees = select([Recipe.distro_tree_id],
+                whereclause=Recipe.status == TaskStatus.queued)
+        distro_tree_labs = session.query(LabControllerDistroTree.distro_tree_id,
+                    LabControllerDistroTree.lab_controller_id)\
+                .filter(LabControllerDistroTree.distro_tree_id.in_(queued_distro_trees))
+        for distro_tree_id, lab_controller_id in distro_tree_labs:
+            self.distro_tree_labs.setdefault(distro_tree_id, set())\
+                    .add(lab_controller_id)
+        recipe_candidates = session.connection(Recipe).execute(select(
+                [system_recipe_map.c.recipe_id, system_recipe_map.c.system_id],
+                from_obj=[system_recipe_map
+                    .join(Recipe.__table__,
+                        system_recipe_map.c.recipe_id == Recipe.__table__.c.id)
+                    .join(System.__table__,
+                        system_recipe_map.c.system_id == System.__table__.c.id)],
+                whereclause=and_(Recipe.status == TaskStatus.queued,
+                    System.user_id == None)))
+        for recipe_id, system_id in recipe_candidates:
+            if system_id in self.systems:
+                self.recipe_candidates.setdefault(recipe_id, set()).add(system_id)
+        log.debug('Indexed %s free systems, %s distro trees, %s recipes',
+                len(self.systems), len(self.distro_tree_labs),
+                len(self.recipe_candidates))
+
+    def discard_system(self, system_id):
+        self.systems.pop(system_id, None)
+
+    def has_candidates(self, recipe_id):
+        return any(system_id in self.systems
+                for system_id in self.recipe_candidates.get(recipe_id, ()))
+
+    def candidate_systems(self, recipe):
+        """
+        Returns the free systems which the given queued recipe could be 
+        scheduled on right now, in scheduler order. This applies the same 
+        criteria as the query in schedule_queued_recipe().
+        """
+        lab_controller_ids = self.distro_tree_labs.get(recipe.distro_tree_id, set())
+        guest_recipes = [guest for guest in recipe.guests
+                if guest.status == TaskStatus.queued and guest.distro_tree]
+        if guest_recipes:
+            latest_guest = max(guest_recipes,
+                    key=lambda guest: guest.distro_tree.date_created)
+            lab_controller_ids = lab_controller_ids.intersection(
+                    self.distro_tree_labs.get(latest_guest.distro_tree_id, set()))
+        if recipe.recipeset.lab_controller_id is not None:
+            lab_controller_ids = lab_controller_ids.intersection(
+                    [recipe.recipeset.lab_controller_id])
+        owner_id = recipe.recipeset.job.owner_id
+        systems = []
+        for system_id in self.recipe_candidates.get(recipe.id, ()):
+            system = self.systems.get(system_id)
+            if system is None:
+                continue
+            if system.lab_controller_id not in lab_controller_ids:
+                continue
+            if system.loan_id is not None and system.loan_id != owner_id:
+                continue
+            systems.append(system)
+        systems.sort(key=lambda system: system.scheduler_ordering(owner_id))
+        return systems
+
+# The index used by the current scheduling pass, if enabled.
+_system_index = None
+# The index kept between scheduling passes.
+_cached_system_index = None
+
+def _system_changed(target, value, oldvalue, initiator):
+    if _system_index is not None and target.id is not None:
+        _system_index.discard_system(target.id)
+
+def _system_user_changed(target, value, oldvalue, initiator):
+    # Only reservations matter here, a system being returned will be picked 
+    # up when the index is rebuilt at the start of the next pass.
+    if value is not None:
+        _system_changed(target, value, oldvalue, initiator)
+
+orm_event.listen(System.user, 'set', _system_user_changed)
+orm_event.listen(System.loaned, 'set', _system_changed)
+orm_event.listen(System.lab_controller, 'set', _system_changed)
+orm_event.listen(System.status, 'set', _system_changed)
+
+def _queued_recipes_with_free_candidates():
+    """
+    Returns the ids of queued recipes which have at least one free candidate 
+    system according to the system index, in scheduling order. This replaces 
+    the large query in schedule_queued_recipes() when the index is enabled.
+    """
+    recipes = MachineRecipe.query\
+        .join(Recipe.recipeset, RecipeSet.job)\
+        .filter(Job.dirty_version == Job.clean_version)\
+        .filter(Recipe.status == TaskStatus.queued)\
+        .order_by(RecipeSet.lab_controller == None)\
+        .order_by(RecipeSet.priority.desc())\
+        .order_by(RecipeSet.id)\
+        .order_by(MachineRecipe.id)
+    return [recipe_id for recipe_id, in recipes.values(MachineRecipe.id)
+            if _system_index.has_candidates(recipe_id)]
+
+@instrumented_stage
 def schedule_queued_recipes(*args):
+    global _system_index, _cached_system_index
     work_done = False
     session.begin()
     try:
+        if config.get('beaker.scheduler_system_index', False):
+            if _cached_system_index is None:
+                _cached_system_index = SystemIndex()
+            _system_index = _cached_system_index
+            _system_index.refresh_if_changed()
+            for recipe_id in _queued_recipes_with_free_candidates():
+                # Systems are handed out as we go, so check again
+                if not _system_index.has_candidates(recipe_id):
+                    continue
+                # The latest guest is picked by SystemIndex.candidate_systems()
+                _record_stage_items(1)
+                if _schedule_queued_recipe_in_savepoint(recipe_id, None):
+                    work_done = True
+            _system_index.remember_signature()
+            return work_done
+        _cached_system_index = None
         # This query returns a queued host recipe and and the guest which has
         # the most recent distro tree. It is to be used as a derived table.
         latest_guest_distro = select([machine_guest_map.c.machine_recipe_id.label('host_id'),
@@ -436,51 +922,92 @@ def schedule_queued_recipes(*args):
         # Don't do a GROUP BY before here, it is not needed.
         recipes = recipes.group_by(MachineRecipe.id)
         for recipe_id, guest_recipe_id in recipes.values(MachineRecipe.id, guest_recipe.id):
-            session.begin(nested=True)
-            try:
-                schedule_queued_recipe(recipe_id, guest_recipe_id)
-                session.commit()
-            except (StaleSystemUserException, InsufficientSystemPermissions,
-                 StaleTaskStatusException), e:
-                # Either
-                # System user has changed before
-                # system allocation
-                # or
-                # System permissions have changed before
-                # system allocation
-                # or
-                # Something has moved our status on from queued
-                # already.
-                log.warn(str(e))
-                session.rollback()
-            except Exception, e:
-                log.exception('Error in schedule_queued_recipe(%s)', recipe_id)
-                session.rollback()
-                session.begin(nested=True)
-                try:
-                    recipe=MachineRecipe.by_id(recipe_id)
-                    recipe.recipeset.abort(u"Aborted in schedule_queued_recipe: %s" % e)
-                    session.commit()
-                except Exception, e:
-                    log.exception("Error during error handling in schedule_queued_recipe: %s" % e)
-                    session.rollback()
+            _record_stage_items(1)
+            _schedule_queued_recipe_in_savepoint(recipe_id, guest_recipe_id)
             work_done = True
         return work_done
     except Exception:
         log.exception('Uncaught exception in schedule_queued_recipes')
         raise
     finally:
+        _system_index = None
         try:
             session.commit()
+            _commit_recipe_transitions()
         except OperationalError:
             msg = 'Possible DB deadlock in schedule_queued_recipes. '
             msg += 'See https://bugzilla.redhat.com/show_bug.cgi?id=958362'
             log.exception(msg)
             session.rollback()
+            _discard_recipe_transitions()
+            if _cached_system_index is not None:
+                _cached_system_index.invalidate()
         session.close()
 
+def _invalidate_system_index():
+    # The index may have been updated for changes which were just rolled back.
+    if _system_index is not None:
+        _system_index.invalidate()
+
+def _schedule_queued_recipe_in_savepoint(recipe_id, guest_recipe_id):
+    """
+    Returns True if the recipe was dealt with (scheduled, or aborted due to an 
+    error), False if it was left queued.
+    """
+    transitions_mark = _pending_recipe_transitions()
+    session.begin(nested=True)
+    try:
+        scheduled = schedule_queued_recipe(recipe_id, guest_recipe_id)
+        session.commit()
+        return scheduled is not False
+    except (StaleSystemUserException, InsufficientSystemPermissions,
+         StaleTaskStatusException), e:
+        # Either
+        # System user has changed before
+        # system allocation
+        # or
+        # System permissions have changed before
+        # system allocation
+        # or
+        # Something has moved our status on from queued
+        # already.
+        log.warn(str(e))
+        session.rollback()
+        _discard_recipe_transitions(transitions_mark)
+        _invalidate_system_index()
+    except Exception, e:
+        log.exception('Error in schedule_queued_recipe(%s)', recipe_id)
+        session.rollback()
+        _discard_recipe_transitions(transitions_mark)
+        _invalidate_system_index()
+        session.begin(nested=True)
+        try:
+            recipe=MachineRecipe.by_id(recipe_id)
+            recipe.recipeset.abort(u"Aborted in schedule_queued_recipe: %s" % e)
+            session.commit()
+        except Exception, e:
+            log.exception("Error during error handling in schedule_queued_recipe: %s" % e)
+            session.rollback()
+    return True
+
+def _select_system_from_index(recipe):
+    systems = _system_index.candidate_systems(recipe)
+    if not systems:
+        return None
+    if recipe.autopick_random:
+        indexed_system = random.choice(systems)
+    else:
+        indexed_system = systems[0]
+    return System.query.get(indexed_system.id)
+
 def schedule_queued_recipe(recipe_id, guest_recipe_id=None):
     log.debug('Selecting a system for recipe %s', recipe_id)
+    if _system_index is not None:
+        recipe = MachineRecipe.by_id(recipe_id)
+        system = _select_system_from_index(recipe)
+        if system is None:
+            return False
+        return _schedule_recipe_on_system(recipe, system)
     guest_recipe = aliased(Recipe)
     guest_distros_map = aliased(LabControllerDistroTree)
     guest_labcontroller = aliased(LabController)
@@ -532,7 +1059,7 @@ def schedule_queued_recipe(recipe_id, guest_recipe_id=None):
     # Something earlier in this pass meant we can't schedule this recipe
     # right now after all. We'll try again next pass.
     if not systems.count():
-        return
+        return False
 
     # Order systems by owner, then Group, finally shared for everyone.
     # FIXME Make this configurable, so that a user can specify their scheduling
@@ -553,6 +1080,9 @@ def schedule_queued_recipe(recipe_id, guest_recipe_id=None):
     else:
         system = systems.first()
 
+    return _schedule_recipe_on_system(recipe, system)
+
+def _schedule_recipe_on_system(recipe, system):
     log.debug("System : %s is available for Recipe %s" % (system, recipe.id))
     # Check to see if user still has proper permissions to use the system.
     # Remember the mapping of available systems could have happend hours or even
@@ -561,13 +1091,21 @@ def schedule_queued_recipe(recipe_id, guest_recipe_id=None):
         log.debug("System : %s recipe: %s no longer has access. removing" % (system, 
                                                                              recipe.id))
         recipe.systems.remove(system)
-        return
+        if _system_index is not None:
+            _system_index.recipe_candidates.get(recipe.id, set()).discard(system.id)
+        return False
 
     recipe.resource = SystemResource(system=system)
     # Reserving the system may fail here if someone stole it out from
     # underneath us, but that is fine...
-    recipe.resource.allocate()
+    try:
+        recipe.resource.allocate()
+    except StaleSystemUserException:
+        if _system_index is not None:
+            _system_index.discard_system(system.id)
+        raise
     recipe.schedule()
+    _record_recipe_transition(recipe, TaskStatus.queued, TaskStatus.scheduled)
     recipe.createRepo()
     recipe.recipeset.lab_controller = system.lab_controller
     recipe.systems = []
@@ -585,6 +1123,7 @@ def schedule_queued_recipe(recipe_id, guest_recipe_id=None):
         log.info('recipe ID %s guest %s moved from Queued to Scheduled',
                 recipe.id, guestrecipe.id)
 
+@instrumented_stage
 def provision_virt_recipes(*args):
     work_done = False
     recipes = MachineRecipe.query\
@@ -599,6 +1138,7 @@ def provision_virt_recipes(*args):
             .order_by(RecipeSet.priority.desc(), Recipe.id.asc())
     futures = [get_virt_executor().submit(provision_virt_recipe, recipe_id)
             for recipe_id, in recipes.values(Recipe.id.distinct())]
+    _record_stage_items(len(futures))
     if futures:
         concurrent.futures.wait(futures)
         work_done = True
@@ -640,6 +1180,7 @@ def provision_virt_recipe(recipe_id):
             recipe.recipeset.lab_controller = manager.lab_controller
             recipe.virt_status = RecipeVirtStatus.succeeded
             recipe.schedule()
+            _record_recipe_transition(recipe, TaskStatus.queued, TaskStatus.scheduled)
             log.info("recipe ID %s moved from Queued to Scheduled by provision_virt_recipe" % recipe.id)
             recipe.waiting()
             recipe.provision()
@@ -654,9 +1195,11 @@ def provision_virt_recipe(recipe_id):
                 # suppress this exception so the original one is not masked
             raise exc_type, exc_value, exc_tb
         session.commit()
+        _commit_recipe_transitions()
     except Exception, e:
         log.exception('Error in provision_virt_recipe(%s)', recipe_id)
         session.rollback()
+        _discard_recipe_transitions()
         # As an added precaution, let's try and avoid this recipe in future
         with session.begin():
             recipe = Recipe.by_id(recipe_id)
@@ -664,28 +1207,18 @@ def provision_virt_recipe(recipe_id):
     finally:
         session.close()
 
+@instrumented_stage
 def provision_scheduled_recipesets(*args):
     """
     if All recipes in a recipeSet are in Scheduled state then move them to
      Running.
     """
-    work_done = False
     recipesets = RecipeSet.query.join(RecipeSet.job)\
             .filter(and_(Job.dirty_version == Job.clean_version, Job.deleted == None))\
             .filter(not_(RecipeSet.recipes.any(
                 Recipe.status != TaskStatus.scheduled)))
-    for rs_id, in recipesets.values(RecipeSet.id):
-        session.begin()
-        try:
-            provision_scheduled_recipeset(rs_id)
-            session.commit()
-        except exceptions.Exception:
-            log.exception('Error in provision_scheduled_recipeset(%s)', rs_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    return _run_sharded(provision_scheduled_recipeset,
+            list(recipesets.values(Job.id, RecipeSet.id)))
 
 def provision_scheduled_recipeset(recipeset_id):
     recipeset = RecipeSet.by_id(recipeset_id)
@@ -707,6 +1240,7 @@ def provision_scheduled_recipeset(recipeset_id):
 # run_data_migrations() as migrations are completed.
 _outstanding_data_migrations = []
 
+@instrumented_stage
 def run_data_migrations():
     migration = _outstanding_data_migrations[0]
     log.debug('Performing online data migration %s (one batch)', migration.name)
@@ -855,11 +1389,23 @@ def _main_recipes():
 @log_traceback(log)
 def main_recipes_loop(*args, **kwargs):
     while running:
+        wakeup_event.clear()
         work_done = _main_recipes()
         if not work_done:
-            event.wait()
+            wakeup_event.wait()
     log.debug("main recipes thread exiting")
 
+@log_traceback(log)
+def wakeup_listener_loop(sock):
+    while running:
+        try:
+            sock.recv(64)
+        except socket.error, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        wakeup_event.set()
+
 def schedule():
     global running
     global _outstanding_data_migrations
@@ -877,6 +1423,19 @@ def schedule():
         metrics_thread.daemon = True
         metrics_thread.start()
 
+    if wakeup.socket_path():
+        try:
+            wakeup_sock = wakeup.bind()
+        except (socket.error, OSError), e:
+            log.warning('Cannot listen for notifications on %s, '
+                    'relying on polling only: %s', wakeup.socket_path(), e)
+        else:
+            log.debug('starting wakeup listener thread on %s', wakeup.socket_path())
+            wakeup_thread = threading.Thread(target=wakeup_listener_loop,
+                    name='wakeup_listener', args=(wakeup_sock,))
+            wakeup_thread.daemon = True
+            wakeup_thread.start()
+
     beakerd_threads = set(["main_recipes"])
 
     log.debug("starting main recipes thread")
@@ -894,17 +1453,23 @@ def schedule():
                 rc = 1
                 running = False
                 event.set()
+                wakeup_event.set()
                 break
             event.set()
             event.clear()
+            wakeup_event.set()
     except (SystemExit, KeyboardInterrupt):
        log.info("shutting down")
        running = False
        event.set()
+       wakeup_event.set()
        rc = 0
 
     if _threadpool_executor:
         _threadpool_executor.shutdown()
+    if _worker_executors:
+        for executor in _worker_executors:
+            executor.shutdown()
     interface.stop()
     main_recipes_thread.join(10)
 
@@ -913,6 +1478,9 @@ def schedule():
 def sigterm_handler(signal, frame):
     raise SystemExit("received SIGTERM")
 
+def sigusr1_handler(signal, frame):
+    dump_stats()
+
 def main():
     global opts
     parser = get_parser()
@@ -922,6 +1490,7 @@ def main():
 
     signal.signal(signal.SIGINT, sigterm_handler)
     signal.signal(signal.SIGTERM, sigterm_handler)
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
 
     if opts.foreground:
         log_to_stream(sys.stderr, level=logging.DEBUG)
@@ -145,7 +145,7 @@ def get_users():
         'email_address': User.email_address,
         'disabled': User.disabled,
         'removed': User.removed,
-    })
+    }, keyset=[User.user_name])
     if request_wants_json():
         return jsonify(json_result)
     return render_tg_template('bkr.server.templates.backgrid', {
@@ -0,0 +1,117 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Notifications for waking up beakerd as soon as there is work for it to do.
+
+beakerd listens on a Unix datagram socket. Whenever the web application
+commits a transaction which submits a job, changes the status of a job (for
+example a task finishing), or returns a system, it sends a datagram to that
+socket so that beakerd starts its next pass immediately instead of waiting for
+its periodic poll. Notifications are best effort: if beakerd is not listening
+they are silently dropped, and the periodic poll picks up the work instead.
+"""
+
+import os
+import errno
+import socket
+import logging
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from turbogears import config
+
+log = logging.getLogger(__name__)
+
+def socket_path():
+    """
+    Returns the path of beakerd's wakeup socket, or None if notifications are
+    disabled.
+    """
+    return config.get('beaker.scheduler_wakeup_socket',
+            '/var/run/beaker/beakerd.sock') or None
+
+def bind():
+    """
+    Creates and binds the socket which beakerd listens on.
+    """
+    path = socket_path()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        os.unlink(path) # left behind by a previous beakerd
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    sock.bind(path)
+    return sock
+
+_sender = None
+
+def notify():
+    """
+    Wakes up beakerd.
+    """
+    global _sender
+    path = socket_path()
+    if not path:
+        return
+    if _sender is None:
+        _sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _sender.setblocking(False)
+    try:
+        _sender.sendto('wakeup', path)
+    except socket.error, e:
+        # beakerd is not running, or it is already well behind and its
+        # socket buffer is full. Either way there is nothing useful to do.
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+            log.warning('Failed to notify beakerd: %s', e)
+
+def _wants_wakeup(obj):
+    # delayed import to avoid circular dependency
+    from bkr.server.model import Job, Reservation
+    if isinstance(obj, Job):
+        # New job submitted, or job marked dirty
+        return get_history(obj, 'dirty_version').has_changes()
+    if isinstance(obj, Reservation):
+        # System returned
+        return get_history(obj, 'finish_time').has_changes()
+    return False
+
+def _after_flush(session, flush_context):
+    if session.info.get('beakerd_wakeup'):
+        return
+    for obj in chain(session.new, session.dirty):
+        if _wants_wakeup(obj):
+            session.info['beakerd_wakeup'] = True
+            return
+
+def _after_commit(session):
+    # Savepoints are committed too, but the changes are not visible to beakerd
+    # until the enclosing transaction is committed.
+    if session.transaction is not None and session.transaction.nested:
+        return
+    if session.info.pop('beakerd_wakeup', False):
+        notify()
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('beakerd_wakeup', None)
+
+_listeners_installed = False
+
+def install_listeners():
+    """
+    Installs session event listeners which will notify beakerd after
+    a transaction is committed, if it changed anything beakerd cares about.
+    This is called when the web application starts up.
+    """
+    global _listeners_installed
+    if _listeners_installed:
+        return
+    event.listen(Session, 'after_flush', _after_flush)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+    _listeners_installed = True
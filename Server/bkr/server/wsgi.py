@@ -128,6 +128,10 @@ def restart_transaction_patched(args):
     with session.begin():
         model.device_classes = [c.device_class for c in model.DeviceClass.query]
 
+    # Wake up beakerd whenever we commit something it should act on.
+    from bkr.server import wakeup
+    wakeup.install_listeners()
+
     log.debug('Application initialised')
 
 # NOTE: order of before_request/after_request functions is important!